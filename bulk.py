@@ -0,0 +1,154 @@
+# streaming import and export of cats as CSV or JSON Lines, see DirectoryTree.bulk_load and iter_records
+import csv
+import json
+import os
+import sys
+
+# Columns of a CSV file, in this order when written, followed by CAT_PROPERTIES. Only name is required
+FIELDS = ("path", "name", "type", "role")
+# What a row describes, a cat unless type says otherwise
+KINDS = ("cat", "cubby")
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+class BulkFormatError(ValueError):
+    """Raised for a file or row that cannot be imported, the message says where"""
+
+def detect_format(path: str, fmt=None) -> str:
+    """Returns "csv" or "jsonl", from fmt if given and otherwise from the file extension"""
+    if fmt is None:
+        fmt = FORMATS.get(os.path.splitext(path)[1].lower())
+        if fmt is None:
+            raise BulkFormatError(f"{path}: unknown format, expected one of {', '.join(FORMATS)}")
+    elif fmt not in FORMATS.values():
+        raise BulkFormatError(f"Unknown format {fmt}, expected csv or jsonl")
+    return fmt
+
+def _csv_rows(f, path, properties):
+    reader = csv.reader(f)
+    try:
+        header = next(reader, None)
+        if header is None:
+            return
+        unknown = set(header) - set(FIELDS) - set(properties)
+        if unknown:
+            raise BulkFormatError(f"{path}:1: unknown column {', '.join(sorted(unknown))}")
+        if "name" not in header:
+            raise BulkFormatError(f"{path}:1: a name column is required")
+        # rows are lists, so fields are read by position rather than building a dict per row
+        width = len(header)
+        name_at = header.index("name")
+        path_at = header.index("path") if "path" in header else None
+        role_at = header.index("role") if "role" in header else None
+        type_at = header.index("type") if "type" in header else None
+        property_at = [(p, header.index(p)) for p in properties if p in header]
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != width:
+                if len(row) > width:
+                    raise BulkFormatError(f"{path}:{reader.line_num}: more cells than columns")
+                row += [""] * (width - len(row))
+            # an empty cell means the value was not given
+            yield (reader.line_num, row[path_at] if path_at is not None else "", row[name_at],
+                   row[type_at] or "cat" if type_at is not None else "cat",
+                   row[role_at] or None if role_at is not None else None, [(p, row[i]) for p, i in property_at if row[i]])
+    except csv.Error as e:
+        raise BulkFormatError(f"{path}:{reader.line_num}: {e}") from None
+
+def _jsonl_rows(f, path, properties):
+    allowed = set(FIELDS).union(properties)
+    wanted = set(properties)
+    decode = json.JSONDecoder().decode
+    for lineno, line in enumerate(f, 1):
+        try:
+            row = decode(line)
+        except json.JSONDecodeError as e:
+            if not line.strip():
+                continue
+            raise BulkFormatError(f"{path}:{lineno}: invalid JSON, {e}") from None
+        if not isinstance(row, dict):
+            raise BulkFormatError(f"{path}:{lineno}: expected a JSON object")
+        if not row.keys() <= allowed:
+            raise BulkFormatError(f"{path}:{lineno}: unknown field {', '.join(sorted(row.keys() - allowed))}")
+        properties = [(p, value) for p, value in row.items() if p in wanted and value is not None]
+        for p, value in properties:
+            if isinstance(value, (dict, list)):
+                raise BulkFormatError(f"{path}:{lineno}: {p} must be a single value, not {type(value).__name__}")
+        yield lineno, row.get("path") or "", row.get("name"), row.get("type") or "cat", row.get("role"), properties
+
+def read_cats(path: str, fmt=None):
+    """
+    Yields (line number, cubby path, name, kind, Role, [(property, value)]) for every row of the file,
+    one row at a time so the file is never held in memory. A row is a path (the cubby, relative to the
+    current one unless it starts with /, empty for the current cubby), a name, an optional type (cat,
+    or cubby for a cubby that may be empty), and for a cat an optional role (visitor, volunteer, staff
+    or admin, staff if omitted) and any of CAT_PROPERTIES.
+    Raises BulkFormatError for a row that does not fit.
+    """
+    from directory import CAT_PROPERTIES, Role
+
+    fmt = detect_format(path, fmt)
+    roles = {role.name.lower(): role for role in Role}
+    with open(path, newline="" if fmt == "csv" else None, encoding="utf-8") as f:
+        rows = _csv_rows(f, path, CAT_PROPERTIES) if fmt == "csv" else _jsonl_rows(f, path, CAT_PROPERTIES)
+        for lineno, cubby, name, kind, role_name, properties in rows:
+            if not isinstance(name, str) or not name or "/" in name or name in (".", ".."):
+                raise BulkFormatError(f"{path}:{lineno}: a {kind} needs a name without /")
+            if not isinstance(cubby, str):
+                raise BulkFormatError(f"{path}:{lineno}: path must be a string")
+            if kind == "cubby":
+                if role_name is not None or properties:
+                    raise BulkFormatError(f"{path}:{lineno}: a cubby has no role or properties")
+                yield lineno, cubby, name, kind, None, properties
+                continue
+            if kind != "cat":
+                raise BulkFormatError(f"{path}:{lineno}: invalid type {kind}, expected one of {', '.join(KINDS)}")
+            if role_name is None:
+                role = Role.STAFF
+            elif not isinstance(role_name, (str, int)):
+                raise BulkFormatError(f"{path}:{lineno}: role must be a string")
+            else:
+                role = roles.get(role_name)
+                if role is None:
+                    role = roles.get(str(role_name).lower())
+                    if role is None:
+                        raise BulkFormatError(f"{path}:{lineno}: invalid role {role_name}, expected one of {', '.join(roles)}")
+                    roles[role_name] = role
+            yield lineno, cubby, name, kind, role, properties
+
+def write_records(records, path: str, fmt=None) -> int:
+    """
+    Writes records (as yielded by DirectoryTree.iter_records) to path one at a time, so memory stays
+    flat however many there are. The file is written next to path and moved into place at the end,
+    so an interrupted export never leaves half a file. path "-" writes to standard output.
+    Returns:
+        int: How many records were written
+    """
+    from directory import CAT_PROPERTIES
+
+    fmt = detect_format(path, fmt) if path != "-" or fmt is not None else "jsonl"
+    if path == "-":
+        return _write(records, sys.stdout, fmt, CAT_PROPERTIES)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w", newline="" if fmt == "csv" else None, encoding="utf-8") as f:
+            count = _write(records, f, fmt, CAT_PROPERTIES)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
+def _write(records, f, fmt, properties) -> int:
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(f, FIELDS + tuple(properties))
+        writer.writeheader()
+        for count, record in enumerate(records, 1):
+            writer.writerow(record)
+    else:
+        encode = json.JSONEncoder(ensure_ascii=False).encode
+        for count, record in enumerate(records, 1):
+            f.write(encode(record) + "\n")
+    return count
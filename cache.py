@@ -1,45 +1,471 @@
 # implement caching algorithm
+from abc import ABC, abstractmethod
 from collections import OrderedDict
 from typing import Optional, TypeVar, Generic
 
 T = TypeVar('T')
+_MISSING = object()
 
-class LRUCache(Generic[T]):
+class Cache(ABC, Generic[T]):
     """
-    A Least Recently Used (LRU) cache implementation for storing generic objects.
-    Uses OrderedDict to maintain the order of access and automatically evict least recently used items.
+    Interface shared by every eviction policy. DirectoryTree only ever calls get on a lookup,
+    put after a miss and invalidate when a cached entry stops being valid.
+    Policies implement _get/_put/_invalidate and bump self.evictions themselves,
+    the public methods keep the remaining counters. _reset empties a policy's own containers.
     """
+    policy = None
+
     def __init__(self, capacity: int):
         """
             Args:
             capacity (int): Maximum number of items the cache can hold
         """
-        self.cache = OrderedDict()
         self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.insertions = 0
+        self.invalidations = 0
 
     def get(self, path: str) -> Optional[T]:
-        """        
+        """
         Args:
             path (str): The path to look up in the cache
         Returns:
             Optional[T]: The cached object if found, None otherwise
         """
-        if path not in self.cache:
-            return None
-        # Move the path to the end to mark it as recently used
-        self.cache.move_to_end(path)
-        return self.cache[path]
+        content = self._get(path)
+        if content is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return content
 
     def put(self, path: str, content: T) -> None:
-        """        
+        """
         Args:
             path (str): The path to store in the cache
             content (T): The object to cache
         """
+        if self._put(path, content):
+            self.insertions += 1
+
+    def invalidate(self, path: str) -> None:
+        """
+        Args:
+            path (str): The path to drop from the cache, if present
+        """
+        if self._invalidate(path):
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        """Drops every entry but keeps the counters"""
+        self._reset()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Counters since the cache was created, plus its current size
+        """
+        lookups = self.hits + self.misses
+        return {
+            "policy": self.policy,
+            "capacity": self.capacity,
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "insertions": self.insertions,
+            "invalidations": self.invalidations,
+        }
+
+    @abstractmethod
+    def _reset(self) -> None:
+        """empties the cache, called by __init__ and clear"""
+
+    @abstractmethod
+    def _get(self, path: str) -> Optional[T]:
+        """returns the cached object, None if path is not cached"""
+
+    @abstractmethod
+    def _put(self, path: str, content: T) -> bool:
+        """returns whether path was newly inserted rather than updated"""
+
+    @abstractmethod
+    def _invalidate(self, path: str) -> bool:
+        """returns whether path was cached"""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+class LRUCache(Cache[T]):
+    """
+    A Least Recently Used (LRU) cache implementation for storing generic objects.
+    Uses OrderedDict to maintain the order of access and automatically evict least recently used items.
+    """
+    policy = "lru"
+
+    def __init__(self, capacity: int):
+        """
+            Args:
+            capacity (int): Maximum number of items the cache can hold
+        """
+        super().__init__(capacity)
+        self._reset()
+
+    def _reset(self) -> None:
+        self.cache = OrderedDict()
+
+    def _get(self, path: str) -> Optional[T]:
+        if path not in self.cache:
+            return None
+        # Move the path to the end to mark it as recently used
+        self.cache.move_to_end(path)
+        return self.cache[path]
+
+    def _put(self, path: str, content: T) -> bool:
         if path in self.cache:
             # Update and mark as recently used
             self.cache.move_to_end(path)
+            self.cache[path] = content
+            return False
         self.cache[path] = content
         # Remove least recently used item if over capacity
         if len(self.cache) > self.capacity:
             self.cache.popitem(last=False)  # Pop from the beginning (LRU)
+            self.evictions += 1
+        return True
+
+    def _invalidate(self, path: str) -> bool:
+        return self.cache.pop(path, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+class LFUCache(Cache[T]):
+    """
+    A Least Frequently Used (LFU) cache. Entries are bucketed by access count so every
+    operation is O(1); ties within the lowest count are broken by recency.
+    """
+    policy = "lfu"
+
+    def __init__(self, capacity: int):
+        super().__init__(capacity)
+        self._reset()
+
+    def _reset(self) -> None:
+        self.values = {}
+        self.counts = {}
+        self.buckets = {}  # count -> OrderedDict of paths with that count, oldest first
+        self.min_count = 0
+
+    def _touch(self, path: str) -> None:
+        count = self.counts[path]
+        bucket = self.buckets[count]
+        del bucket[path]
+        if not bucket:
+            del self.buckets[count]
+            if self.min_count == count:
+                self.min_count = count + 1
+        self.counts[path] = count + 1
+        self.buckets.setdefault(count + 1, OrderedDict())[path] = None
+
+    def _get(self, path: str) -> Optional[T]:
+        if path not in self.values:
+            return None
+        self._touch(path)
+        return self.values[path]
+
+    def _put(self, path: str, content: T) -> bool:
+        if path in self.values:
+            self.values[path] = content
+            self._touch(path)
+            return False
+        if len(self.values) >= self.capacity:
+            victim, _ = self.buckets[self.min_count].popitem(last=False)
+            if not self.buckets[self.min_count]:
+                del self.buckets[self.min_count]
+            del self.values[victim]
+            del self.counts[victim]
+            self.evictions += 1
+        self.values[path] = content
+        self.counts[path] = 1
+        self.buckets.setdefault(1, OrderedDict())[path] = None
+        self.min_count = 1
+        return True
+
+    def _invalidate(self, path: str) -> bool:
+        if path not in self.values:
+            return False
+        count = self.counts.pop(path)
+        del self.values[path]
+        del self.buckets[count][path]
+        if not self.buckets[count]:
+            del self.buckets[count]
+            if self.min_count == count:
+                self.min_count = min(self.buckets, default=0)
+        return True
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+class TwoQCache(Cache[T]):
+    """
+    The full 2Q policy. New entries land in a small FIFO (a1in) and are only promoted to the
+    main LRU (am) if they are requested again after leaving it, which the ghost list a1out
+    remembers. A one-off scan therefore only churns a1in and leaves am alone.
+    """
+    policy = "2q"
+
+    def __init__(self, capacity: int):
+        super().__init__(capacity)
+        self.kin = max(1, capacity // 4)
+        self.kout = max(1, capacity // 2)
+        self._reset()
+
+    def _reset(self) -> None:
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict()  # ghost entries: paths only
+        self.am = OrderedDict()
+
+    def _get(self, path: str) -> Optional[T]:
+        if path in self.am:
+            self.am.move_to_end(path)
+            return self.am[path]
+        # a hit in a1in does not change its position, that is what makes 2Q scan resistant
+        return self.a1in.get(path)
+
+    def _reclaim(self) -> None:
+        if len(self.a1in) + len(self.am) < self.capacity:
+            return
+        if len(self.a1in) > self.kin or not self.am:
+            victim, _ = self.a1in.popitem(last=False)
+            self.a1out[victim] = None
+            if len(self.a1out) > self.kout:
+                self.a1out.popitem(last=False)
+        else:
+            self.am.popitem(last=False)
+        self.evictions += 1
+
+    def _put(self, path: str, content: T) -> bool:
+        if path in self.am:
+            self.am[path] = content
+            self.am.move_to_end(path)
+            return False
+        if path in self.a1in:
+            self.a1in[path] = content
+            return False
+        if path in self.a1out:
+            del self.a1out[path]
+            self._reclaim()
+            self.am[path] = content
+        else:
+            self._reclaim()
+            self.a1in[path] = content
+        return True
+
+    def _invalidate(self, path: str) -> bool:
+        return (self.am.pop(path, _MISSING) is not _MISSING) | (self.a1in.pop(path, _MISSING) is not _MISSING)
+
+    def __len__(self) -> int:
+        return len(self.a1in) + len(self.am)
+
+class ARCCache(Cache[T]):
+    """
+    Adaptive Replacement Cache. Resident entries are split between t1 (seen once) and t2
+    (seen at least twice), with ghost lists b1/b2 remembering what each recently evicted.
+    Ghost hits move the target size p of t1, so the split adapts between recency and frequency.
+    """
+    policy = "arc"
+
+    def __init__(self, capacity: int):
+        super().__init__(capacity)
+        self._reset()
+
+    def _reset(self) -> None:
+        self.p = 0
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+
+    def _get(self, path: str) -> Optional[T]:
+        if path in self.t1:
+            content = self.t1.pop(path)
+            self.t2[path] = content
+            return content
+        if path in self.t2:
+            self.t2.move_to_end(path)
+            return self.t2[path]
+        return None
+
+    def _replace(self, in_b2: bool) -> None:
+        # invalidations can leave the cache below capacity, in which case nothing needs to go
+        if len(self.t1) + len(self.t2) < self.capacity:
+            return
+        if self.t1 and (len(self.t1) > self.p or (in_b2 and len(self.t1) == self.p) or not self.t2):
+            victim, _ = self.t1.popitem(last=False)
+            self.b1[victim] = None
+        else:
+            victim, _ = self.t2.popitem(last=False)
+            self.b2[victim] = None
+        self.evictions += 1
+
+    def _put(self, path: str, content: T) -> bool:
+        if path in self.t1 or path in self.t2:
+            self.t1.pop(path, None)
+            self.t2[path] = content
+            self.t2.move_to_end(path)
+            return False
+        c = self.capacity
+        if path in self.b1:
+            self.p = min(c, self.p + max(len(self.b2) // len(self.b1), 1))
+            self._replace(False)
+            del self.b1[path]
+            self.t2[path] = content
+            return True
+        if path in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) // len(self.b2), 1))
+            self._replace(True)
+            del self.b2[path]
+            self.t2[path] = content
+            return True
+        l1 = len(self.t1) + len(self.b1)
+        total = l1 + len(self.t2) + len(self.b2)
+        if l1 >= c:
+            if len(self.t1) < c:
+                self.b1.popitem(last=False)
+                self._replace(False)
+            else:
+                self.t1.popitem(last=False)
+                self.evictions += 1
+        elif total >= c:
+            if total >= 2 * c:
+                self.b2.popitem(last=False)
+            self._replace(False)
+        self.t1[path] = content
+        return True
+
+    def _invalidate(self, path: str) -> bool:
+        return (self.t1.pop(path, _MISSING) is not _MISSING) | (self.t2.pop(path, _MISSING) is not _MISSING)
+
+    def __len__(self) -> int:
+        return len(self.t1) + len(self.t2)
+
+class TinyLFUCache(Cache[T]):
+    """
+    W-TinyLFU. New entries go through a small LRU window, and when one falls out of it
+    it is only admitted to the main segmented LRU if a count-min sketch says it has been
+    requested more often than the entry it would evict. Popular entries survive scans
+    because scanned paths are rarely more frequent than anything already cached.
+    """
+    policy = "tinylfu"
+
+    SKETCH_DEPTH = 4
+    MAX_COUNT = 15
+
+    def __init__(self, capacity: int):
+        super().__init__(capacity)
+        self.window_capacity = max(1, capacity // 100)
+        self.main_capacity = capacity - self.window_capacity
+        self.protected_capacity = max(1, self.main_capacity * 4 // 5)
+        width = 1
+        while width < capacity * 4:
+            width <<= 1
+        self.width_mask = width - 1
+        self.sample_limit = 10 * max(capacity, 1)
+        self._reset()
+
+    def _reset(self) -> None:
+        self.window = OrderedDict()
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.sketch = [bytearray(self.width_mask + 1) for _ in range(self.SKETCH_DEPTH)]
+        self.samples = 0
+
+    def _slots(self, path: str):
+        return [hash((row, path)) & self.width_mask for row in range(self.SKETCH_DEPTH)]
+
+    def _record(self, path: str) -> None:
+        for row, slot in zip(self.sketch, self._slots(path)):
+            if row[slot] < self.MAX_COUNT:
+                row[slot] += 1
+        self.samples += 1
+        if self.samples >= self.sample_limit:
+            # age the sketch so yesterday's popular paths don't stay popular forever
+            for row in self.sketch:
+                for slot in range(len(row)):
+                    row[slot] >>= 1
+            self.samples //= 2
+
+    def frequency(self, path: str) -> int:
+        return min(row[slot] for row, slot in zip(self.sketch, self._slots(path)))
+
+    def _get(self, path: str) -> Optional[T]:
+        self._record(path)
+        if path in self.window:
+            self.window.move_to_end(path)
+            return self.window[path]
+        if path in self.protected:
+            self.protected.move_to_end(path)
+            return self.protected[path]
+        if path in self.probation:
+            # a second hit promotes the entry, demoting the protected LRU if that is full
+            content = self.probation.pop(path)
+            self.protected[path] = content
+            if len(self.protected) > self.protected_capacity:
+                demoted, demoted_content = self.protected.popitem(last=False)
+                self.probation[demoted] = demoted_content
+            return content
+        return None
+
+    def _put(self, path: str, content: T) -> bool:
+        for segment in (self.window, self.protected, self.probation):
+            if path in segment:
+                segment[path] = content
+                return False
+        self.window[path] = content
+        if len(self.window) <= self.window_capacity:
+            return True
+        candidate, candidate_content = self.window.popitem(last=False)
+        if self.main_capacity > 0 and len(self.probation) + len(self.protected) < self.main_capacity:
+            self.probation[candidate] = candidate_content
+            return True
+        # whichever of the candidate and the probation victim loses the frequency contest is evicted
+        self.evictions += 1
+        if self.main_capacity <= 0:
+            return True
+        if not self.probation:
+            demoted, demoted_content = self.protected.popitem(last=False)
+            self.probation[demoted] = demoted_content
+        victim = next(iter(self.probation))
+        if self.frequency(candidate) > self.frequency(victim):
+            del self.probation[victim]
+            self.probation[candidate] = candidate_content
+        return True
+
+    def _invalidate(self, path: str) -> bool:
+        found = False
+        for segment in (self.window, self.probation, self.protected):
+            found |= segment.pop(path, _MISSING) is not _MISSING
+        return found
+
+    def __len__(self) -> int:
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+# Eviction policies selectable by name, e.g. from main.py's --cache-policy
+CACHE_POLICIES = {cls.policy: cls for cls in (LRUCache, LFUCache, TwoQCache, ARCCache, TinyLFUCache)}
+
+def make_cache(policy: str, capacity: int) -> Cache:
+    """
+    Args:
+        policy (str): One of the names in CACHE_POLICIES
+        capacity (int): Maximum number of items the cache can hold
+    Returns:
+        Cache: An empty cache using that eviction policy
+    """
+    if policy not in CACHE_POLICIES:
+        raise ValueError(f"Unknown cache policy {policy}, valid policies are: {', '.join(CACHE_POLICIES)}")
+    return CACHE_POLICIES[policy](capacity)
@@ -0,0 +1,88 @@
+# path resolution cache for DirectoryTree._traverse_to_node
+from collections import OrderedDict
+
+class DentryCache:
+    """
+    Maps (start cubby, path) to the node the path resolved to, so walking to a deep path
+    costs one lookup instead of one per component. Every entry remembers the lookups its
+    resolution made, as (cubby, name) pairs with ".." recorded as (node, ".."), and is
+    dropped as soon as one of them could give a different answer. Least recently used
+    entries are evicted beyond capacity. Paths that did not resolve are never cached.
+    """
+    def __init__(self, capacity: int):
+        """
+            Args:
+            capacity (int): Maximum number of cached paths
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()  # (start, path) -> (node, lookups)
+        self._dependents = {}  # (cubby, name) -> keys of the entries whose resolution looked it up
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, start, path: str):
+        """
+        Returns:
+            The cached node, or None on a miss
+        """
+        entry = self.entries.get((start, path))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end((start, path))
+        self.hits += 1
+        return entry[0]
+
+    def put(self, start, path: str, node, lookups) -> None:
+        """
+        Args:
+            start (FolderNode): Cubby the path was resolved from
+            path (str): The path as given
+            node: What it resolved to
+            lookups (list): The (cubby, name) lookups made while resolving it
+        """
+        key = (start, path)
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (node, lookups)
+        for lookup in lookups:
+            self._dependents.setdefault(lookup, set()).add(key)
+        if len(self.entries) > self.capacity:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, key) -> None:
+        _, lookups = self.entries.pop(key)
+        for lookup in lookups:
+            keys = self._dependents.get(lookup)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._dependents[lookup]
+
+    def invalidate(self, folder, name: str) -> None:
+        """Drops every entry that looked up name in folder (or folder's parent, for name "..")"""
+        keys = self._dependents.get((folder, name))
+        if keys is None:
+            return
+        for key in list(keys):
+            self._drop(key)
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self._dependents.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        accesses = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / accesses if accesses else 0.0,
+            "invalidations": self.invalidations,
+        }
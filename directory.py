@@ -1,8 +1,39 @@
+import fnmatch
+import gc
+import json
 import os
 import pickle
-from cache import LRUCache
+import re
+import sys
+import tempfile
+import threading
+from collections.abc import MutableMapping
+from contextlib import contextmanager, redirect_stdout
+from operator import attrgetter, itemgetter
+from bulk import BulkFormatError, read_cats, write_records
+from cache import make_cache
+from dentry import DentryCache
+from image import CafeImage, encode_image, write_image
+from journal import Journal
+from names import SortedNames
+from parallel import ParallelSearch, search
+from query import Predicate, make_property_index, parse_predicate, plan
+from rwlock import ReadWriteLock
+from shards import ShardStore
+from stats import timed
+from storage import encode_cafe, read_cafe, write_cafe
+from writer import BackgroundWriter
 from enum import Enum
 
+# Journal size (bytes) after which the snapshot is rewritten and the journal emptied
+JOURNAL_CHECKPOINT_BYTES = 1 << 20
+# How long (seconds) the background writer waits for more mutations before saving
+BACKGROUND_SAVE_DELAY = 0.05
+# Number of resolved paths remembered for walk
+DENTRY_CACHE_SIZE = 1024
+# Number of names remembered as not belonging to any cat, when find has to search the tree
+NEGATIVE_CACHE_SIZE = 4096
+
 # Role enum and global permissions
 class Role(Enum):
     VISITOR = 0
@@ -17,32 +48,133 @@ global_perms = {
     Role.ADMIN:     {"pet": True,  "feed": True,  "groom": True},
 }
 
+# Name multimaps map a name to a node, or to a list of nodes (in insertion order) once names collide
+def _multimap_add(index, name, node):
+    existing = index.get(name)
+    if existing is None:
+        index[name] = node
+    elif type(existing) is list:
+        existing.append(node)
+    else:
+        index[name] = [existing, node]
+
+def _multimap_remove(index, name, node):
+    existing = index[name]
+    if type(existing) is list:
+        existing.remove(node)
+        if len(existing) == 1:
+            index[name] = existing[0]
+    else:
+        del index[name]
+
+def _multimap_first(index, name):
+    node = index.get(name)
+    if type(node) is list:
+        return node[0]
+    return node
+
+def _name_multimap(nodes):
+    index = dict(zip(map(attrgetter("name"), nodes), nodes))
+    if len(index) < len(nodes):
+        # some names collide, which needs the slower multimap
+        index = {}
+        for node in nodes:
+            _multimap_add(index, node.name, node)
+    return index
+
+# A find argument containing any of these is a glob pattern rather than a cat's name
+GLOB_CHARS = frozenset("*?[")
+
+def _name_matcher(pattern, regex=False):
+    """Returns a predicate for the cat names pattern matches, or None if pattern is just a name.
+    Globs must match the whole name, regular expressions can match anywhere in it (like grep).
+    Raises re.error for an invalid regular expression"""
+    if regex:
+        return re.compile(pattern).search
+    if GLOB_CHARS.isdisjoint(pattern):
+        return None
+    return re.compile(fnmatch.translate(pattern)).match
+
+def _literal_prefix(pattern):
+    """The part of a glob pattern before its first wildcard"""
+    return pattern[:min(pattern.index(char) for char in GLOB_CHARS if char in pattern)]
+
+# The properties every cat has, in the order they are listed
+CAT_PROPERTIES = ("age", "mood", "date_found", "date_fed")
+
 class BaseNode:
+    # __slots__ keep nodes free of a per-instance __dict__, which matters at millions of cats
+    # _wd memoizes (path, depth) while the node is in the tree, see DirectoryTree._get_wd_of_node
+    __slots__ = ("name", "parent", "_wd")
     def __init__(self, name: str, parent=None):
         self.name = name
         self.parent = parent
+        self._wd = None
     def __repr__(self):
         return f"{self.__class__.__name__}(name={self.name})"
 
+class CatContent(MutableMapping):
+    """A dict-like view of a FileNode's properties, reads and writes go straight to the node's slots"""
+    __slots__ = ("_node",)
+    def __init__(self, node):
+        self._node = node
+    def __getitem__(self, property_name):
+        if property_name not in CAT_PROPERTIES:
+            raise KeyError(property_name)
+        return getattr(self._node, property_name)
+    def __setitem__(self, property_name, value):
+        if property_name not in CAT_PROPERTIES:
+            raise KeyError(property_name)
+        setattr(self._node, property_name, value)
+    def __delitem__(self, property_name):
+        raise TypeError("cat properties cannot be removed")
+    def __contains__(self, property_name):
+        return property_name in CAT_PROPERTIES
+    def __iter__(self):
+        return iter(CAT_PROPERTIES)
+    def __len__(self):
+        return len(CAT_PROPERTIES)
+    def copy(self):
+        return dict(self.items())
+    def __repr__(self):
+        return repr(self.copy())
+
 class FileNode(BaseNode):
+    __slots__ = ("required_role",) + CAT_PROPERTIES
+    is_file = True
     def __init__(self, name: str, required_role: Role = Role.STAFF, parent=None):
         super().__init__(name, parent)
-        self.is_file = True
-        self.content = {
-            'age': None,
-            'mood': None,
-            'date_found': None,
-            'date_fed': None
-        }
+        self.age = None
+        self.mood = None
+        self.date_found = None
+        self.date_fed = None
         self.required_role = required_role
+    def __getstate__(self):
+        return (self.name, self.parent, self.required_role, self.age, self.mood, self.date_found, self.date_fed)
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Older pickles stored an instance __dict__ with a content dict
+            content = state.get("content", {})
+            state = (state["name"], state["parent"], state["required_role"]) + tuple(content.get(p) for p in CAT_PROPERTIES)
+        self.name, self.parent, self.required_role, self.age, self.mood, self.date_found, self.date_fed = state
+        self._wd = None
+    @property
+    def content(self):
+        return CatContent(self)
+    @content.setter
+    def content(self, values):
+        for property_name in CAT_PROPERTIES:
+            setattr(self, property_name, values.get(property_name))
     def set_property(self, property_name, value):
-        if property_name in self.content:
+        if property_name in CAT_PROPERTIES:
             print(f"Setting {property_name} to {value}")
-            self.content[property_name] = value
+            setattr(self, property_name, value)
             return True
         return False
     def get_property(self, property_name):
-        return self.content.get(property_name)
+        if property_name in CAT_PROPERTIES:
+            return getattr(self, property_name)
+        return None
     def can_pet(self, user_role: Role):
         if user_role.value >= self.required_role.value:
             return True
@@ -57,77 +189,899 @@ class FileNode(BaseNode):
         return global_perms[user_role]["groom"]
 
 class FolderNode(BaseNode):
+    # children in insertion order (dict keys), plus name -> child, or a list of children when names collide.
+    # _store is the ShardStore to read them from, for a cubby of a lazily opened cafe not read yet
+    __slots__ = ("_children", "_by_name", "_store")
+    is_file = False
     def __init__(self, name: str, parent=None):
         super().__init__(name, parent)
-        self.is_file = False
-        self.children = []
-        self.dot = self
-        self.dotdot = parent
+        self._children = {}
+        self._by_name = {}
+    def __getstate__(self):
+        return (self.name, self.parent, list(self._children))
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Older pickles stored an instance __dict__, with children in a list or an ordered dict
+            children = state["children"] if "children" in state else state["_children"]
+            state = (state["name"], state["parent"], children)
+        self.name, self.parent, children = state
+        self._wd = None
+        # the children may not be unpickled yet, so the name map is left unset until first use
+        self._children = dict.fromkeys(children)
+    def __getattr__(self, name):
+        # only called for unset slots: the children of a lazily opened cubby, read on first use,
+        # or the name map of an unpickled cubby, built once its children are all there
+        if name == "_children" or name == "_by_name":
+            if name == "_by_name" and not hasattr(self, "_store"):
+                self._reindex()
+            else:
+                self._store.load_children(self)
+            return getattr(self, name)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+    @property
+    def dot(self):
+        return self
+    @property
+    def dotdot(self):
+        return self.parent
+    @property
+    def children(self):
+        return self._children.keys()
+    def _reindex(self):
+        self._by_name = _name_multimap(self._children)
+    def _fill(self, children):
+        # the name map is set first, so a thread that finds the children set finds it set too
+        self._by_name = _name_multimap(children)
+        self._children = dict.fromkeys(children)
     def add_child(self, child):
-        self.children.append(child)
+        self._children[child] = None
+        _multimap_add(self._by_name, child.name, child)
     def remove_child(self, child):
-        self.children.remove(child)
+        del self._children[child]
+        _multimap_remove(self._by_name, child.name, child)
+    def rename_child(self, child, new_name):
+        _multimap_remove(self._by_name, child.name, child)
+        collides = new_name in self._by_name
+        child.name = new_name
+        if collides:
+            # keep colliding children in insertion order so lookups still return the first one
+            self._by_name[new_name] = [c for c in self._children if c.name == new_name]
+        else:
+            self._by_name[new_name] = child
+    def find_child(self, name):
+        """returns the first child called name, without resolving . and .."""
+        return _multimap_first(self._by_name, name)
     def get_child(self, name):
         if name == ".":
             return self.dot
         elif name == "..":
             return self.dotdot
-        for child in self.children:
-            if child.name == name:
-                return child
-        return None
+        return self.find_child(name)
+
+class Session:
+    """Where one user of a tree is, what they may do and the cats they carry. The tree has its own,
+    and a server gives every client another one, see DirectoryTree.client_session"""
+    __slots__ = ("role", "current_node", "carried_cats")
+    def __init__(self, role: Role, current_node=None, carried_cats=None):
+        self.role = role
+        self.current_node = current_node
+        self.carried_cats = [] if carried_cats is None else carried_cats
+
+class Transaction:
+    """What a DirectoryTree needs to commit or roll back a batch of in-memory mutations.
+    Folders and nodes are copied the first time a mutation touches them."""
+    def __init__(self, tree):
+        self.records = []
+        self.folders = {}  # folder -> its children dict before the transaction
+        self.nodes = {}    # node -> (name, parent, content) before the transaction
+        self.carried_cats = list(tree.carried_cats)
+        self.current_node = tree.current_node
+
+class SaveSnapshot:
+    """The tree as it was when a save began, for a save that encodes it outside the tree's lock.
+    Mutations made meanwhile copy what they change first, as a Transaction does, so the lock is
+    only held for as long as the copies take."""
+    def __init__(self):
+        self.folders = {}  # folder -> its children before the save began
+        self.nodes = {}    # node -> a copy of it before the save began
+
+    def preserve(self, folder, node=None):
+        """Called with the tree's lock held, before folder (and node) change"""
+        if folder is not None and folder not in self.folders:
+            self.folders[folder] = list(folder._children)
+        if node is not None and node not in self.nodes:
+            if node.is_file:
+                copy = FileNode(node.name, node.required_role)
+                copy.content = node.content
+            else:
+                copy = FolderNode(node.name)
+            self.nodes[node] = copy
+
+    def children(self, folder) -> list:
+        children = list(folder.children)
+        # a folder is copied before it changes, so if it has not been the list above is still the old one
+        return self.folders.get(folder, children)
+
+    def changed(self) -> dict:
+        """Called once the encoder has read every node: the copies of those that may have changed meanwhile"""
+        return self.nodes
+
+class SearchSnapshot:
+    """An image of a DirectoryTree written for the workers of its parallel searches"""
+    __slots__ = ("path", "nodes", "ids", "changes", "searches")
+    def __init__(self, path: str, nodes: list, ids: dict, changes: int):
+        self.path = path
+        self.nodes = nodes  # the tree's nodes by image id, to hand back what the workers found
+        self.ids = ids  # and the other way round, to tell the workers which cubby to search
+        self.changes = changes  # the tree's change count when it was written
+        self.searches = 0  # running on it, its file is removed once the last one is done
 
 class DirectoryTree:
-    def __init__(self, name: str, cache_size: int=0, role: Role = Role.VISITOR):
-        self.cache_hits = 0
-        self.cache_accesses = 0
-        if cache_size > 0:
-            self.cache = LRUCache(cache_size)
-        else:
-            self.cache = None
+    def __init__(self, name: str, cache_size: int=0, role: Role = Role.VISITOR, journal: bool = False, index: bool = True,
+                 cache_policy: str = "lru", background: bool = False, property_indexes=(), sharded: bool = False):
         self.name = name
-        self.role = role
-        self.carried_cats = []
-        self._pkl_path = os.path.join("cafes", f"{name}.pkl")
+        self._init_session(role, cache_size, cache_policy)
+        if journal:
+            self.enable_journal()
         if not os.path.exists("cafes"):
             os.makedirs("cafes")
-        if os.path.exists(self._pkl_path):
+        if self.exists(name):
             raise RuntimeError(f"CatFS {name} already exists, cannot create another CatFS named the same thing")
         self.root = FolderNode("root")
+        self.carried_cats = []
+        self._journal_seq = 0
         self.current_node = self.root
-        self._save_to_pkl()
+        # cat name -> cat node(s) anywhere in the tree, so find doesn't need to walk it
+        self._name_index = {} if index else None
+        # the index's names in sorted order, for prefix searches, built the first time one is made
+        self._cat_names = None
+        for property_name in property_indexes:
+            self.index_property(property_name)
+        if sharded:
+            self._shards = ShardStore(self._shard_path)
+            self._shards.on_load = self._index_loaded
+            self._shards.mark_all(self.root)
+        self._save()
+        if background:
+            self.enable_background_saves()
+
+    def _init_session(self, role, cache_size=0, cache_policy="lru"):
+        """Sets up the state that belongs to this session and is never written to the cafe file"""
+        self.cache_hits = 0
+        self.cache_accesses = 0
+        self.set_cache_size(cache_size, cache_policy)
+        self.set_dentry_cache_size(DENTRY_CACHE_SIZE)
+        self.set_negative_cache_size(NEGATIVE_CACHE_SIZE)
+        self._child_names = {}  # cubby -> SortedNames of its children, for every cubby read so far
+        self._property_indexes = {}  # property name -> HashIndex or SortedIndex over the cats in the tree
+        self.queries_indexed = 0
+        self.queries_scanned = 0
+        self.latencies = {}  # command name -> LatencyHistogram
+        self._own_session = Session(role)
+        self._local = threading.local()  # .session, the Session of a server client running on this thread
+        self._client_sessions = set()
+        self._path = self.cafe_path(self.name)
+        self._legacy_path = os.path.join("cafes", f"{self.name}.pkl")
+        self._journal_path = os.path.join("cafes", f"{self.name}.journal")
+        self._journal = None
+        self._shard_path = self.shard_path(self.name)
+        self._shards = None  # a ShardStore if the cafe is stored as a directory of shards
+        self.checkpoint_bytes = JOURNAL_CHECKPOINT_BYTES
+        self._txn = None
+        self._defer_saves = False
+        self._dirty = False
+        self._saving = None  # the SaveSnapshot of a save encoding the tree outside the lock
+        self._changes = 0  # how many times the tree was changed, so a snapshot knows when it is stale
+        self._parallel = None  # a ParallelSearch, see enable_parallel_search
+        self._snapshot = None  # the SearchSnapshot it searches
+        self._snapshotting = None  # the thread writing the next one
+        # held while the tree is mutated or encoded, so a background save never sees half a mutation
+        self._lock = threading.RLock()
+        # held for a whole save, so snapshots reach the file in the order they were taken
+        self._save_lock = threading.Lock()
+        # lets server clients read the tree together while their mutations run one at a time, see server.py
+        self.rwlock = ReadWriteLock()
+        # guards the lookup caches, which readers holding the rwlock together still update
+        self._cache_lock = threading.Lock()
+        self._writer = None
+
+    @staticmethod
+    def cafe_path(name: str) -> str:
+        return os.path.join("cafes", f"{name}.cafe")
+
+    @staticmethod
+    def shard_path(name: str) -> str:
+        return os.path.join("cafes", f"{name}.shards")
+
+    @staticmethod
+    def image_path(name: str) -> str:
+        return os.path.join("cafes", f"{name}.img")
+
+    @classmethod
+    def exists(cls, name: str) -> bool:
+        """Whether a cafe called name was saved before, as a file, as shards or as a legacy pickle"""
+        return (os.path.exists(cls.cafe_path(name)) or ShardStore.exists(cls.shard_path(name))
+                or os.path.exists(os.path.join("cafes", f"{name}.pkl")))
+
+    @classmethod
+    def load(cls, name: str, role: Role = Role.VISITOR, cache_size: int = 0, cache_policy: str = "lru",
+             journal: bool = False, index: bool = True, background: bool = False, property_indexes=(),
+             sharded: bool = False, lazy: bool = True):
+        """
+        Opens a saved cafe at its root cubby and replays its journal. A cafe that only exists as a
+        legacy pickle is migrated, the new file is written next to it and the pickle is left alone.
+        With sharded, a cafe stored as a single file is converted to shards and the file removed.
+        A sharded cafe is opened lazily unless lazy is False: each cubby is read the first time it
+        is used, and find reads only the cubbies holding the name, see shards.py. Property indexes
+        still need the whole cafe, which is then read at once.
+        """
+        tree = cls.__new__(cls)
+        tree.name = name
+        tree._init_session(role, cache_size, cache_policy)
+        migrate = False
+        if ShardStore.exists(tree._shard_path):
+            tree._shards = ShardStore(tree._shard_path)
+            tree._shards.on_load = tree._index_loaded
+            tree.root, tree.carried_cats, meta = tree._shards.load(lazy)
+            tree._journal_seq = meta["journal_seq"]
+        elif os.path.exists(tree._path):
+            tree.root, tree.carried_cats, meta = read_cafe(tree._path)
+            tree._journal_seq = meta["journal_seq"]
+        else:
+            migrate = True
+            with open(tree._legacy_path, "rb") as f:
+                legacy = pickle.load(f)
+            tree.root, tree.carried_cats, tree._journal_seq = legacy.root, legacy.carried_cats, legacy._journal_seq
+        convert = sharded and tree._shards is None
+        if convert:
+            tree._shards = ShardStore(tree._shard_path)
+            tree._shards.on_load = tree._index_loaded
+            tree._shards.mark_all(tree.root)
+        tree.current_node = tree.root
+        tree._name_index = {} if index else None
+        tree._cat_names = None
+        tree._rebuild_indexes()
+        for property_name in property_indexes:
+            tree.index_property(property_name)
+        tree.replay_journal()
+        if migrate or convert or tree._shards is not None and tree._shards.outdated:
+            tree._save()
+        if convert and os.path.exists(tree._path):
+            os.remove(tree._path)
+        if journal:
+            tree.enable_journal()
+        if background:
+            tree.enable_background_saves()
+        return tree
+
+    def __getstate__(self):
+        # What a legacy pickled cafe held, the locks and the rest of the session state can't be pickled
+        return {"name": self.name, "root": self.root, "carried_cats": self._all_carried_cats(), "_journal_seq": self._journal_seq}
+
+    def __setstate__(self, state):
+        # Only legacy pickled cafes are unpickled, see load()
+        session = Session(state.pop("role", Role.VISITOR), state.pop("current_node", None), state.pop("carried_cats", []))
+        self.__dict__.update(state)
+        self._own_session = session
+        self._local = threading.local()
+        self.__dict__.setdefault("_journal_seq", 0)
+
+    @property
+    def session(self):
+        """The Session of whoever is using the tree on this thread"""
+        return getattr(self._local, "session", None) or self._own_session
+
+    @property
+    def role(self):
+        return self.session.role
+
+    @role.setter
+    def role(self, role):
+        self.session.role = role
+
+    @property
+    def current_node(self):
+        return self.session.current_node
+
+    @current_node.setter
+    def current_node(self, node):
+        self.session.current_node = node
+
+    @property
+    def carried_cats(self):
+        return self.session.carried_cats
+
+    @carried_cats.setter
+    def carried_cats(self, cats):
+        self.session.carried_cats = cats
+
+    def open_session(self, role: Role):
+        """
+        Returns a new Session at the root for a server client, so clients walk, carry and hold roles
+        independently. Every open session's carried cats are saved with the cafe.
+        """
+        session = Session(role, self.root)
+        with self._lock:
+            self._client_sessions.add(session)
+        return session
+
+    def close_session(self, session):
+        """Ends a session from open_session, the cats it still carries are handed to the tree's own session"""
+        with self.rwlock.write(), self._lock:
+            self._client_sessions.discard(session)
+            self._own_session.carried_cats.extend(session.carried_cats)
+
+    @contextmanager
+    def using_session(self, session):
+        """Runs the block as session on the calling thread"""
+        previous = getattr(self._local, "session", None)
+        self._local.session = session
+        try:
+            yield session
+        finally:
+            self._local.session = previous
+
+    @contextmanager
+    def client_session(self, role: Role):
+        """Gives the calling thread a session of its own until the block ends, see open_session"""
+        session = self.open_session(role)
+        try:
+            with self.using_session(session):
+                yield session
+        finally:
+            self.close_session(session)
+
+    def _all_carried_cats(self):
+        """The cats carried in every session, which is what a snapshot stores"""
+        carried = list(self._own_session.carried_cats)
+        for session in self._client_sessions:
+            carried.extend(session.carried_cats)
+        return carried
+
+    def _rebuild_indexes(self):
+        """Recomputes everything derived from the tree, after it was changed behind the indexes' back"""
+        self._changes += 1
+        if self._name_index is not None:
+            self._rebuild_name_index()
+        self._cat_names = None
+        self._child_names = {folder: SortedNames(folder._by_name) for folder in self._iter_folders(loaded_only=True)}
+        for property_name in self._property_indexes:
+            self.index_property(property_name)
+        if self.cache is not None:
+            self.cache.clear()
+        if self._dentries is not None:
+            self._dentries.clear()
+        if self._negative is not None:
+            self._negative.clear()
+        self._forget_wds(self.root)
+        for cat in self._all_carried_cats():
+            cat._wd = None
+
+    def _rebuild_name_index(self):
+        # cubbies not read yet are added as they are, see _index_loaded
+        cats = [child for folder in self._iter_folders(loaded_only=True) for child in folder.children if child.is_file]
+        # built in reverse so the first cat wins if names collide, in which case the multimap is needed
+        self._name_index = {cat.name: cat for cat in reversed(cats)}
+        if len(self._name_index) < len(cats):
+            self._name_index = {}
+            for cat in cats:
+                _multimap_add(self._name_index, cat.name, cat)
+
+    def _index_loaded(self, folder):
+        """Adds the cats of a cubby whose shard was just read to the name index, see ShardStore.load_children"""
+        self._child_names[folder] = SortedNames(folder._by_name)
+        if self._name_index is not None:
+            for child in folder.children:
+                if child.is_file:
+                    self._index_cat(child.name, child)
+
+    def enable_parallel_search(self, workers: int = None):
+        """Runs the searches that have to check every cat (find without the name index, query without a
+        property index) on a pool of worker processes, see parallel.py"""
+        if self._parallel is None:
+            self._parallel = ParallelSearch(workers)
 
-    def _save_to_pkl(self):
-        with open(self._pkl_path, "wb") as f:
-            pickle.dump(self, f)
+    def _parallel_search(self, spec, folder=None, first=False):
+        """Runs a search on the workers, over a snapshot image of the tree. Returns [(path, cat)] in the
+        order the tree is searched in, or None if the tree has changed since the snapshot was taken: a
+        new one is then written on a background thread, and the caller searches the tree itself meanwhile.
+        The tree lock is only held to look the snapshot up, so other sessions carry on while the workers search."""
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.changes != self._changes:
+                if self._snapshotting is None:
+                    self._snapshotting = threading.Thread(target=self._take_snapshot, name="catfs-snapshot", daemon=True)
+                    self._snapshotting.start()
+                return None
+            scope = 0 if folder is None or folder is self.root else snapshot.ids[folder]
+            snapshot.searches += 1
+        try:
+            found = self._parallel.search(snapshot.path, spec, scope, first)
+        finally:
+            with self._lock:
+                snapshot.searches -= 1
+                if snapshot is not self._snapshot and not snapshot.searches:
+                    os.remove(snapshot.path)
+        # by id rather than path, which may lead to another cat of the same name or, through a / in a name, nowhere
+        return [(path, snapshot.nodes[cat]) for path, cat in found]
+
+    def _take_snapshot(self):
+        """Writes an image of the tree to a temporary file for the workers, on the _snapshotting thread.
+        Only encoding it holds the tree lock. Nothing reads the file once this process is gone, so unlike
+        export_image it is neither synced to disk nor moved into place."""
+        try:
+            with self._lock:
+                self._load_all()
+                nodes = []
+                data = encode_image(self.root, self.name, nodes)
+                changes = self._changes
+            ids = dict(zip(nodes, range(len(nodes))))
+            fd, path = tempfile.mkstemp(prefix=f"{self.name}-", suffix=".img")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+            except BaseException:
+                os.remove(path)
+                raise
+            with self._lock:
+                self._drop_snapshot()
+                self._snapshot = SearchSnapshot(path, nodes, ids, changes)
+        except Exception as e:
+            # searches keep going through the tree, and the next one tries again
+            print(f"Search snapshot failed: {e}", file=sys.stderr)
+        finally:
+            with self._lock:
+                self._snapshotting = None
+
+    def _drop_snapshot(self):
+        """Stops using the snapshot, its file is removed now or when the last search on it is done"""
+        snapshot, self._snapshot = self._snapshot, None
+        if snapshot is not None and not snapshot.searches:
+            os.remove(snapshot.path)
+
+    def _load_name(self, name):
+        """Reads the cubbies holding cats called name, if the cafe was opened lazily"""
+        if self._shards is not None and self._shards.unloaded:
+            self._shards.load_name(name)
+
+    def _load_all(self):
+        """Reads every cubby not read yet, if the cafe was opened lazily, for what needs all the cats"""
+        if self._shards is not None and self._shards.unloaded:
+            # Millions of new objects would set off the cyclic garbage collector over and over, for nothing
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                for _ in self._iter_folders():
+                    pass
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+
+    def _index_cat(self, name, cat):
+        if self._cat_names is not None and name not in self._name_index:
+            self._cat_names.add(name)
+        _multimap_add(self._name_index, name, cat)
+
+    def _unindex_cat(self, name, cat):
+        _multimap_remove(self._name_index, name, cat)
+        if self._cat_names is not None and name not in self._name_index:
+            self._cat_names.remove(name)
+
+    def _sorted_cat_names(self):
+        """The distinct names of the cats in the tree as SortedNames, None without the name index"""
+        if self._cat_names is None and self._name_index is not None:
+            self._load_all()
+            self._cat_names = SortedNames(self._name_index)
+        return self._cat_names
+
+    def _sorted_child_names(self, folder):
+        """The distinct names of folder's children as SortedNames, kept up to date by _attach, _detach and _rename"""
+        names = self._child_names.get(folder)
+        if names is None:
+            # a new tree's root, or a cubby of a lazily opened cafe that was not read yet
+            names = SortedNames(folder._by_name)
+            self._child_names[folder] = names
+        return names
+
+    def index_property(self, property_name):
+        """Builds (or rebuilds) a secondary index on a cat property, which query uses from then on"""
+        if property_name not in CAT_PROPERTIES:
+            raise ValueError(f"Invalid property: {property_name}, valid properties are: {', '.join(CAT_PROPERTIES)}")
+        index = make_property_index(property_name)
+        self._load_all()
+        for folder in self._iter_folders():
+            for child in folder.children:
+                if child.is_file:
+                    index.add(child, getattr(child, property_name))
+        self._property_indexes[property_name] = index
+
+    def drop_property_index(self, property_name):
+        self._property_indexes.pop(property_name, None)
+
+    def _iter_folders(self, loaded_only=False):
+        """Yields every cubby in the tree, iteratively so deep trees don't hit the recursion limit.
+        With loaded_only, cubbies of a lazily opened cafe that were not read yet are left out"""
+        unloaded = self._shards.unloaded if loaded_only and self._shards is not None else ()
+        stack = [self.root]
+        while stack:
+            folder = stack.pop()
+            if folder in unloaded:
+                continue
+            yield folder
+            stack.extend(child for child in folder.children if not child.is_file)
+
+    def set_cache_size(self, cache_size: int, policy: str = "lru"):
+        """Replaces the find cache with an empty one of the given size and eviction policy, 0 disables it"""
+        if cache_size > 0:
+            self.cache = make_cache(policy, cache_size)
+        else:
+            self.cache = None
+
+    def set_dentry_cache_size(self, size: int):
+        """Replaces the path resolution cache with an empty one holding up to size paths, 0 disables it"""
+        self._dentries = DentryCache(size) if size > 0 else None
+
+    def set_negative_cache_size(self, size: int):
+        """Replaces the cache of names find knows are missing with an empty one of the given size, 0 disables it.
+        It is only consulted without the name index, which answers misses in O(1) by itself"""
+        self._negative = make_cache("lru", size) if size > 0 else None
+
+    def enable_journal(self):
+        """Journals each mutation instead of rewriting the whole snapshot"""
+        if self._journal is None:
+            self._journal = Journal(self._journal_path)
+
+    def enable_background_saves(self, delay: float = BACKGROUND_SAVE_DELAY):
+        """Hands snapshot saves to a background thread, which coalesces bursts of mutations into one save"""
+        if self._writer is None:
+            self._writer = BackgroundWriter(self._save, delay)
+
+    def _save(self):
+        """Writes a snapshot of the whole cafe, or of the cubbies changed since the last one if it is sharded.
+        See storage.py and shards.py for the formats"""
+        with self._save_lock:
+            with self._lock:
+                meta = {"name": self.name, "journal_seq": self._journal_seq}
+                carried_cats = self._all_carried_cats()
+                if self._shards is None:
+                    # encoded below without the lock, mutations meanwhile copy what they change first
+                    self._saving = saving = SaveSnapshot()
+                else:
+                    data = self._shards.encode(self.root, carried_cats)
+                self._dirty = False
+            if self._shards is None:
+                try:
+                    data = encode_cafe(self.root, carried_cats, meta, saving)
+                finally:
+                    self._saving = None
+                write_cafe(self._path, data)
+            else:
+                self._shards.write(data, meta)
+            # The snapshot now covers every journaled mutation
+            if self._journal is not None:
+                self._journal.truncate()
+            elif os.path.exists(self._journal_path):
+                os.remove(self._journal_path)
+
+    def _request_save(self):
+        """Saves a snapshot now, or marks the tree dirty and wakes the background writer if there is one"""
+        if self._writer is None or self._journal is not None:
+            # the journal is truncated after a snapshot, which must not race with appends
+            self._save()
+        else:
+            self._dirty = True
+            self._writer.wake()
+
+    def _persist(self, op, folder, *args):
+        """Makes a mutation durable, by journaling it if enabled and otherwise by saving a snapshot.
+        Inside a transaction this is deferred until commit"""
+        if self._txn is not None:
+            if self._journal is not None:
+                self._txn.records.append((op, self._get_wd_of_node(folder), args))
+            else:
+                self._txn.records.append(op)
+            return
+        if self._defer_saves:
+            self._dirty = True
+            return
+        if self._journal is None:
+            self._request_save()
+            return
+        self._journal_seq += 1
+        self._journal.append((self._journal_seq, op, self._get_wd_of_node(folder), args))
+        self._maybe_checkpoint()
+
+    def _maybe_checkpoint(self):
+        if self._journal.size() >= self.checkpoint_bytes:
+            self._save()
+
+    def _mutate(self, op, *args):
+        """Applies a mutation to the current cubby and persists it"""
+        with self._lock:
+            getattr(self, f"_do_{op}")(self.current_node, *args)
+            self._persist(op, self.current_node, *args)
+
+    def replay_journal(self):
+        """Re-applies journaled mutations newer than the loaded snapshot, returns how many were applied"""
+        if not os.path.exists(self._journal_path):
+            return 0
+        applied = 0
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            for seq, op, path, args in Journal(self._journal_path).records():
+                if seq <= self._journal_seq:
+                    continue
+                # a committed transaction is a single batch record, so it is replayed all or nothing
+                for op, path, args in (args if op == "batch" else [(op, path, args)]):
+                    getattr(self, f"_do_{op}")(self._traverse_to_node(path), *args)
+                self._journal_seq = seq
+                applied += 1
+        return applied
+
+    @contextmanager
+    def deferred_saves(self):
+        """Skips per-mutation persistence inside the block and saves once at the end if anything changed"""
+        self._defer_saves = True
+        try:
+            yield self
+        finally:
+            self._defer_saves = False
+            if self._dirty:
+                self._request_save()
+
+    @property
+    def in_transaction(self):
+        return self._txn is not None
+
+    @timed
+    def begin(self):
+        """Starts a transaction: mutations are only applied in memory until commit."""
+        if self._txn is not None:
+            print("Already in a transaction")
+            return False
+        if self.session is not self._own_session:
+            # abort would roll back the other clients' changes too
+            print("Transactions are not available to server clients")
+            return False
+        if self._writer is not None:
+            # start from a saved tree, so the writer never snapshots uncommitted changes
+            self._writer.flush()
+        self._txn = Transaction(self)
+        print("Started transaction")
+
+    @timed
+    def commit(self):
+        """Persists every mutation made since begin, with a single save."""
+        if self._txn is None:
+            print("Not in a transaction")
+            return False
+        txn, self._txn = self._txn, None
+        if txn.records:
+            if self._defer_saves:
+                self._dirty = True
+            elif self._journal is not None:
+                self._journal_seq += 1
+                self._journal.append((self._journal_seq, "batch", None, txn.records))
+                self._maybe_checkpoint()
+            else:
+                self._request_save()
+        print(f"Committed {len(txn.records)} changes")
+
+    @timed
+    def abort(self):
+        """Rolls the tree, carried cats and current cubby back to where they were at begin."""
+        if self._txn is None:
+            print("Not in a transaction")
+            return False
+        with self._lock:
+            txn, self._txn = self._txn, None
+            saving = self._saving
+            if saving is not None:
+                for folder in txn.folders:
+                    saving.preserve(folder)
+                for node in txn.nodes:
+                    saving.preserve(None, node)
+            for node, (name, parent, content) in txn.nodes.items():
+                node.name = name
+                node.parent = parent
+                if content is not None:
+                    node.content = content
+            for folder, children in txn.folders.items():
+                folder._children = children
+                folder._reindex()
+            self.carried_cats = txn.carried_cats
+            self._touch_carried()
+            self.current_node = txn.current_node
+            # every node that moved or was renamed was touched, the rest kept their paths
+            for node in txn.nodes:
+                self._forget_wds(node)
+            self._rebuild_indexes()
+        print(f"Aborted {len(txn.records)} changes")
+
+    @contextmanager
+    def transaction(self):
+        """Runs the body as one transaction, committed on success and aborted if it raises"""
+        if self._txn is not None:
+            raise RuntimeError("DirectoryTree transactions cannot be nested")
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.abort()
+            raise
+        self.commit()
+
+    def _touch(self, folder, node=None):
+        """Called before a mutation changes folder (and node): marks the folder's shard for the next save,
+        keeps their state for a save encoding the tree, and inside a transaction remembers it for abort"""
+        self._changes += 1
+        if self._shards is not None:
+            self._shards.dirty.add(folder)
+        saving = self._saving
+        if saving is not None:
+            saving.preserve(folder, node)
+        txn = self._txn
+        if txn is None:
+            return
+        if folder not in txn.folders:
+            txn.folders[folder] = dict(folder._children)
+        if node is not None and node not in txn.nodes:
+            txn.nodes[node] = (node.name, node.parent, node.content.copy() if node.is_file else None)
+
+    def _touch_carried(self):
+        """Marks the carried cats' shard for the next save, after they changed"""
+        if self._shards is not None:
+            self._shards.carried_dirty = True
+
+    # Every structural change goes through these three so the tree-wide indexes stay current
+    def _attach(self, folder, node):
+        self._touch(folder, node)
+        self._invalidate_lookups(folder, node.name, node)
+        self._forget_wds(node)
+        node.parent = folder
+        child_names = self._child_names.get(folder)
+        if child_names is not None and node.name not in folder._by_name:
+            child_names.add(node.name)
+        folder.add_child(node)
+        if not node.is_file and node not in self._child_names:
+            self._child_names[node] = SortedNames(node._by_name)
+        if node.is_file:
+            if self._name_index is not None:
+                self._index_cat(node.name, node)
+            for property_name, index in self._property_indexes.items():
+                index.add(node, getattr(node, property_name))
+            # find may have remembered this name as missing
+            if self._negative is not None:
+                self._negative.invalidate(node.name)
+        elif self._negative is not None and node.children:
+            # a cubby that already holds cats brings all of their names at once
+            self._negative.clear()
+
+    def _detach(self, folder, node):
+        self._touch(folder)
+        self._invalidate_lookups(folder, node.name, node)
+        self._forget_wds(node)
+        folder.remove_child(node)
+        child_names = self._child_names.get(folder)
+        if child_names is not None and node.name not in folder._by_name:
+            child_names.remove(node.name)
+        if node.is_file:
+            if self._name_index is not None:
+                self._unindex_cat(node.name, node)
+            for property_name, index in self._property_indexes.items():
+                index.remove(node, getattr(node, property_name))
+            # the cache may hold this cat under its name, which no longer leads anywhere
+            if self.cache is not None:
+                self.cache.invalidate(node.name)
+
+    def _rename(self, folder, node, new_name):
+        self._touch(folder, node)
+        self._invalidate_lookups(folder, node.name)
+        self._invalidate_lookups(folder, new_name)
+        self._forget_wds(node)
+        old_name = node.name
+        if node.is_file:
+            if self._name_index is not None:
+                self._unindex_cat(old_name, node)
+                self._index_cat(new_name, node)
+            if self.cache is not None:
+                self.cache.invalidate(node.name)
+            if self._negative is not None:
+                self._negative.invalidate(new_name)
+        child_names = self._child_names.get(folder)
+        if child_names is not None and new_name not in folder._by_name:
+            child_names.add(new_name)
+        folder.rename_child(node, new_name)
+        if child_names is not None and old_name not in folder._by_name:
+            child_names.remove(old_name)
+
+    def _invalidate_lookups(self, folder, name, node=None):
+        """Forgets resolved paths that looked up name in folder, or went to node's parent with .."""
+        if self._dentries is not None:
+            self._dentries.invalidate(folder, name)
+            if node is not None:
+                self._dentries.invalidate(node, "..")
+
+    # Mutations shared by the commands below and by journal replay, none of them print
+    def _do_rescue(self, folder, cat_name, required_role):
+        self._attach(folder, FileNode(cat_name, required_role, parent=folder))
+
+    def _do_meow(self, folder, cat_name, property_name, value):
+        cat = self._find_node_in(folder, cat_name)
+        self._touch(folder, cat)
+        index = self._property_indexes.get(property_name)
+        if index is not None:
+            index.remove(cat, cat.get_property(property_name))
+        cat.set_property(property_name, value)
+        if index is not None:
+            index.add(cat, value)
+
+    def _do_copycat(self, folder, cat_name, new_cat_name):
+        source = self._find_node_in(folder, cat_name)
+        new_cat = FileNode(new_cat_name, required_role=source.required_role, parent=folder)
+        new_cat.content = source.content.copy()
+        self._attach(folder, new_cat)
+
+    def _do_recollar(self, folder, cat_name, new_name):
+        self._rename(folder, self._find_node_in(folder, cat_name), new_name)
+
+    def _do_adopted(self, folder, cat_name):
+        self._detach(folder, self._find_node_in(folder, cat_name))
+
+    def _do_carry(self, folder, cat_name):
+        cat = self._find_node_in(folder, cat_name)
+        self.carried_cats.append(cat)
+        self._detach(folder, cat)
+        self._touch_carried()
+
+    def _do_put(self, folder, cat_name=None):
+        for cat in self.carried_cats[:]:
+            if cat_name is None or cat.name == cat_name:
+                self._attach(folder, cat)
+                self.carried_cats.remove(cat)
+                self._touch_carried()
+                if cat_name is not None:
+                    return
+
+    def _do_mkcby(self, folder, cubby_name):
+        self._attach(folder, FolderNode(cubby_name, parent=folder))
 
     def _traverse_to_node(self, path: str):
         if path[0] == "/":
-            current = self.root
+            start = self.root
         else:
-            current = self.current_node
+            start = self.current_node
+        if self._dentries is not None:
+            with self._cache_lock:
+                cached = self._dentries.get(start, path)
+            if cached is not None:
+                return cached
+        current = start
+        lookups = []  # what the resolution depends on, see DentryCache
         parts = path.strip("/").split("/")
-        # current = self.current_node if path.startswith(".") else self.root
         for part in parts:
-            if not part:
+            if not part or part == ".":
                 continue
             if current.is_file:
                 return None
             child = current.get_child(part)
             if child is None:
                 return None
+            lookups.append((current, part))
             current = child
+        if self._dentries is not None:
+            with self._cache_lock:
+                self._dentries.put(start, path, current, lookups)
         return current
     
+    def _find_node_in(self, folder, name):
+        return folder.find_child(name)
+
     def _find_node_in_current(self, name):
-        for child in self.current_node.children:
-            if child.name == name:
-                return child
-        return None
+        return self._find_node_in(self.current_node, name)
     
     def _find_file_in_tree(self, name):
-        """takes a file name and returns the file node if it exists in the tree, otherwise None"""
-        # FIXME: eventually use cache here if enabled
+        """takes a file name and returns the file node if it exists in the tree, otherwise None.
+        With the name index enabled and several cats sharing the name, the earliest indexed one is returned"""
         def _recursively_find_file(node, name):
             # Recursively search in children
             folders = []
@@ -145,116 +1099,500 @@ class DirectoryTree:
         self.cache_accesses += 1
 
         # Check cache first
-        if self.cache:
-            cached_result = self.cache.get(name)
+        if self.cache is not None:
+            with self._cache_lock:
+                cached_result = self.cache.get(name)
             if cached_result:
                 self.cache_hits += 1
                 return cached_result
         
-        # If not in cache, search the tree
-        result = _recursively_find_file(self.root, name)
+        # If not in cache, use the name index or fall back to searching the tree
+        if self._name_index is not None:
+            result = _multimap_first(self._name_index, name)
+            if result is None and self._shards is not None and self._shards.unloaded:
+                self._load_name(name)
+                result = _multimap_first(self._name_index, name)
+        elif self._negative is not None and self._known_missing(name):
+            # searched before and not found, and no cat has been given this name since
+            return None
+        else:
+            found = self._parallel_search(("name", name), first=True) if self._parallel is not None else None
+            if found is not None:
+                result = found[0][1] if found else None
+            else:
+                result = _recursively_find_file(self.root, name)
+            if result is None and self._negative is not None:
+                self._remember_missing(name)
 
         # If found, cache the result
-        if self.cache and result:
-            self.cache.put(name, result)
+        if self.cache is not None and result:
+            with self._cache_lock:
+                self.cache.put(name, result)
 
         return result
     
+    def _known_missing(self, name):
+        with self._cache_lock:
+            return self._negative.get(name)
+
+    def _remember_missing(self, name):
+        with self._cache_lock:
+            self._negative.put(name, True)
+
     def _get_wd_of_node(self, node):
-        """does pwd on that node"""
-        path = []
+        """does pwd on that node. The path is memoized on the node and every cubby above it,
+        so asking again, or for a sibling or a descendant, costs O(1) climbing"""
+        return self._memoize_wd(node)[0]
+
+    def _get_depth_of_node(self, node):
+        """how many cubbies down from the root the node is, the root being 0"""
+        return self._memoize_wd(node)[1]
+
+    def _memoize_wd(self, node):
+        if node._wd is not None:
+            return node._wd
+        # climb to the root or to the nearest ancestor that already knows its path
+        chain = []
+        attached = True
         current = node
-        while current is not None and current != self.root:
-            path.append(current.name)
-            current = getattr(current, 'parent', None)
-        return f"/{"/".join(reversed(path))}"
+        while current is not None and current is not self.root and current._wd is None:
+            chain.append(current)
+            if current.parent is not None and current not in current.parent._children:
+                # detached (a carried cat keeps pointing at its old cubby), nothing would invalidate a memo
+                attached = False
+            current = current.parent
+        if current is None:
+            attached = False
+            path, depth = "", 0
+        else:
+            path, depth = ("", 0) if current is self.root else current._wd
+        for current in reversed(chain):
+            path = f"{path}/{current.name}"
+            depth += 1
+            if attached:
+                current._wd = (path, depth)
+        return (path or "/"), depth
+
+    def _forget_wds(self, node):
+        """Drops the memoized paths of node and everything under it. A node only has a memo
+        if its parent has one (the root never does), so memo-less cubbies are not descended into"""
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            current._wd = None
+            if not current.is_file:
+                stack.extend(child for child in current.children if child._wd is not None)
             
     
-    def find(self, name):
-        """Finds a cat in the whole tree."""
-        node = self._find_file_in_tree(name)
-        if node:
-            print(f"Found {name} in {self._get_wd_of_node(node)}")
+    def iter_find(self, pattern, regex=False):
+        """
+        Yields (path, cat) for every cat in the tree whose name matches, one at a time, so a huge
+        result set is never held in memory. With the name index only the distinct names are matched,
+        in sorted order and only those starting with the glob's literal prefix, otherwise the tree is
+        walked once, depth first in prowl order.
+        The tree must not be changed until the iteration is done.
+            Args:
+            pattern (str): A cat's name or a glob pattern, or a regular expression if regex
+            regex (bool): Whether pattern is a regular expression
+        """
+        matches = _name_matcher(pattern, regex)
+        if self._name_index is not None:
+            if matches is None:
+                self._load_name(pattern)
+                names = (pattern,) if pattern in self._name_index else ()
+            else:
+                cat_names = self._sorted_cat_names()
+                prefix = "" if regex else _literal_prefix(pattern)
+                names = filter(matches, cat_names.with_prefix(prefix) if prefix else cat_names)
+            for name in names:
+                cats = self._name_index[name]
+                for cat in (cats if type(cats) is list else (cats,)):
+                    yield self._get_wd_of_node(cat), cat
+            return
+        if matches is None and self._negative is not None and self._known_missing(pattern):
+            return
+        cats = None
+        if self._parallel is not None:
+            cats = self._parallel_search(("name", pattern) if matches is None else ("pattern", pattern, regex))
+        if cats is None:
+            cats = ((f"{path}/{cat.name}", cat) for path, cat in self._iter_cats_under(self.root)
+                    if ((cat.name == pattern) if matches is None else matches(cat.name)))
+        found = False
+        for path, cat in cats:
+            found = True
+            yield path, cat
+        if not found and matches is None and self._negative is not None:
+            self._remember_missing(pattern)
+
+    def bulk_load(self, path, fmt=None):
+        """
+        Imports every cat and cubby in a CSV or JSON Lines file (see bulk.read_cats), creating the
+        cubbies on their paths as needed, then saves once. It reads what export writes. Rows are streamed, so the file can be any size. Nodes
+        are linked straight into their cubbies and the indexes are rebuilt once at the end, like load.
+        All or nothing: if a row is invalid or names a cat its cubby already has, everything imported
+        so far is taken out again and BulkFormatError is raised.
+            Args:
+            path (str): The file to import
+            fmt (str): "csv" or "jsonl", from the file extension if omitted
+        Returns:
+            tuple: (cats imported, cubbies created)
+        """
+        if self._txn is not None:
+            raise RuntimeError("bulk_load cannot run inside a transaction")
+        created = set()  # cubbies made by this import
+        # children each cubby that was already there had before the import, new ones are added after them,
+        # so rolling back only needs these counts rather than every node linked
+        counts = {}
+        folders = {}  # path as written -> cubby, nothing is removed during an import so these stay valid
+
+        def link(folder, node):
+            if folder not in created and folder not in counts:
+                if saving is not None:
+                    saving.preserve(folder)
+                counts[folder] = len(folder._children)
+            folder.add_child(node)
+
+        def resolve(lineno, cubby_path):
+            folder = self.root if cubby_path.startswith("/") else self.current_node
+            for part in cubby_path.split("/"):
+                if not part or part == ".":
+                    continue
+                if part == "..":
+                    if folder.parent is None:
+                        raise BulkFormatError(f"{path}:{lineno}: {cubby_path} goes above the root")
+                    folder = folder.parent
+                    continue
+                child = folder.find_child(part)
+                if child is None:
+                    child = FolderNode(part, parent=folder)
+                    link(folder, child)
+                    created.add(child)
+                elif child.is_file:
+                    raise BulkFormatError(f"{path}:{lineno}: {part} in {cubby_path} is a cat, not a cubby")
+                folder = child
+            return folder
+
+        cats = 0
+        # Millions of new objects would set off the cyclic garbage collector over and over, for nothing
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        with self._lock:
+            # a save encoding the tree outside the lock started before the import, nothing else can meanwhile
+            saving = self._saving
+            try:
+                last_path = folder = by_name = None
+                for lineno, cubby_path, name, kind, role, properties in read_cats(path, fmt):
+                    if kind == "cubby":
+                        resolve(lineno, f"{cubby_path}/{name}" if cubby_path else name)
+                        continue
+                    if cubby_path != last_path:
+                        # rows usually come grouped by cubby, so most of them skip even the dict lookup
+                        folder = folders.get(cubby_path)
+                        if folder is None:
+                            folder = folders[cubby_path] = resolve(lineno, cubby_path)
+                        last_path = cubby_path
+                        by_name = folder._by_name
+                        if folder not in created and folder not in counts:
+                            if saving is not None:
+                                saving.preserve(folder)
+                            counts[folder] = len(folder._children)
+                    if name in by_name and folder.find_child(name).is_file:
+                        raise BulkFormatError(f"{path}:{lineno}: cat {name} already exists in {cubby_path or '.'}")
+                    cat = FileNode(name, role, parent=folder)
+                    for property_name, value in properties:
+                        setattr(cat, property_name, value)
+                    folder.add_child(cat)
+                    cats += 1
+            except BaseException:
+                # cubbies this import made go with the cubby they were linked into
+                for folder, count in counts.items():
+                    children = folder._children
+                    while len(children) > count:
+                        folder.remove_child(next(reversed(children)))
+                raise
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+                if counts:
+                    self._rebuild_indexes()
+                    if self._shards is not None:
+                        # new cubbies get their shards along with their parents'
+                        self._shards.dirty.update(counts)
+        if cats or created:
+            if self._defer_saves:
+                self._dirty = True
+            else:
+                self._request_save()
+        return cats, len(created)
+
+    def iter_records(self, scope="/"):
+        """
+        Returns an iterator of one dict per cubby and cat under scope, depth first in prowl order with
+        each cubby before its contents: path (of the cubby it is in), name, type ("cubby" or "cat"),
+        and for cats role and the properties that are set. This is the format bulk_load reads.
+        The walk keeps one iterator per level, so memory does not grow with the size of the cafe.
+        The tree must not be changed until the iteration is done.
+            Args:
+            scope (str): Path of the cubby whose contents are listed
+        Raises ValueError if scope does not lead to a cubby
+        """
+        folder = self._traverse_to_node(scope)
+        if folder is None or folder.is_file:
+            raise ValueError(f"Cubby {scope} not found")
+        return self._records_under(folder)
+
+    def _records_under(self, folder):
+        roles = {role: role.name.lower() for role in Role}
+        stack = [("" if folder is self.root else self._get_wd_of_node(folder), iter(folder.children))]
+        while stack:
+            path, children = stack[-1]
+            node = next(children, None)
+            if node is None:
+                stack.pop()
+                continue
+            if node.is_file:
+                record = {"path": path or "/", "name": node.name, "type": "cat", "role": roles[node.required_role]}
+                for property_name in CAT_PROPERTIES:
+                    value = getattr(node, property_name)
+                    if value is not None:
+                        record[property_name] = value
+                yield record
+            else:
+                yield {"path": path or "/", "name": node.name, "type": "cubby"}
+                stack.append((f"{path}/{node.name}", iter(node.children)))
+
+    def _iter_cats_under(self, folder):
+        """Yields (path of its cubby, cat) for every cat under folder, depth first in prowl order,
+        the root's path being "". Paths are built on the way down rather than climbed back up"""
+        stack = [(folder, "" if folder is self.root else self._get_wd_of_node(folder))]
+        while stack:
+            folder, path = stack.pop()
+            folders = []
+            for child in folder.children:
+                if child.is_file:
+                    yield path, child
+                else:
+                    folders.append((child, f"{path}/{child.name}"))
+            stack.extend(reversed(folders))
+
+    def iter_query(self, predicates, scope="/"):
+        """
+        Returns an iterator of (path, cat) for every cat under scope whose properties satisfy all the
+        predicates. When an indexed property narrows the query down, only the cats the index picks
+        are checked and results are sorted by path, otherwise every cat under scope is checked, depth
+        first in prowl order. The tree must not be changed until the iteration is done.
+            Args:
+            predicates (list): Predicate objects, or strings such as "age>=3" or "mood=hungry"
+            scope (str): Path of the cubby to search under
+        Raises ValueError for an invalid predicate, or a scope that does not lead to a cubby
+        """
+        predicates = [p if isinstance(p, Predicate) else parse_predicate(p) for p in predicates]
+        folder = self._traverse_to_node(scope)
+        if folder is None or folder.is_file:
+            raise ValueError(f"Cubby {scope} not found")
+        index, on_property = plan(predicates, self._property_indexes)
+        if index is None:
+            self.queries_scanned += 1
+            return self._scan_query(predicates, folder)
+        self.queries_indexed += 1
+        prefix = "/" if folder is self.root else self._get_wd_of_node(folder) + "/"
+        matches = []
+        for cat in index.lookup(on_property):
+            if all(predicate.matches(cat) for predicate in predicates):
+                path = self._get_wd_of_node(cat)
+                if path.startswith(prefix):
+                    matches.append((path, cat))
+        matches.sort(key=itemgetter(0))
+        return iter(matches)
+
+    def _scan_query(self, predicates, folder):
+        found = self._parallel_search(("query", predicates), folder) if self._parallel is not None else None
+        if found is not None:
+            return iter(found)
+        return ((f"{path}/{cat.name}", cat) for path, cat in self._iter_cats_under(folder)
+                if all(predicate.matches(cat) for predicate in predicates))
+
+    def complete(self, text):
+        """
+        Returns the names in the current cubby that start with text, sorted, for tab completion.
+        If text is a path, the last part is completed in the cubby the rest of it leads to.
+        """
+        directory, slash, prefix = text.rpartition("/")
+        if slash:
+            folder = self._traverse_to_node(directory or "/")
+            if folder is None or folder.is_file:
+                return []
+            return [f"{directory}/{name}" for name in self._sorted_child_names(folder).with_prefix(prefix)]
+        return self._sorted_child_names(self.current_node).with_prefix(prefix)
+
+    @timed
+    def import_cats(self, path):
+        """Imports cats from a CSV or JSON Lines file, see bulk_load."""
+        if self._txn is not None:
+            print("Cannot import inside a transaction, commit or abort first")
+            return False
+        try:
+            cats, cubbies = self.bulk_load(path)
+        except (OSError, ValueError) as e:
+            print(f"Import failed, nothing was imported: {e}")
+            return False
+        print(f"Imported {cats} cat{'s' if cats != 1 else ''} and created {cubbies} cubb{'ies' if cubbies != 1 else 'y'}")
+
+    @timed
+    def export(self, path, scope="/"):
+        """Writes every cubby and cat under scope to a CSV or JSON Lines file (- for the screen), see iter_records."""
+        try:
+            with self._lock:
+                count = write_records(self.iter_records(scope), path)
+        except (OSError, ValueError) as e:
+            print(f"Export failed: {e}")
+            return False
+        if path != "-":
+            print(f"Exported {count} record{'s' if count != 1 else ''} to {path}")
+
+    @timed
+    def export_image(self, path=None):
+        """Writes a read-only image of the tree (see image.py) that viewers open with ImageTree, to cafes/<name>.img by default."""
+        path = path or self.image_path(self.name)
+        try:
+            with self._lock:
+                self._load_all()
+                size = write_image(self.root, self.name, path)
+        except OSError as e:
+            print(f"Writing the image failed: {e}")
+            return False
+        print(f"Wrote image to {path} ({size} bytes)")
+
+    @timed
+    def query(self, *predicates, scope="/"):
+        """Lists the cats under scope whose properties match every predicate, e.g. query("mood=hungry", "date_fed<2026-10-13")."""
+        try:
+            matches = self.iter_query(predicates, scope)
+        except ValueError as e:
+            print(e)
+            return False
+        count = 0
+        for path, _ in matches:
+            print(path)
+            count += 1
+        if count:
+            print(f"{count} cat{'s' if count != 1 else ''} found")
+        else:
+            print("No cats match")
+
+    @timed
+    def find(self, name, all_matches=False, regex=False):
+        """Finds a cat in the whole tree, or every cat whose name matches with all_matches.
+        name can be a glob pattern, or a regular expression with regex."""
+        if not all_matches and not regex and GLOB_CHARS.isdisjoint(name):
+            node = self._find_file_in_tree(name)
+            if node:
+                print(f"Found {name} in {self._get_wd_of_node(node)}")
+            else:
+                print(f"{name} not found in the tree")
+            return
+        try:
+            _name_matcher(name, regex)
+        except re.error as e:
+            print(f"Invalid pattern {name}: {e}")
+            return False
+        if not all_matches:
+            path, node = next(self.iter_find(name, regex), (None, None))
+            if node:
+                print(f"Found {node.name} in {path}")
+            else:
+                print(f"{name} not found in the tree")
+            return
+        count = 0
+        for path, _ in self.iter_find(name, regex):
+            print(path)
+            count += 1
+        if count:
+            print(f"{count} cat{'s' if count != 1 else ''} found")
         else:
             print(f"{name} not found in the tree")
+    @timed
     def rescue(self, cat_name, required_role: Role = Role.STAFF):
         """Creates a new cat with a required role"""
         if self._find_node_in_current(cat_name) and self._find_node_in_current(cat_name).is_file: # type: ignore
             print(f"Cat {cat_name} already exists!")
-            return
-        new_cat = FileNode(cat_name, required_role, parent=self.current_node)
-        self.current_node.add_child(new_cat)
-        self._save_to_pkl()
+            return False
+        self._mutate("rescue", cat_name, required_role)
         print(f"Rescued new cat: {cat_name} (role required: {required_role.name})")
+    @timed
     def pawprint(self):
         """Prints current working directory (pwd)"""
         print(f"Current cubby: {self._get_wd_of_node(self.current_node)}")
+    @timed
     def cat(self, cat_name):
         """Prints details about a cat."""
         node = self._find_node_in_current(cat_name)
         if not node:
             print(f"Cat {cat_name} not found!")
-            return
+            return False
         if not node.is_file:
             print(f"{cat_name} is not a cat!")
-            return
+            return False
         if not node.can_pet(self.role):
             print("Permission denied: you need petting permission")
-            return
+            return False
         print(f"Cat: {node.name}")
         for prop, value in node.content.items():
             if value is not None:
                 print(f"{prop}: {value}")
+    @timed
     def meow(self, cat_name, property_name, value):
         """Write details about a cat."""
         node = self._find_node_in_current(cat_name)
         if not node:
             print(f"Cat {cat_name} not found!")
-            return
+            return False
         if not node.is_file:
             print(f"{cat_name} is not a cat!")
-            return
+            return False
         if not node.can_feed(self.role):
             print("Permission denied: you need feeding permission")
-            return
-        if not node.set_property(property_name, value):
-            print(f"Invalid property: {property_name}, valid properties are: age, mood, date_found, date_fed")
-            return
-        self._save_to_pkl()
+            return False
+        if property_name not in CAT_PROPERTIES:
+            print(f"Invalid property: {property_name}, valid properties are: {', '.join(CAT_PROPERTIES)}")
+            return False
+        self._mutate("meow", cat_name, property_name, value)
         print(f"Updated {property_name} for {cat_name}")
+    @timed
     def boop(self, cat_name):
         """Executes the cat (if user has groom permission)."""
         node = self._find_node_in_current(cat_name)
         if not node:
             print(f"Cat {cat_name} not found!")
-            return
+            return False
         if not node.is_file:
             print(f"{cat_name} is not a cat!")
-            return
+            return False
         if not node.can_groom(self.role):
             print("Permission denied: you need grooming permission")
-            return
+            return False
         print(f"*{cat_name} purrs contentedly*")
+    @timed
     def copycat(self, cat_name, new_cat_name):
         """Copies a cat."""
         source = self._find_node_in_current(cat_name)
         if source and source.is_file:
-            new_cat = FileNode(new_cat_name, required_role=source.required_role, parent=self.current_node)
-            new_cat.content = source.content.copy()
-            self.current_node.add_child(new_cat)
-            self._save_to_pkl()
+            self._mutate("copycat", cat_name, new_cat_name)
             print(f"Copied {cat_name} to {new_cat_name}")
         else:
             print(f"Cat {cat_name} not found!")
+            return False
+    @timed
     def recollar(self, cat_name, new_name):
         """Renames a cat."""
         cat = self._find_node_in_current(cat_name)
         if cat and cat.is_file:
-            cat.name = new_name
-            self._save_to_pkl()
+            self._mutate("recollar", cat_name, new_name)
             print(f"Renamed {cat_name} to {new_name}")
         else:
             print(f"Cat {cat_name} not found!")
+            return False
+    @timed
     def walk(self, new_location):
         """Changes directory."""
         target = self._traverse_to_node(new_location)
@@ -263,29 +1601,33 @@ class DirectoryTree:
             print(f"Walked to {new_location}")
         else:
             print(f"Location {new_location} not found!")
+            return False
+    @timed
     def adopted(self, cat_name):
         """Removes a cat."""
         cat = self._find_node_in_current(cat_name)
         if cat and cat.is_file:
-            self.current_node.remove_child(cat)
-            self._save_to_pkl()
+            self._mutate("adopted", cat_name)
             print(f"{cat_name} has been adopted!")
         else:
             print(f"Cat {cat_name} not found!")
+            return False
+    @timed
     def carry(self, cat_name):
         """Attempts to carry a cat."""
         import random
         cat = self._find_node_in_current(cat_name)
         if cat and cat.is_file:
             if random.random() < 0.5:  # 50% chance of success
-                self.carried_cats.append(cat)
-                self.current_node.remove_child(cat)
-                self._save_to_pkl()
+                self._mutate("carry", cat_name)
                 print(f"Successfully carrying {cat_name}")
             else:
                 print(f"Failed to carry {cat_name} - they're too squirmy!")
+                return False
         else:
             print(f"Cat {cat_name} not found!")
+            return False
+    @timed
     def carrying(self):
         """Lists all cats being carried."""
         if self.carried_cats:
@@ -294,32 +1636,28 @@ class DirectoryTree:
                 print(f"- {cat.name}")
         else:
             print("Not carrying any cats")
+    @timed
     def put(self, cat_name=None):
         """Drops a cat into current directory."""
         if cat_name is None:
-            for cat in self.carried_cats[:]:
-                self.current_node.add_child(cat)
-                self.carried_cats.remove(cat)
-            self._save_to_pkl()
+            self._mutate("put")
             print("Dropped all cats")
+        elif any(cat.name == cat_name for cat in self.carried_cats):
+            self._mutate("put", cat_name)
+            print(f"Dropped {cat_name}")
         else:
-            for cat in self.carried_cats:
-                if cat.name == cat_name:
-                    self.current_node.add_child(cat)
-                    self.carried_cats.remove(cat)
-                    self._save_to_pkl()
-                    print(f"Dropped {cat_name}")
-                    return
             print(f"Not carrying {cat_name}")
+            return False
+    @timed
     def mkcby(self, cubby_name):
         """Creates a new directory (cubby)."""
         if self._find_node_in_current(cubby_name) and not self._find_node_in_current(cubby_name).is_file: # type: ignore
             print(f"Cubby {cubby_name} already exists!")
+            return False
         else:
-            new_cubby = FolderNode(cubby_name, parent=self.current_node)
-            self.current_node.add_child(new_cubby)
-            self._save_to_pkl()
+            self._mutate("mkcby", cubby_name)
             print(f"Created new cubby: {cubby_name}")
+    @timed
     def prowl(self):
         """Lists all cats and sub-cubbies in current directory."""
         if not self.current_node.children or len(self.current_node.children) == 0:
@@ -328,3 +1666,331 @@ class DirectoryTree:
         print("Current cubby contents:")
         for child in self.current_node.children:
             print(f" - {child.name} ({'cubby' if not child.is_file else 'cat'})")
+    @timed
+    def sync(self):
+        """Waits until every change made so far is on disk."""
+        try:
+            if self._writer is not None:
+                self._writer.flush()
+            elif self._dirty and self._txn is None:
+                self._save()
+            if self._journal is not None:
+                self._journal.sync()
+        except Exception as e:
+            print(f"Sync failed: {e}")
+            return False
+        print("Synced")
+    def close(self):
+        """Flushes pending saves and stops the background writer, call when done with the tree."""
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+        if self._journal is not None:
+            self._journal.close()
+        parallel, self._parallel = self._parallel, None
+        if parallel is not None:
+            parallel.close()
+            snapshotting = self._snapshotting
+            if snapshotting is not None:
+                snapshotting.join()
+            self._drop_snapshot()
+    def get_stats(self):
+        """Returns cache counters and per-command latency percentiles as a JSON-serializable dict"""
+        return {
+            "cafe": self.name,
+            "find": {"accesses": self.cache_accesses, "cache_hits": self.cache_hits},
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "dentries": self._dentries.stats() if self._dentries is not None else None,
+            "negative": self._negative.stats() if self._negative is not None and self._name_index is None else None,
+            "query": {"indexed": self.queries_indexed, "scanned": self.queries_scanned,
+                      "indexes": {name: index.stats() for name, index in self._property_indexes.items()}},
+            "shards": {"read": self._shards.shards_read, "unread": len(self._shards.unloaded)} if self._shards is not None else None,
+            "commands": {name: histogram.summary() for name, histogram in sorted(self.latencies.items())},
+        }
+    @timed
+    def stats(self, fmt=None, path=None):
+        """Prints cache and command latency statistics, or dumps them as JSON (to path if given)."""
+        stats = self.get_stats()
+        if fmt == "json":
+            _dump_stats(stats, path)
+            return
+        print(f"find: {stats['find']['accesses']} lookups, {stats['find']['cache_hits']} cache hits")
+        cache = stats["cache"]
+        if cache is None:
+            print("cache: disabled")
+        else:
+            print(f"cache ({cache['policy']}): {cache['size']}/{cache['capacity']} entries, "
+                  f"hits={cache['hits']} misses={cache['misses']} hit rate={cache['hit_rate']:.3f}, "
+                  f"insertions={cache['insertions']} evictions={cache['evictions']} invalidations={cache['invalidations']}")
+        negative = stats["negative"]
+        if negative is not None:
+            print(f"known missing: {negative['size']}/{negative['capacity']} names, hits={negative['hits']} "
+                  f"misses={negative['misses']} invalidations={negative['invalidations']}")
+        query = stats["query"]
+        if query["indexed"] or query["scanned"] or query["indexes"]:
+            indexes = ", ".join(f"{name} ({index['kind']}, {index['keys']} values, {index['cats']} cats)"
+                                for name, index in query["indexes"].items())
+            print(f"query: {query['indexed']} from an index, {query['scanned']} scans, indexes: {indexes or 'none'}")
+        dentries = stats["dentries"]
+        if dentries is not None:
+            print(f"paths: {dentries['size']}/{dentries['capacity']} entries, hits={dentries['hits']} "
+                  f"misses={dentries['misses']} hit rate={dentries['hit_rate']:.3f}, invalidations={dentries['invalidations']}")
+        shards = stats["shards"]
+        if shards is not None:
+            print(f"shards: {shards['read']} cubbies read, {shards['unread']} not read yet")
+        _print_latencies(stats["commands"])
+
+def _dump_stats(stats, path=None):
+    if path is None:
+        print(json.dumps(stats, indent=2))
+    else:
+        with open(path, "w") as f:
+            json.dump(stats, f, indent=2)
+        print(f"Wrote stats to {path}")
+
+def _print_latencies(commands):
+    if not commands:
+        return
+    print(f"{'command':>10} | {'count':>7} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8} | {'max ms':>8}")
+    for name, summary in commands.items():
+        print(f"{name:>10} | {summary['count']:>7} | {summary['p50_ms']:8.3f} | {summary['p95_ms']:8.3f} | "
+              f"{summary['p99_ms']:8.3f} | {summary['max_ms']:8.3f}")
+
+class ImageTree:
+    """
+    A read-only DirectoryTree over a cafe image written by DirectoryTree.export_image, for viewer
+    processes. Every command reads the mapped image directly (see image.py), so opening is instant
+    whatever the size of the cafe and the processes viewing one image share a single copy of it.
+    Nodes are the image's ids. Commands that would change the cafe fail.
+    """
+    in_transaction = False
+
+    def __init__(self, name: str, role: Role = Role.VISITOR, path: str = None):
+        """Raises OSError if there is no image, CafeFormatError if path is not one"""
+        self.image = CafeImage(path or DirectoryTree.image_path(name))
+        self.name = name
+        self.role = role
+        self.current_node = CafeImage.ROOT
+        self.carried_cats = []
+        self.latencies = {}
+        self._parallel = None
+
+    def _read_only(self, *args, **kwargs):
+        print(f"{self.name} is a read-only image, open the cafe itself to change it")
+        return False
+
+    rescue = meow = copycat = recollar = adopted = carry = put = mkcby = import_cats = _read_only
+    begin = commit = abort = export_image = _read_only
+    carrying = DirectoryTree.carrying
+    query = DirectoryTree.query
+
+    @contextmanager
+    def deferred_saves(self):
+        yield self
+
+    def enable_parallel_search(self, workers: int = None):
+        """Runs queries on a pool of worker processes that map the image too, see parallel.py"""
+        if self._parallel is None:
+            self._parallel = ParallelSearch(workers)
+
+    def _allows(self, cat, action):
+        # the same rule as FileNode.can_pet and friends
+        return self.role.value >= self.image.role(cat) or global_perms[self.role][action]
+
+    def _traverse_to_node(self, path: str):
+        current = CafeImage.ROOT if path[0] == "/" else self.current_node
+        for part in path.strip("/").split("/"):
+            if not part or part == ".":
+                continue
+            if self.image.is_cat(current):
+                return None
+            current = self.image.parent(current) if part == ".." else self.image.child(current, part)
+            if current is None:
+                return None
+        return current
+
+    def iter_find(self, pattern, regex=False):
+        """Yields (path, cat) for every cat whose name matches, by name, see DirectoryTree.iter_find"""
+        matches = _name_matcher(pattern, regex)
+        if matches is None:
+            cats = self.image.cats_named(pattern)
+        else:
+            prefix = "" if regex else _literal_prefix(pattern)
+            cats = (cat for cat in self.image.cats_named(prefix, prefix=True) if matches(self.image.name(cat)))
+        for cat in cats:
+            yield self.image.path(cat), cat
+
+    def _iter_under(self, folder):
+        """Yields (path of its cubby, node) for every node under folder, depth first in prowl order
+        with each cubby before its contents, the root's path being the empty string"""
+        paths = {folder: "" if folder == CafeImage.ROOT else self.image.path(folder)}
+        for node in range(folder + 1, self.image.end(folder)):
+            path = paths[self.image.parent(node)]
+            if not self.image.is_cat(node):
+                paths[node] = f"{path}/{self.image.name(node)}"
+            yield path, node
+
+    def _cubby(self, scope):
+        folder = self._traverse_to_node(scope)
+        if folder is None or self.image.is_cat(folder):
+            raise ValueError(f"Cubby {scope} not found")
+        return folder
+
+    def iter_records(self, scope="/"):
+        """Returns an iterator of one dict per cubby and cat under scope, see DirectoryTree.iter_records"""
+        return self._records_under(self._cubby(scope))
+
+    def _records_under(self, folder):
+        roles = {role.value: role.name.lower() for role in Role}
+        for path, node in self._iter_under(folder):
+            if self.image.is_cat(node):
+                yield {"path": path or "/", "name": self.image.name(node), "type": "cat",
+                       "role": roles[self.image.role(node)], **self.image.properties(node)}
+            else:
+                yield {"path": path or "/", "name": self.image.name(node), "type": "cubby"}
+
+    def iter_query(self, predicates, scope="/"):
+        """Returns an iterator of (path, cat) for every cat under scope whose properties satisfy all the
+        predicates, checking each of them in the order DirectoryTree scans its tree in, see DirectoryTree.iter_query"""
+        predicates = [p if isinstance(p, Predicate) else parse_predicate(p) for p in predicates]
+        return self._scan_query(predicates, self._cubby(scope))
+
+    def _scan_query(self, predicates, folder):
+        if self._parallel is not None:
+            return iter(self._parallel.search(self.image.filename, ("query", predicates), folder))
+        return ((self.image.path(cat), cat) for cat in search(self.image, ("query", predicates), folder))
+
+    def complete(self, text):
+        """Returns the names in the current cubby that start with text, sorted, see DirectoryTree.complete"""
+        directory, slash, prefix = text.rpartition("/")
+        folder = self._traverse_to_node(directory or "/") if slash else self.current_node
+        if folder is None or self.image.is_cat(folder):
+            return []
+        names = sorted({name for name in map(self.image.name, self.image.children(folder)) if name.startswith(prefix)})
+        return [f"{directory}/{name}" for name in names] if slash else names
+
+    @timed
+    def find(self, name, all_matches=False, regex=False):
+        """Finds a cat in the whole image, or every cat whose name matches with all_matches.
+        name can be a glob pattern, or a regular expression with regex."""
+        try:
+            _name_matcher(name, regex)
+        except re.error as e:
+            print(f"Invalid pattern {name}: {e}")
+            return False
+        count = 0
+        for path, cat in self.iter_find(name, regex):
+            if not all_matches:
+                print(f"Found {self.image.name(cat)} in {path}")
+                return
+            print(path)
+            count += 1
+        if count:
+            print(f"{count} cat{'s' if count != 1 else ''} found")
+        else:
+            print(f"{name} not found in the tree")
+
+    @timed
+    def pawprint(self):
+        """Prints current working directory (pwd)"""
+        print(f"Current cubby: {self.image.path(self.current_node)}")
+
+    def _find_cat(self, cat_name, action, verb):
+        cat = self.image.child(self.current_node, cat_name)
+        if cat is None:
+            print(f"Cat {cat_name} not found!")
+        elif not self.image.is_cat(cat):
+            print(f"{cat_name} is not a cat!")
+        elif not self._allows(cat, action):
+            print(f"Permission denied: you need {verb} permission")
+        else:
+            return cat
+        return None
+
+    @timed
+    def cat(self, cat_name):
+        """Prints details about a cat."""
+        cat = self._find_cat(cat_name, "pet", "petting")
+        if cat is None:
+            return False
+        print(f"Cat: {cat_name}")
+        for prop, value in self.image.properties(cat).items():
+            print(f"{prop}: {value}")
+
+    @timed
+    def boop(self, cat_name):
+        """Executes the cat (if user has groom permission)."""
+        if self._find_cat(cat_name, "groom", "grooming") is None:
+            return False
+        print(f"*{cat_name} purrs contentedly*")
+
+    @timed
+    def walk(self, new_location):
+        """Changes directory."""
+        target = self._traverse_to_node(new_location)
+        if target is not None and not self.image.is_cat(target):
+            self.current_node = target
+            print(f"Walked to {new_location}")
+        else:
+            print(f"Location {new_location} not found!")
+            return False
+
+    @timed
+    def prowl(self):
+        """Lists all cats and sub-cubbies in current directory."""
+        children = self.image.children(self.current_node)
+        if not children:
+            print("No cats or cubbies in this cubby")
+            return
+        print("Current cubby contents:")
+        for child in children:
+            print(f" - {self.image.name(child)} ({'cat' if self.image.is_cat(child) else 'cubby'})")
+
+    @timed
+    def export(self, path, scope="/"):
+        """Writes every cubby and cat under scope to a CSV or JSON Lines file (- for the screen), see iter_records."""
+        try:
+            count = write_records(self.iter_records(scope), path)
+        except (OSError, ValueError) as e:
+            print(f"Export failed: {e}")
+            return False
+        if path != "-":
+            print(f"Exported {count} record{'s' if count != 1 else ''} to {path}")
+
+    def sync(self):
+        """Nothing to save, an image never changes."""
+        print("Synced")
+
+    def close(self):
+        if self._parallel is not None:
+            self._parallel.close()
+        self.image.close()
+
+    def get_stats(self):
+        """Returns the image's size and per-command latency percentiles as a JSON-serializable dict"""
+        return {
+            "cafe": self.name,
+            "image": {"nodes": self.image.node_count, "cats": self.image.cat_count, "bytes": self.image.size},
+            "commands": {name: histogram.summary() for name, histogram in sorted(self.latencies.items())},
+        }
+
+    @timed
+    def stats(self, fmt=None, path=None):
+        """Prints the image's size and command latency statistics, or dumps them as JSON (to path if given)."""
+        stats = self.get_stats()
+        if fmt == "json":
+            _dump_stats(stats, path)
+            return
+        image = stats["image"]
+        print(f"image: {image['nodes']} nodes, {image['cats']} cats, {image['bytes']} bytes mapped read-only")
+        _print_latencies(stats["commands"])
+
+def migrate_pickles():
+    """Writes every legacy cafes/<name>.pkl cafe in the current format, returns the migrated names"""
+    migrated = []
+    for filename in sorted(os.listdir("cafes")):
+        name, ext = os.path.splitext(filename)
+        if ext == ".pkl" and not os.path.exists(DirectoryTree.cafe_path(name)):
+            DirectoryTree.load(name)
+            migrated.append(name)
+    return migrated
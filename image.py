@@ -0,0 +1,324 @@
+# read-only cafe images, memory-mapped so any number of viewer processes share one copy
+#
+# An image is written once from a tree and never changed, a new export replaces the file (running
+# viewers keep the one they mapped). Nothing is deserialized on open: the file is mapped and every
+# lookup reads the few records it needs straight from the mapping, so opening costs the same
+# whatever the size of the cafe and the pages are shared through the page cache.
+#
+# Nodes are numbered depth first in prowl order, each cubby before its contents (root is 0), so
+# the nodes under a cubby are the contiguous run up to its end. Everything is little-endian.
+#
+#   header      MAGIC, IMAGE_VERSION, counts, section offsets, the cafe's name in the string table
+#   nodes       a fixed-width _NODE record per node: kind, role (cats), parent, name in the string
+#               table, first and count (for a cubby its run of the child arrays, for a cat its run
+#               of value records) and the end of its run of nodes
+#   values      a _VALUE record per property a cat has set: its index in CAT_PROPERTIES, its type
+#               tag (see storage.py) and its text in the string table
+#   children    uint32 node ids, the children of each cubby in prowl order
+#   by name     the same runs sorted by name (then prowl order), to look a child up by bisection
+#   cats        uint32 node id of every cat, sorted by name (then prowl order), for find
+#   strings     UTF-8 text the records point into
+#
+# Names are compared as UTF-8 bytes, which sort the same as the strings. Carried cats and session
+# state are not part of an image.
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import Counter
+from itertools import accumulate, compress, cycle, islice, repeat
+from operator import add, attrgetter, not_
+from storage import KIND_FILE, KIND_FOLDER, PARENT_NONE, CafeFormatError, _array_bytes, _array_from, _encode_column, _DECODERS
+
+MAGIC = b"CATIMG"
+IMAGE_VERSION = 1
+_HEADER = struct.Struct("<6sHIII6QQI")
+_NODE = struct.Struct("<BBxxiQIIII")
+_VALUE = struct.Struct("<BBxxIQ")
+_NATIVE = sys.byteorder == "little"
+
+def _records(layout: struct.Struct, columns) -> bytes:
+    """Packs columns (bytes or an array per field of layout, in order) into layout's fixed-width
+    records. Each byte of a field is copied to every record at once with a strided slice"""
+    count = len(columns[0])
+    records = bytearray(layout.size * count)
+    offset = 0
+    fields = iter(columns)
+    for code in layout.format.lstrip("<"):
+        width = struct.calcsize("<" + code)
+        if code != "x":
+            column = next(fields)
+            data = column if isinstance(column, (bytes, bytearray)) else _array_bytes(column)
+            for byte in range(width):
+                records[offset + byte::layout.size] = data[byte::width]
+        offset += width
+    return bytes(records)
+
+def encode_image(root, name: str, numbering: list = None) -> bytes:
+    """
+    Args:
+        root (FolderNode): Root cubby of the tree
+        name (str): Name of the cafe
+        numbering (list): If given, the tree's nodes are appended to it in id order
+    Returns:
+        bytes: The contents of an image file
+    """
+    from directory import CAT_PROPERTIES
+
+    nodes = [] if numbering is None else numbering
+    parents = array("i")
+    stack = [(root, PARENT_NONE)]
+    # depth-first numbering, children pushed in reverse so they come out in prowl order
+    while stack:
+        node, parent = stack.pop()
+        if not node.is_file:
+            stack.extend(zip(reversed(list(node.children)), repeat(len(nodes))))
+        parents.append(parent)
+        nodes.append(node)
+    count = len(nodes)
+    kinds = bytes(KIND_FILE if node.is_file else KIND_FOLDER for node in nodes)
+    roles = bytes(node.required_role.value if node.is_file else 0 for node in nodes)
+    cats = list(compress(range(count), kinds))  # KIND_FILE is the only truthy kind
+    folders = list(compress(range(count), map(not_, kinds)))
+
+    names = [node.name.encode("utf-8") for node in nodes]
+    cafe_name = name.encode("utf-8")
+    strings = [cafe_name] + names
+    name_lengths = array("I", map(len, names))
+    name_offsets = array("Q", accumulate(name_lengths, initial=len(cafe_name)))
+    offset = name_offsets.pop()
+
+    # property values a column at a time, then put in cat order: the values of each cat, by property
+    files = [nodes[i] for i in cats]
+    width = len(CAT_PROPERTIES)
+    tags = bytearray(width * len(files))
+    value_counts = [0] * len(files)
+    lengths = []
+    offsets = []
+    for column, property_name in enumerate(CAT_PROPERTIES):
+        column_tags, texts = _encode_column(list(map(attrgetter(property_name), files)))
+        tags[column::width] = column_tags
+        value_counts = list(map(add, value_counts, map(bool, column_tags)))
+        texts = [text.encode("utf-8") for text in texts]
+        column_lengths = array("I", map(len, texts))
+        lengths.append(iter(column_lengths))
+        offsets.append(iter(accumulate(column_lengths, initial=offset)))
+        offset += sum(column_lengths)
+        strings += texts
+    properties = bytes(compress(cycle(range(width)), tags))
+    values = _records(_VALUE, [properties, bytes(filter(None, tags)),
+                               array("I", map(next, map(lengths.__getitem__, properties))),
+                               array("Q", map(next, map(offsets.__getitem__, properties)))])
+
+    # a cubby's first and count are its run of the child arrays, a cat's its run of value records
+    first = [0] * count
+    number = [0] * count
+    ends = list(range(1, count + 1))
+    for i, value_first, value_count in zip(cats, accumulate(value_counts, initial=0), value_counts):
+        first[i] = value_first
+        number[i] = value_count
+    # children are in id order within each cubby, which is prowl order
+    children = sorted(range(1, count), key=parents.__getitem__)
+    child_counts = Counter(islice(parents, 1, None))
+    by_name = []
+    position = 0
+    for folder in folders:
+        first[folder] = position
+        number[folder] = child_counts[folder]
+        by_name += sorted(children[position:position + number[folder]], key=names.__getitem__)
+        position += number[folder]
+    # a cubby's run of nodes ends where its last child's does
+    for folder in reversed(folders):
+        if number[folder]:
+            ends[folder] = ends[children[first[folder] + number[folder] - 1]]
+
+    nodes = _records(_NODE, [kinds, roles, parents, name_offsets, name_lengths,
+                             array("I", first), array("I", number), array("I", ends)])
+    sections = [nodes, values, _array_bytes(array("I", children)), _array_bytes(array("I", by_name)),
+                _array_bytes(array("I", sorted(cats, key=names.__getitem__))), b"".join(strings)]
+    offsets = []
+    offset = _HEADER.size
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section)
+    header = _HEADER.pack(MAGIC, IMAGE_VERSION, count, len(cats), len(properties), *offsets, 0, len(cafe_name))
+    return header + b"".join(sections)
+
+def write_image(root, name: str, path: str) -> int:
+    """Writes the image next to path and moves it into place, so viewers that have the old one
+    mapped keep reading it and new ones only ever see a whole image. Returns its size in bytes"""
+    data = encode_image(root, name)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(data)
+
+class CafeImage:
+    """
+    An image file mapped read-only. Nodes are ids (the root is ROOT), every method reads what it
+    needs from the mapping, nothing is cached. Safe to share between threads.
+    """
+    ROOT = 0
+
+    def __init__(self, path: str):
+        self.filename = path
+        with open(path, "rb") as f:
+            # which file was mapped, a new export replaces the one at path
+            stat = os.fstat(f.fileno())
+            self.file_id = (stat.st_dev, stat.st_ino)
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file cannot be mapped
+                raise CafeFormatError(f"{path} is not a cafe image") from None
+        try:
+            if len(self._map) < _HEADER.size:
+                raise CafeFormatError(f"{path} is not a cafe image")
+            (magic, version, self.node_count, self.cat_count, value_count, self._nodes, self._values,
+             children, by_name, cats, self._strings, name_offset, name_length) = _HEADER.unpack_from(self._map)
+            if magic != MAGIC:
+                raise CafeFormatError(f"{path} is not a cafe image")
+            if version > IMAGE_VERSION:
+                raise CafeFormatError(f"{path} uses image version {version}, this CatFS only reads up to {IMAGE_VERSION}")
+            self.cafe_name = self._text(name_offset, name_length)
+            self._children = self._ids(children, self.node_count - 1)
+            self._by_name = self._ids(by_name, self.node_count - 1)
+            self._cats = self._ids(cats, self.cat_count)
+        except BaseException:
+            self.close()
+            raise
+        self.size = len(self._map)
+
+    def _ids(self, offset, count):
+        if _NATIVE:
+            # a view of the mapping itself, no copy
+            return memoryview(self._map)[offset:offset + 4 * count].cast("I")
+        return _array_from("I", self._map[offset:offset + 4 * count])
+
+    def _text(self, offset, length) -> str:
+        start = self._strings + offset
+        return self._map[start:start + length].decode("utf-8")
+
+    def _name_bytes(self, node) -> bytes:
+        _, _, _, offset, length, _, _, _ = self._record(node)
+        start = self._strings + offset
+        return self._map[start:start + length]
+
+    def _record(self, node):
+        return _NODE.unpack_from(self._map, self._nodes + _NODE.size * node)
+
+    def is_cat(self, node) -> bool:
+        return self._map[self._nodes + _NODE.size * node] == KIND_FILE
+
+    def name(self, node) -> str:
+        _, _, _, offset, length, _, _, _ = self._record(node)
+        return self._text(offset, length)
+
+    def parent(self, node):
+        """The parent's id, None for the root"""
+        parent = self._record(node)[2]
+        return None if parent == PARENT_NONE else parent
+
+    def role(self, node) -> int:
+        """The Role value a cat requires"""
+        return self._record(node)[1]
+
+    def properties(self, node) -> dict:
+        """The properties a cat has set, in CAT_PROPERTIES order"""
+        from directory import CAT_PROPERTIES
+
+        _, _, _, _, _, first, count, _ = self._record(node)
+        properties = {}
+        for i in range(first, first + count):
+            property_index, tag, length, offset = _VALUE.unpack_from(self._map, self._values + _VALUE.size * i)
+            properties[CAT_PROPERTIES[property_index]] = _DECODERS[tag](self._text(offset, length))
+        return properties
+
+    def children(self, node) -> list:
+        """A cubby's child ids in prowl order"""
+        _, _, _, _, _, first, count, _ = self._record(node)
+        return self._children[first:first + count].tolist()
+
+    def end(self, node) -> int:
+        """One past the last id under a cubby, the nodes under it being node + 1 up to there"""
+        return self._record(node)[7]
+
+    def _lower_bound(self, ids, lo, hi, key: bytes) -> int:
+        """The first position in ids[lo:hi] (sorted by name) whose name is not below key"""
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name_bytes(ids[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def child(self, node, name: str):
+        """The first child of a cubby called name, or None"""
+        _, _, _, _, _, first, count, _ = self._record(node)
+        key = name.encode("utf-8")
+        i = self._lower_bound(self._by_name, first, first + count, key)
+        if i < first + count and self._name_bytes(self._by_name[i]) == key:
+            return self._by_name[i]
+        return None
+
+    def cats_named(self, name: str, prefix: bool = False):
+        """Yields the ids of the cats called name (or whose name starts with it), by name then in prowl order"""
+        key = name.encode("utf-8")
+        i = self._lower_bound(self._cats, 0, self.cat_count, key)
+        while i < self.cat_count:
+            found = self._name_bytes(self._cats[i])
+            if not (found.startswith(key) if prefix else found == key):
+                return
+            yield self._cats[i]
+            i += 1
+
+    def lookup(self, path: str):
+        """The node at an absolute path, or None"""
+        node = self.ROOT
+        for part in path.strip("/").split("/"):
+            if part:
+                if self.is_cat(node):
+                    return None
+                node = self.child(node, part)
+                if node is None:
+                    return None
+        return node
+
+    def cats_under(self, folder, recursive: bool = True):
+        """Yields the ids of a cubby's cats in prowl order, then (if recursive) those under each of its
+        subcubbies in turn, the order DirectoryTree searches its tree in"""
+        stack = [folder]
+        while stack:
+            folder = stack.pop()
+            folders = []
+            for child in self.children(folder):
+                if self.is_cat(child):
+                    yield child
+                elif recursive:
+                    folders.append(child)
+            stack.extend(reversed(folders))
+
+    def path(self, node) -> str:
+        """Path of a node from the root, "/" for the root itself"""
+        parts = []
+        while node:
+            _, _, parent, offset, length, _, _, _ = self._record(node)
+            parts.append(self._text(offset, length))
+            node = parent
+        return "/" + "/".join(reversed(parts))
+
+    def close(self) -> None:
+        for view in ("_children", "_by_name", "_cats"):
+            if isinstance(getattr(self, view, None), memoryview):
+                getattr(self, view).release()
+        self._map.close()
@@ -0,0 +1,89 @@
+# append-only write-ahead journal for DirectoryTree mutations
+import os
+import pickle
+import struct
+import zlib
+
+# Every record is prefixed with the payload length and its CRC32
+_HEADER = struct.Struct("<II")
+
+class Journal:
+    """
+    An append-only log of mutations that sits next to a cafe's snapshot.
+    Records are framed with their length and a checksum, so a record that was only
+    partially written when the process died is detected (and cut off) on replay.
+    """
+    def __init__(self, path: str, fsync: bool = False):
+        """
+            Args:
+            path (str): Location of the journal file
+            fsync (bool): Whether to fsync after every record (survives power loss, but slower)
+        """
+        self.path = path
+        self.fsync = fsync
+        self._file = None
+
+    def append(self, record) -> None:
+        """
+        Args:
+            record: Any picklable object describing a mutation
+        """
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        self._file.write(_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def size(self) -> int:
+        """
+        Returns:
+            int: Number of bytes currently in the journal
+        """
+        if self._file is not None:
+            return self._file.tell()
+        if os.path.exists(self.path):
+            return os.path.getsize(self.path)
+        return 0
+
+    def records(self):
+        """
+        Yields every intact record in the order it was written. Anything after the
+        last intact record (a torn write) is truncated away so new appends start clean.
+        """
+        if not os.path.exists(self.path):
+            return
+        good_end = 0
+        with open(self.path, "rb") as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length, checksum = _HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    break
+                good_end = f.tell()
+                yield pickle.loads(payload)
+        if good_end < os.path.getsize(self.path):
+            self.close()
+            with open(self.path, "r+b") as f:
+                f.truncate(good_end)
+
+    def sync(self) -> None:
+        """Forces every appended record to disk"""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def truncate(self) -> None:
+        """Empties the journal, called once a snapshot covers all of its records"""
+        self.close()
+        with open(self.path, "wb"):
+            pass
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
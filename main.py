@@ -1,123 +1,322 @@
 import argparse
-import os
-import pickle
-from directory import DirectoryTree, Role
+import sys
+from cache import CACHE_POLICIES
+from directory import CAT_PROPERTIES, DirectoryTree, ImageTree, Role
+from server import IDLE_TIMEOUT, AsyncCatServer, CatClient, CatServer, socket_path
+from storage import CafeFormatError
+
+try:
+    import readline
+except ImportError:
+    # not available on every platform, the prompt then works without tab completion
+    readline = None
 
 def parse_args():
     """Parse command-line arguments."""
     parser = argparse.ArgumentParser(description="Cat Cafe File System")
-    parser.add_argument("-c", "--cache", type=int, default=0, help="Cache size (not implemented yet)")
+    parser.add_argument("-c", "--cache", type=int, default=0, help="Size of the find cache, 0 disables it")
+    parser.add_argument("--cache-policy", type=str, default="lru", choices=list(CACHE_POLICIES), help="Eviction policy of the find cache")
     parser.add_argument("-p", "--perm", type=str, default="visitor", choices=["visitor", "volunteer", "staff", "admin"], help="Role permission level")
-    parser.add_argument("-n", "--name", type=str, required=True, help="Name of the cafe to open")
-    return parser.parse_args()
-
-def load_or_create_tree(name, role):
-    """Load DirectoryTree from pickle file or create a new one."""
-    pkl_path = os.path.join("cafes", f"{name}.pkl")
-    if os.path.exists(pkl_path):
-        with open(pkl_path, "rb") as f:
-            tree = pickle.load(f)
-            tree.role = role  # update role for this session
-            return tree
+    parser.add_argument("-n", "--name", type=str, help="Name of the cafe to open")
+    parser.add_argument("-j", "--journal", action="store_true", help="Journal each change instead of rewriting the whole cafe")
+    parser.add_argument("-b", "--background", action="store_true", help="Save the cafe on a background thread instead of after every change")
+    parser.add_argument("--shards", action="store_true",
+                        help="Store the cafe as a file per cubby, so a change only rewrites the cubbies it touches (converts an existing cafe)")
+    parser.add_argument("--image", action="store_true",
+                        help="Open the cafe's read-only image (written by the image command) instead of the cafe, to view it only")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="Run the finds and queries that have to check every cat on this many worker processes")
+    parser.add_argument("-x", "--index-property", action="append", default=[], choices=CAT_PROPERTIES,
+                        help="Keep a secondary index on this cat property to speed up query, can be repeated")
+    parser.add_argument("-i", "--import", dest="import_file", type=str,
+                        help="Import the cats and cubbies in this .csv or .jsonl file into the cafe, then exit")
+    parser.add_argument("-s", "--script", type=str, help="Run the commands in this file (- for stdin) without prompting, then exit")
+    parser.add_argument("-k", "--keep-going", action="store_true", help="In script mode, keep running after a command fails")
+    parser.add_argument("--serve", action="store_true", help="Keep the cafe open and serve it to clients started with --connect")
+    parser.add_argument("--connect", action="store_true", help="Run commands on the cafe's server instead of opening the cafe")
+    parser.add_argument("--socket", type=str, help="Socket the server listens on, cafes/[name].sock by default")
+    parser.add_argument("--threads", action="store_true", help="Serve each client on a thread of its own instead of one event loop")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="Seconds a client may stay idle before the server disconnects it (event loop server only)")
+    args = parser.parse_args()
+    if args.serve and args.connect:
+        parser.error("--serve and --connect cannot be combined")
+    if args.image and (args.serve or args.connect):
+        parser.error("--image cannot be combined with --serve or --connect")
+    if args.import_file is not None and (args.image or args.serve or args.connect or args.script is not None):
+        parser.error("--import cannot be combined with --image, --serve, --connect or --script")
+    if args.name is None and not (args.connect and args.socket):
+        parser.error("the following arguments are required: -n/--name")
+    return args
+
+def load_or_create_tree(name, role, journal=False, cache_size=0, cache_policy="lru", background=False,
+                        property_indexes=(), sharded=False):
+    """Load DirectoryTree from its cafe file or shards (migrating an old pickle, replaying its journal) or create a new one."""
+    if DirectoryTree.exists(name):
+        return DirectoryTree.load(name, role, cache_size, cache_policy, journal, background=background,
+                                  property_indexes=property_indexes, sharded=sharded)
+    return DirectoryTree(name=name, cache_size=cache_size, role=role, journal=journal, cache_policy=cache_policy,
+                         background=background, property_indexes=property_indexes, sharded=sharded)
+
+ROLE_MAP = {
+    "visitor": Role.VISITOR,
+    "volunteer": Role.VOLUNTEER,
+    "staff": Role.STAFF,
+    "admin": Role.ADMIN
+}
+
+FIND_FLAGS = {"--all", "--regex"}
+
+COMMANDS = [
+    ("help", "Show this help message"),
+    ("exit", "Exit the command prompt"),
+    ("cat [cat_name]", "View details of a cat"),
+    ("meow [cat_name] [property] [value]", "Update/set the `age`, `mood`, `date_found`, and `date_fed` of a cat"),
+    ("boop [cat_name]", "Execute the cat"),
+    ("rescue [cat_name] [permissions]", "Create new cat, permissions are optional"),
+    ("find [--all] [--regex] [pattern]", "Searches the whole cafe for a cat, or every cat matching a name, glob or regex"),
+    ("query [--in path] [property<op>value ...]", "List the cats whose properties match, op is one of = != < <= > >="),
+    ("pawprint", "Show the path it takes to get to the current cubby (pwd)"),
+    ("copycat [cat_name] [new_cat_name]", "... copy the cat"),
+    ("recollar [cat_name] [new_name]", "Rename the cat"),
+    ("walk [new_location]", "Walk to a different cubby"),
+    ("adopted [cat_name]", "Have some adopt the cat, removing it from our cubby"),
+    ("carry [cat_name]", "Try to carry cat so you can move it somewhere else, but cats are elusive and may run away"),
+    ("carrying", "List carried cats"),
+    ("put [cat_name]", "Drop cat(s) into current cubby, omit name to drop all"),
+    ("mkcby [cubby_name]", "Create a cubby (directory)"),
+    ("import [file]", "Add every cat in a .csv or .jsonl file (path, name, role, properties), creating cubbies as needed"),
+    ("export [file] [--in path]", "Write every cubby and cat (under path) to a .csv or .jsonl file that import reads, - for the screen"),
+    ("prowl", "List all cats and cubbies in current cubby"),
+    ("image [file]", "Write a read-only image of the cafe that viewers open with --image, cafes/[name].img by default"),
+    ("begin", "Start a transaction, changes are only saved at commit"),
+    ("commit", "Save every change made since begin"),
+    ("abort", "Undo every change made since begin"),
+    ("sync", "Wait until every change is saved to disk"),
+    ("stats [json] [file]", "Show cache counters and command latencies, optionally as JSON written to file")
+]
+COMMAND_NAMES = sorted({usage.split()[0] for usage, _ in COMMANDS} | {"quit"})
+
+def print_help():
+    """Prints the available commands."""
+    print("Available commands:")
+    max_len = max(len(cmd[0]) for cmd in COMMANDS)
+    for cmd, desc in COMMANDS:
+        print(f"  {cmd.ljust(max_len + 2)}{desc}")
+
+def run_command(dt, user_input):
+    """Parses and runs a single command line, returns False if the command failed."""
+    args = user_input.split()
+    if not args:
+        return True
+
+    command = args[0].lower()
+    args = args[1:]
+
+    if command == "cat" and len(args) == 1:
+        result = dt.cat(args[0])
+    elif command == "meow" and len(args) == 3:
+        result = dt.meow(args[0], args[1], args[2])
+    elif command == "boop" and len(args) == 1:
+        result = dt.boop(args[0])
+    elif command == "rescue" and len(args) == 2 and args[1].lower() in ROLE_MAP:
+        result = dt.rescue(args[0], ROLE_MAP[args[1].lower()])
+    elif command == "rescue" and len(args) == 1:
+        result = dt.rescue(args[0])
+    elif command == "find" and 1 <= len(args) <= 3 and set(args[:-1]) <= FIND_FLAGS:
+        result = dt.find(args[-1], "--all" in args[:-1], "--regex" in args[:-1])
+    elif command == "query" and args.count("--in") <= 1 and args[-1:] != ["--in"]:
+        scope = "/"
+        if "--in" in args:
+            i = args.index("--in")
+            scope = args[i + 1]
+            args = args[:i] + args[i + 2:]
+        result = dt.query(*args, scope=scope)
+    elif command == "pawprint":
+        result = dt.pawprint()
+    elif command == "copycat" and len(args) == 2:
+        result = dt.copycat(args[0], args[1])
+    elif command == "recollar" and len(args) == 2:
+        result = dt.recollar(args[0], args[1])
+    elif command == "walk" and len(args) == 1:
+        result = dt.walk(args[0])
+    elif command == "adopted" and len(args) == 1:
+        result = dt.adopted(args[0])
+    elif command == "carry" and len(args) == 1:
+        result = dt.carry(args[0])
+    elif command == "carrying":
+        result = dt.carrying()
+    elif command == "put" and len(args) == 0:
+        result = dt.put()
+    elif command == "put" and len(args) == 1:
+        result = dt.put(args[0])
+    elif command == "mkcby" and len(args) == 1:
+        result = dt.mkcby(args[0])
+    elif command == "import" and len(args) == 1:
+        result = dt.import_cats(args[0])
+    elif command == "export" and len(args) == 1:
+        result = dt.export(args[0])
+    elif command == "export" and len(args) == 3 and args[1] == "--in":
+        result = dt.export(args[0], args[2])
+    elif command == "prowl":
+        result = dt.prowl()
+    elif command == "image" and len(args) <= 1:
+        result = dt.export_image(*args)
+    elif command == "begin":
+        result = dt.begin()
+    elif command == "commit":
+        result = dt.commit()
+    elif command == "abort":
+        result = dt.abort()
+    elif command == "sync":
+        result = dt.sync()
+    elif command == "stats" and len(args) == 0:
+        result = dt.stats()
+    elif command == "stats" and args[0].lower() == "json" and len(args) <= 2:
+        result = dt.stats("json", *args[1:])
+    elif command == "help" or command == "?":
+        result = print_help()
+    else:
+        print("Invalid command or arguments. Run `help` to view available commands.")
+        result = False
+    return result is not False
+
+class Completer:
+    """Tab completion for the prompt: command names first, then names in the current cubby (or the cubby a path leads to)."""
+    def __init__(self, dt):
+        self.dt = dt
+        self.matches = []
+
+    def complete(self, text, state):
+        """readline calls this with state 0, 1, 2, ... until it returns None"""
+        if state == 0:
+            if readline.get_line_buffer()[:readline.get_begidx()].strip():
+                self.matches = self.dt.complete(text)
+            else:
+                self.matches = [name for name in COMMAND_NAMES if name.startswith(text)]
+        return self.matches[state] if state < len(self.matches) else None
+
+def enable_completion(dt):
+    """Turns on tab completion for the prompt, if readline is available."""
+    if readline is None:
+        return
+    readline.set_completer(Completer(dt).complete)
+    # paths are completed a cubby at a time, so / must not split words
+    readline.set_completer_delims(" \t\n")
+    if "libedit" in (readline.__doc__ or ""):
+        readline.parse_and_bind("bind ^I rl_complete")
     else:
-        return DirectoryTree(name=name, role=role)
+        readline.parse_and_bind("tab: complete")
 
-def command_prompt(dt):
-    """Starts the command prompt loop."""
+def command_prompt(dt, run=run_command):
+    """Starts the command prompt loop. dt can also be a CatClient, with run=CatClient.run_command."""
+    enable_completion(dt)
     while True:
         try:
             user_input = input("catfs 🐱 ")
             if user_input.strip().lower() in {"exit", "quit"}:
+                if dt.in_transaction:
+                    dt.abort()
                 print("Exiting command prompt. Goodbye!")
                 break
-                
-            args = user_input.split()
-            if not args:
-                continue
-                
-            command = args[0].lower()
-            args = args[1:]
-            
-            if command == "cat" and len(args) == 1:
-                dt.cat(args[0])
-            elif command == "meow" and len(args) == 3:
-                dt.meow(args[0], args[1], args[2])
-            elif command == "boop" and len(args) == 1:
-                dt.boop(args[0])
-            elif command == "rescue" and len(args) == 2:
-                dt.rescue(args[0], args[1])
-            elif command == "rescue" and len(args) == 1:
-                dt.rescue(args[0])
-            elif command == "find" and len(args) == 1:
-                dt.find(args[0])
-            elif command == "pawprint":
-                dt.pawprint()
-            elif command == "copycat" and len(args) == 2:
-                dt.copycat(args[0], args[1])
-            elif command == "recollar" and len(args) == 2:
-                dt.recollar(args[0], args[1])
-            elif command == "walk" and len(args) == 1:
-                dt.walk(args[0])
-            elif command == "adopted" and len(args) == 1:
-                dt.adopted(args[0])
-            elif command == "carry" and len(args) == 1:
-                dt.carry(args[0])
-            elif command == "carrying":
-                dt.carrying()
-            elif command == "put" and len(args) == 0:
-                dt.put()
-            elif command == "put" and len(args) == 1:
-                dt.put(args[0])
-            elif command == "mkcby" and len(args) == 1:
-                dt.mkcby(args[0])
-            elif command == "prowl":
-                dt.prowl()
-            elif command.lower() == "help" or command.lower() == "?":
-                print("Available commands:")
-                commands = [
-                    ("help", "Show this help message"),
-                    ("exit", "Exit the command prompt"),
-                    ("cat [cat_name]", "View details of a cat"),
-                    ("meow [cat_name] [property] [value]", "Update/set the `age`, `mood`, `date_found`, and `date_fed` of a cat"),
-                    ("boop [cat_name]", "Execute the cat"),
-                    ("rescue [cat_name] [permissions]", "Create new cat, permissions are optional"),
-                    ("find [cat_name]", "Searches for cat in the whole cafe"),
-                    ("pawprint", "Show the path it takes to get to the current cubby (pwd)"),
-                    ("copycat [cat_name] [new_cat_name]", "... copy the cat"),
-                    ("recollar [cat_name] [new_name]", "Rename the cat"),
-                    ("walk [new_location]", "Walk to a different cubby"),
-                    ("adopted [cat_name]", "Have some adopt the cat, removing it from our cubby"),
-                    ("carry [cat_name]", "Try to carry cat so you can move it somewhere else, but cats are elusive and may run away"),
-                    ("carrying", "List carried cats"),
-                    ("put [cat_name]", "Drop cat(s) into current cubby, omit name to drop all"),
-                    ("mkcby [cubby_name]", "Create a cubby (directory)"),
-                    ("prowl", "List all cats and cubbies in current cubby")
-                ]
-
-                max_len = max(len(cmd[0]) for cmd in commands)
-                for cmd, desc in commands:
-                    print(f"  {cmd.ljust(max_len + 2)}{desc}")
-            else:
-                print("Invalid command or arguments. Run `help` to view available commands.")
-                
+            run(dt, user_input)
         except KeyboardInterrupt:
             print("\nExiting command prompt. Goodbye!")
             break
         except Exception as e:
             print(f"Error: {e}")
 
+def run_script(dt, lines, keep_going=False, source="<stdin>", run=run_command):
+    """
+    Runs commands back to back without prompting, saving the cafe once at the end.
+    Blank lines and lines starting with # are skipped.
+    Stops at the first failing command unless keep_going, returns the process exit code.
+    """
+    failures = 0
+    with dt.deferred_saves():
+        for lineno, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.lower() in {"exit", "quit"}:
+                break
+            try:
+                ok = run(dt, line)
+            except Exception as e:
+                print(f"Error: {e}")
+                ok = False
+            if not ok:
+                failures += 1
+                print(f"{source}:{lineno}: command failed: {line}", file=sys.stderr)
+                if not keep_going:
+                    break
+        if dt.in_transaction:
+            dt.abort()
+    return 1 if failures else 0
+
+def serve(dt, path, threads=False, idle_timeout=IDLE_TIMEOUT):
+    """Serves the tree to clients until interrupted, from one event loop or with a thread per client."""
+    if threads:
+        server = CatServer(dt, path, run_command)
+    else:
+        server = AsyncCatServer(dt, path, run_command, idle_timeout=idle_timeout)
+    print(f"Serving {dt.name} on {path}, Ctrl-C to stop")
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    print("Server stopped")
+
+def connect(path, role, script=None, keep_going=False):
+    """Runs the prompt (or a script) against the server listening on path, returns the process exit code."""
+    try:
+        client = CatClient(path, role)
+    except (OSError, ValueError) as e:
+        print(f"Cannot connect to {path}: {e}", file=sys.stderr)
+        return 1
+    with client:
+        if script is not None and script != "-":
+            with open(script) as f:
+                return run_script(client, f, keep_going, script, run=CatClient.run_command)
+        if script == "-" or not sys.stdin.isatty():
+            return run_script(client, sys.stdin, keep_going, run=CatClient.run_command)
+        command_prompt(client, run=CatClient.run_command)
+        return 0
+
 def main():
     """Main entry point for the program."""
     args = parse_args()
-    role_map = {
-        "visitor": Role.VISITOR,
-        "volunteer": Role.VOLUNTEER,
-        "staff": Role.STAFF,
-        "admin": Role.ADMIN
-    }
-    dt = load_or_create_tree(args.name, role_map[args.perm])
-    command_prompt(dt)
+    path = args.socket or (socket_path(args.name) if args.name else None)
+    if args.connect:
+        return connect(path, args.perm, args.script, args.keep_going)
+    if args.image:
+        try:
+            dt = ImageTree(args.name, ROLE_MAP[args.perm])
+        except (OSError, CafeFormatError) as e:
+            print(f"Cannot open the image of {args.name}: {e}", file=sys.stderr)
+            return 1
+    else:
+        dt = load_or_create_tree(args.name, ROLE_MAP[args.perm], args.journal, args.cache, args.cache_policy, args.background,
+                                 args.index_property, args.shards)
+    if args.workers:
+        dt.enable_parallel_search(args.workers)
+    try:
+        if args.import_file is not None:
+            return 1 if dt.import_cats(args.import_file) is False else 0
+        if args.serve:
+            serve(dt, path, args.threads, args.idle_timeout)
+            return 0
+        if args.script is not None and args.script != "-":
+            with open(args.script) as f:
+                return run_script(dt, f, args.keep_going, args.script)
+        if args.script == "-" or not sys.stdin.isatty():
+            return run_script(dt, sys.stdin, args.keep_going)
+        command_prompt(dt)
+        return 0
+    finally:
+        # flushes anything the background writer has not saved yet
+        dt.close()
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
 
@@ -0,0 +1,50 @@
+# sorted name lists for prefix search and tab completion
+from bisect import bisect_left, insort
+
+_MAX_CHAR = chr(0x10FFFF)
+
+def _prefix_end(prefix: str):
+    """The smallest string greater than every string starting with prefix, or None if there is none"""
+    prefix = prefix.rstrip(_MAX_CHAR)
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class SortedNames:
+    """
+    A set of names kept in a sorted list, so the names starting with a prefix are a contiguous
+    run found with two binary searches. Adding or removing a name shifts the list, which is a
+    memmove even at millions of names. The owner decides when a name comes and goes, and keeps
+    track of how many nodes share it.
+    """
+    def __init__(self, names=()):
+        """
+            Args:
+            names (iterable): Distinct names to start with
+        """
+        self.names = sorted(names)
+
+    def add(self, name: str) -> None:
+        insort(self.names, name)
+
+    def remove(self, name: str) -> None:
+        del self.names[bisect_left(self.names, name)]
+
+    def with_prefix(self, prefix: str) -> list:
+        """
+        Returns:
+            list: The names starting with prefix, in sorted order
+        """
+        start = bisect_left(self.names, prefix)
+        end = _prefix_end(prefix)
+        return self.names[start:] if end is None else self.names[start:bisect_left(self.names, end, start)]
+
+    def __contains__(self, name: str) -> bool:
+        i = bisect_left(self.names, name)
+        return i < len(self.names) and self.names[i] == name
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
@@ -0,0 +1,169 @@
+# searches that have to check every cat, split across a pool of worker processes
+#
+# The workers search a cafe image (see image.py) that each of them maps, so the tree is never
+# copied to them: a task is a cubby's id, and the pages of the image are shared by every process
+# through the page cache. A search is split along the root's subtrees, and the biggest subtree is
+# split again along its own until every worker has a few tasks. The tasks are listed in the order
+# the tree is searched sequentially (a cubby's own cats in prowl order, then each of its subcubbies
+# in turn), so their results put together in that order are exactly the sequential results.
+#
+# A search is described by a picklable spec:
+#   ("name", name)                cats called name
+#   ("pattern", pattern, regex)   cats whose name matches a glob pattern, or a regular expression with regex
+#   ("query", predicates)      cats whose properties satisfy every Predicate (see query.py)
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from itertools import islice
+from types import SimpleNamespace
+from image import CafeImage
+
+# Tasks handed out per worker, so one that drew small subtrees takes more instead of idling
+TASKS_PER_WORKER = 4
+# How many cats a worker checks between looking whether an earlier task has already found a match
+CHECK_EVERY = 1024
+_NO_MATCH = 2 ** 62
+
+# worker process state
+_image = None  # the CafeImage searched last
+_first_match = None  # shared with the other workers: the earliest task known to have a match
+
+def _init_worker(first_match):
+    global _first_match
+    _first_match = first_match
+
+def _open(image, path):
+    """image if it maps the file now at path, otherwise that file mapped, closing image"""
+    if image is not None and image.filename == path:
+        stat = os.stat(path)
+        if image.file_id == (stat.st_dev, stat.st_ino):
+            return image
+    if image is not None:
+        image.close()
+    return CafeImage(path)
+
+def _matcher(image, spec):
+    """Returns a function telling whether a cat of image matches spec"""
+    from directory import CAT_PROPERTIES, _name_matcher
+
+    if spec[0] == "name":
+        name = spec[1]
+        return lambda cat: image.name(cat) == name
+    if spec[0] == "pattern":
+        _, pattern, regex = spec
+        matches = _name_matcher(pattern, regex) or pattern.__eq__
+        return lambda cat: matches(image.name(cat))
+    predicates = spec[1]
+    unset = dict.fromkeys(CAT_PROPERTIES)
+
+    def matches(cat):
+        properties = SimpleNamespace(**{**unset, **image.properties(cat)})
+        return all(predicate.matches(properties) for predicate in predicates)
+    return matches
+
+def search(image, spec, folder=CafeImage.ROOT, first=False) -> list:
+    """
+    Searches in this process, in the sequential order.
+    Returns:
+        list: Ids of the cats under folder that match spec, only the first one with first
+    """
+    found = filter(_matcher(image, spec), image.cats_under(folder))
+    return list(islice(found, 1)) if first else list(found)
+
+def split(image, folder, count: int) -> list:
+    """
+    Splits the search under folder into about count tasks, (cubby, whether its subcubbies are searched
+    too), in the sequential order. The biggest subtree is replaced by its cubby's own cats followed by
+    each of its subcubbies, until there are enough tasks or no subtree has subcubbies left to split off.
+    """
+    tasks = [(folder, True)]
+    leaves = set()  # cubbies without subcubbies
+    while len(tasks) < count:
+        splittable = [i for i, (folder, recursive) in enumerate(tasks) if recursive and folder not in leaves]
+        if not splittable:
+            break
+        i = max(splittable, key=lambda i: image.end(tasks[i][0]) - tasks[i][0])
+        folder = tasks[i][0]
+        subfolders = [child for child in image.children(folder) if not image.is_cat(child)]
+        if subfolders:
+            tasks[i:i + 1] = [(folder, False)] + [(subfolder, True) for subfolder in subfolders]
+        else:
+            leaves.add(folder)
+    return tasks
+
+def _run_task(path, spec, task, index, first):
+    """Runs one task in a worker. For first, gives up (returning no cats) once an earlier task has a match"""
+    global _image
+    _image = _open(_image, path)
+    folder, recursive = task
+    matches = _matcher(_image, spec)
+    found = []
+    for checked, cat in enumerate(_image.cats_under(folder, recursive), 1):
+        if matches(cat):
+            found.append(cat)
+            if first:
+                with _first_match.get_lock():
+                    _first_match.value = min(_first_match.value, index)
+                break
+        if first and not checked % CHECK_EVERY and _first_match.value < index:
+            return []
+    return found
+
+class ParallelSearch:
+    """
+    A pool of worker processes searching cafe images. The workers are started the first time they are
+    needed, with spawn, so they inherit nothing from this process (its threads and locks included) and
+    work the same on every platform. Searches from several threads take turns.
+    """
+    def __init__(self, workers: int = None):
+        """
+            Args:
+            workers (int): Number of worker processes, one per CPU if None
+        """
+        self.workers = workers or os.cpu_count() or 1
+        context = multiprocessing.get_context("spawn")
+        self._first_match = context.Value("q", _NO_MATCH)
+        self._pool = ProcessPoolExecutor(self.workers, mp_context=context, initializer=_init_worker,
+                                         initargs=(self._first_match,))
+        self._image = None  # this process's mapping, to split searches and build paths
+        self._lock = threading.Lock()
+
+    def search(self, path: str, spec, scope: str = "/", first: bool = False) -> list:
+        """
+        Searches the image at path on the workers.
+            Args:
+            path (str): Image file, written by image.write_image
+            spec (tuple): What to look for, see the top of this module
+            scope (str | int): Path or id of the cubby to search under
+            first (bool): Whether only the first match is wanted, the tasks after it are then cancelled
+        Returns:
+            list: (path, id) of the matching cats in the sequential order
+        Raises ValueError if scope does not lead to a cubby
+        """
+        with self._lock:
+            self._image = image = _open(self._image, path)
+            folder = scope if isinstance(scope, int) else image.lookup(scope)
+            if folder is None or not 0 <= folder < image.node_count or image.is_cat(folder):
+                raise ValueError(f"Cubby {scope} not found")
+            self._first_match.value = _NO_MATCH
+            futures = [self._pool.submit(_run_task, path, spec, task, index, first)
+                       for index, task in enumerate(split(image, folder, self.workers * TASKS_PER_WORKER))]
+            found = []
+            try:
+                for future in futures:
+                    found += future.result()
+                    if first and found:
+                        found = found[:1]
+                        break
+            finally:
+                for future in futures:
+                    future.cancel()
+                # the ones already running see the match and stop soon, they must not touch the next search's
+                wait(futures)
+            return [(image.path(cat), cat) for cat in found]
+
+    def close(self) -> None:
+        self._pool.shutdown(cancel_futures=True)
+        if self._image is not None:
+            self._image.close()
@@ -0,0 +1,193 @@
+# property predicates and secondary indexes over cat properties, for DirectoryTree.iter_query
+import operator
+import re
+from bisect import bisect_left, bisect_right, insort
+
+OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+_PREDICATE = re.compile(r"^(\w+)(<=|>=|!=|=|<|>)(.+)$")
+
+# Properties compared as numbers, the rest compare as text (so dates should be written YYYY-MM-DD)
+NUMERIC_PROPERTIES = frozenset({"age"})
+# Properties that get a hash index (equality only), the rest get a sorted index (equality and ranges)
+HASH_INDEXED_PROPERTIES = frozenset({"mood"})
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def property_key(property_name, value):
+    """The value a property is compared and indexed by, None if it is unset or not comparable"""
+    if value is None:
+        return None
+    if property_name in NUMERIC_PROPERTIES:
+        return _number(value)
+    return str(value)
+
+class Predicate:
+    """property_name <op> value, e.g. age>=3"""
+    __slots__ = ("property_name", "op", "key")
+    def __init__(self, property_name: str, op: str, value):
+        """
+            Args:
+            property_name (str): One of CAT_PROPERTIES
+            op (str): One of OPERATORS
+            value: What the property is compared with
+        """
+        from directory import CAT_PROPERTIES
+        if property_name not in CAT_PROPERTIES:
+            raise ValueError(f"Invalid property: {property_name}, valid properties are: {', '.join(CAT_PROPERTIES)}")
+        if op not in OPERATORS:
+            raise ValueError(f"Invalid operator: {op}")
+        self.property_name = property_name
+        self.op = op
+        self.key = property_key(property_name, value)
+        if self.key is None:
+            raise ValueError(f"{property_name} must be compared with a number, not {value}")
+
+    def matches(self, cat) -> bool:
+        key = property_key(self.property_name, getattr(cat, self.property_name))
+        return key is not None and OPERATORS[self.op](key, self.key)
+
+    def __repr__(self):
+        return f"Predicate({self.property_name}{self.op}{self.key!r})"
+
+def parse_predicate(text: str) -> Predicate:
+    """Parses property<op>value, raises ValueError if text is not a valid predicate"""
+    match = _PREDICATE.match(text)
+    if match is None:
+        raise ValueError(f"Invalid predicate: {text}, expected property<op>value with op one of {' '.join(OPERATORS)}")
+    return Predicate(*match.groups())
+
+class HashIndex:
+    """Maps a property's key to the cats that have it, answers equality predicates"""
+    kind = "hash"
+
+    def __init__(self, property_name: str):
+        self.property_name = property_name
+        self.buckets = {}  # key -> {cat: None}, insertion ordered
+        self.count = 0  # cats with a key
+
+    def add(self, cat, value) -> None:
+        key = property_key(self.property_name, value)
+        if key is not None:
+            self.buckets.setdefault(key, {})[cat] = None
+            self.count += 1
+
+    def remove(self, cat, value) -> None:
+        key = property_key(self.property_name, value)
+        if key is None:
+            return
+        bucket = self.buckets[key]
+        del bucket[cat]
+        self.count -= 1
+        if not bucket:
+            self._drop_key(key)
+
+    def _drop_key(self, key) -> None:
+        del self.buckets[key]
+
+    def estimate(self, predicates):
+        """How many cats lookup would return for these predicates (all on this property), None if it can't help"""
+        for predicate in predicates:
+            if predicate.op == "=":
+                return len(self.buckets.get(predicate.key, ()))
+        return None
+
+    def lookup(self, predicates):
+        """The cats that may match, a superset of the cats matching every predicate"""
+        for predicate in predicates:
+            if predicate.op == "=":
+                return list(self.buckets.get(predicate.key, ()))
+        raise ValueError(f"a {self.kind} index cannot answer {predicates}")
+
+    def stats(self) -> dict:
+        return {"kind": self.kind, "keys": len(self.buckets), "cats": self.count}
+
+class SortedIndex(HashIndex):
+    """A hash index whose keys are also kept sorted, so it answers ranges as well"""
+    kind = "sorted"
+
+    def __init__(self, property_name: str):
+        super().__init__(property_name)
+        self.keys = []
+
+    def add(self, cat, value) -> None:
+        key = property_key(self.property_name, value)
+        if key is not None and key not in self.buckets:
+            insort(self.keys, key)
+        super().add(cat, value)
+
+    def _drop_key(self, key) -> None:
+        super()._drop_key(key)
+        del self.keys[bisect_left(self.keys, key)]
+
+    def _key_range(self, predicates):
+        """The slice of self.keys every predicate allows, or None if they are all != and narrow nothing down"""
+        start, end = 0, len(self.keys)
+        for predicate in predicates:
+            if predicate.op == "=":
+                start = max(start, bisect_left(self.keys, predicate.key))
+                end = min(end, bisect_right(self.keys, predicate.key))
+            elif predicate.op == ">":
+                start = max(start, bisect_right(self.keys, predicate.key))
+            elif predicate.op == ">=":
+                start = max(start, bisect_left(self.keys, predicate.key))
+            elif predicate.op == "<":
+                end = min(end, bisect_left(self.keys, predicate.key))
+            elif predicate.op == "<=":
+                end = min(end, bisect_right(self.keys, predicate.key))
+        if all(predicate.op == "!=" for predicate in predicates):
+            return None
+        return start, max(start, end)
+
+    def estimate(self, predicates):
+        key_range = self._key_range(predicates)
+        if key_range is None:
+            return None
+        start, end = key_range
+        if end - start > 64:
+            # too many keys to count exactly, assume they are about as popular as the average key
+            return (end - start) * self.count // max(len(self.keys), 1)
+        return sum(len(self.buckets[key]) for key in self.keys[start:end])
+
+    def lookup(self, predicates):
+        key_range = self._key_range(predicates)
+        if key_range is None:
+            raise ValueError(f"a {self.kind} index cannot answer {predicates}")
+        start, end = key_range
+        return [cat for key in self.keys[start:end] for cat in self.buckets[key]]
+
+def make_property_index(property_name: str):
+    """Returns an empty index of the kind suited to property_name"""
+    if property_name in HASH_INDEXED_PROPERTIES:
+        return HashIndex(property_name)
+    return SortedIndex(property_name)
+
+def plan(predicates, indexes):
+    """
+    Picks the index that narrows the query down to the fewest cats.
+    Args:
+        predicates (list): Predicates that must all hold
+        indexes (dict): property name -> index
+    Returns:
+        tuple: (index, the predicates on its property) or (None, None) if the cats must be scanned
+    """
+    best = (None, None)
+    best_estimate = None
+    for property_name, index in indexes.items():
+        on_property = [predicate for predicate in predicates if predicate.property_name == property_name]
+        if not on_property:
+            continue
+        estimate = index.estimate(on_property)
+        if estimate is not None and (best_estimate is None or estimate < best_estimate):
+            best, best_estimate = (index, on_property), estimate
+    return best
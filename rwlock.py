@@ -0,0 +1,85 @@
+# reader/writer lock, so clients of one tree can read it at the same time while changes go one at a time
+import threading
+from contextlib import contextmanager
+
+class ReadWriteLock:
+    """
+    Lets any number of readers hold the lock at once, or a single writer. Writers are preferred:
+    once one is waiting, new readers wait behind it, so a steady stream of reads cannot starve
+    the mutations. The writer may take the lock again, to read or write, while it holds it.
+    A reader must not take it again, a writer arriving in between would wait on it forever.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = None  # ident of the thread holding the write lock
+        self._depth = 0  # how many times the writer holds it
+        self._waiting_writers = 0
+
+    def acquire_read(self, timeout=None) -> bool:
+        """Waits (up to timeout seconds, forever if None) until no writer holds or waits for the lock,
+        returns False if it gave up"""
+        with self._cond:
+            if self._writer == threading.get_ident():
+                # the writer already keeps everyone else out
+                self._depth += 1
+                return True
+            if not self._cond.wait_for(lambda: self._writer is None and not self._waiting_writers, timeout):
+                return False
+            self._readers += 1
+            return True
+
+    def release_read(self) -> None:
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._release_write()
+                return
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self, timeout=None) -> bool:
+        """Waits (up to timeout seconds, forever if None) until every reader is done,
+        returns False if it gave up"""
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._waiting_writers += 1
+                try:
+                    if not self._cond.wait_for(lambda: self._writer is None and not self._readers, timeout):
+                        return False
+                finally:
+                    self._waiting_writers -= 1
+                    # readers held back by this writer may go if it gave up
+                    self._cond.notify_all()
+                self._writer = me
+            self._depth += 1
+            return True
+
+    def release_write(self) -> None:
+        with self._cond:
+            self._release_write()
+
+    def _release_write(self):
+        self._depth -= 1
+        if not self._depth:
+            self._writer = None
+            self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        """Held by any number of readers at once, while no writer holds or waits for it"""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        """Held by one thread, once every reader is done"""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
@@ -0,0 +1,480 @@
+# serves one DirectoryTree to many clients over a Unix domain socket, and the client that talks to it
+import asyncio
+import contextlib
+import io
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from directory import GLOB_CHARS, Role
+
+# Commands that only read the tree run side by side, the others hold the tree to themselves.
+# walk only moves the client's own session, so it counts as a read
+READ_COMMANDS = frozenset({"help", "?", "cat", "boop", "find", "query", "pawprint", "walk", "carrying", "prowl",
+                           "export", "sync", "stats"})
+# A line starting with this is a request from the client program rather than a command typed by the user,
+# and a line starting with it ends every reply, followed by "ok" or "failed"
+CONTROL = "\0"
+OK = f"{CONTROL}ok\n"
+FAILED = f"{CONTROL}failed\n"
+ROLES = {role.name.lower(): role for role in Role}
+
+# Cheap reads that AsyncCatServer runs on its event loop when no writer holds the tree, see _is_cheap
+INLINE_COMMANDS = frozenset({"help", "?", "cat", "boop", "pawprint", "walk", "carrying"})
+# AsyncCatServer defaults
+MAX_PENDING = 256  # commands waiting for or running on the thread pool, more sessions wait their turn
+IDLE_TIMEOUT = 600.0  # seconds a session may go without sending a command before it is disconnected
+LOCK_TIMEOUT = 10.0  # seconds a command may wait for its turn at the tree before it fails, having done nothing
+SEND_TIMEOUT = 30.0  # seconds a client may leave its reply unread before it is disconnected
+OUTPUT_CHUNK = 1 << 16  # output of a command on the thread pool kept in memory, and sent to its client at a time
+LINE_LIMIT = 1 << 16  # longest command line accepted
+BACKLOG = 1024  # connections waiting to be accepted
+
+def socket_path(name: str) -> str:
+    """Where the server of the cafe called name listens unless told otherwise"""
+    return os.path.join("cafes", f"{name}.sock")
+
+def _is_cheap(tree, args) -> bool:
+    """Whether a command line (split into words) is a read that takes next to no time. find of a
+    plain name is, when the name index answers it. While a cafe opened lazily still has cubbies to
+    read from disk, a command other than help may need to read some, so none is"""
+    if not args:
+        return True
+    command = args[0].lower()
+    if command not in {"help", "?"} and tree._shards is not None and tree._shards.unloaded:
+        return False
+    if command == "find":
+        return len(args) == 2 and tree._name_index is not None and GLOB_CHARS.isdisjoint(args[1])
+    return command in INLINE_COMMANDS
+
+def _claim(path: str) -> None:
+    """Raises RuntimeError if a server is listening on path, and removes a socket file left behind by
+    one that did not shut down cleanly"""
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.remove(path)
+        else:
+            raise RuntimeError(f"A server is already listening on {path}")
+        finally:
+            probe.close()
+
+def execute(tree, run, line: str, timeout=None):
+    """
+    Runs a command line with the tree's rwlock held for reading or writing, as the command needs
+    (see READ_COMMANDS), from its checks to its save, so clients never see or make half a change.
+    Returns False if the command failed, or None without running it if the tree stayed busy for
+    timeout seconds.
+    """
+    args = line.split()
+    reading = args[0].lower() in READ_COMMANDS if args else True
+    lock = tree.rwlock
+    if not (lock.acquire_read(timeout) if reading else lock.acquire_write(timeout)):
+        return None
+    try:
+        return run(tree, line)
+    except ConnectionError:
+        # the client went away, there is nobody to tell
+        raise
+    except Exception as e:
+        print(f"Error: {e}")
+        return False
+    finally:
+        if reading:
+            lock.release_read()
+        else:
+            lock.release_write()
+
+@contextlib.contextmanager
+def _client_output():
+    stdout = sys.stdout
+    output = sys.stdout = ClientOutput(stdout)
+    try:
+        yield output
+    finally:
+        sys.stdout = stdout
+
+class ClientOutput:
+    """
+    Stands in for sys.stdout while serving. What a client's thread prints goes to that client's
+    connection as it is printed, everything else to the real stdout.
+    """
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self._local = threading.local()
+
+    @property
+    def stream(self):
+        return getattr(self._local, "stream", None) or self.stdout
+
+    @stream.setter
+    def stream(self, stream):
+        self._local.stream = stream
+
+    def write(self, text):
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+class CatServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves one tree to any number of clients, each on its own thread with its own Session (cubby,
+    role and carried cats). Commands are parsed by run_command as at the prompt, and run with the
+    tree's rwlock held, see execute. AsyncCatServer serves the same protocol without a thread per
+    client.
+
+    The protocol is lines of UTF-8 text: the client sends its role, then one command per line, and
+    every reply is what the command printed followed by OK or FAILED.
+    """
+    # serve waits for the clients' threads, so no command is cut off halfway when the server stops
+    daemon_threads = False
+    block_on_close = True
+    request_queue_size = BACKLOG
+
+    def __init__(self, tree, path: str, run):
+        """
+            Args:
+            tree (DirectoryTree): The tree to serve
+            path (str): Where the socket is created
+            run: Runs a command line against the tree, run_command(tree, line) -> bool
+        """
+        _claim(path)
+        self.tree = tree
+        self.run = run
+        self.output = None
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        super().__init__(path, ClientHandler)
+
+    def serve(self, poll_interval: float = 0.5):
+        """Serves until shutdown is called (or Ctrl-C), then lets the clients' current commands finish"""
+        with _client_output() as self.output:
+            try:
+                self.serve_forever(poll_interval)
+            finally:
+                with self._connections_lock:
+                    for connection in self._connections:
+                        # the client's next read ends its session, a command already running still gets its reply
+                        with contextlib.suppress(OSError):
+                            connection.shutdown(socket.SHUT_RD)
+                self.server_close()
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.server_address)
+
+    def execute(self, line: str, out) -> bool:
+        """Runs one command line for the calling client, printing to out, returns False if it failed"""
+        self.output.stream = out
+        try:
+            return execute(self.tree, self.run, line)
+        finally:
+            self.output.stream = None
+
+    def complete(self, text: str, out) -> None:
+        with self.tree.rwlock.read():
+            for name in self.tree.complete(text):
+                out.write(f"{name}\n")
+
+class ClientHandler(socketserver.BaseRequestHandler):
+    """One client connection, from its role line until it disconnects"""
+    def setup(self):
+        with self.server._connections_lock:
+            self.server._connections.add(self.request)
+        self.reader = self.request.makefile("r", encoding="utf-8", newline="\n")
+        self.writer = self.request.makefile("w", encoding="utf-8", newline="\n")
+
+    def handle(self):
+        role = ROLES.get(self.reader.readline().strip().lower())
+        try:
+            if role is None:
+                self.writer.write(f"Invalid role, expected one of {', '.join(ROLES)}\n{FAILED}")
+                return
+            self.writer.write(OK)
+            self.writer.flush()
+            with self.server.tree.client_session(role):
+                for line in self.reader:
+                    line = line.rstrip("\n")
+                    if line.startswith(f"{CONTROL}complete "):
+                        self.server.complete(line[len(CONTROL) + len("complete "):], self.writer)
+                        ok = True
+                    elif line.strip().lower() in {"exit", "quit"}:
+                        break
+                    else:
+                        ok = self.server.execute(line, self.writer)
+                    self.writer.write(OK if ok else FAILED)
+                    self.writer.flush()
+        except ConnectionError:
+            # the client went away mid-reply
+            pass
+
+    def finish(self):
+        with self.server._connections_lock:
+            self.server._connections.discard(self.request)
+        with contextlib.suppress(OSError):
+            self.writer.close()
+        self.reader.close()
+
+class AsyncCatServer:
+    """
+    Serves the same protocol as CatServer from one asyncio event loop, so an idle client costs a
+    coroutine rather than a thread. Cheap reads (INLINE_COMMANDS, and find of a plain name) run on
+    the loop when the tree is not being written and has no shards left to read, everything else (searches, queries, mutations and
+    their saves) runs on a thread pool so it cannot stall the other sessions.
+
+    Each session has at most one command in flight and reads nothing more until it is answered.
+    At most max_pending commands wait for or run on the pool, other sessions wait their turn.
+    Output is spooled while a command runs and sent a chunk at a time once it has let go of the
+    tree, so a client that stops reading holds up only its own session, see send_timeout. A session
+    is disconnected after idle_timeout without a command, and a command that waits lock_timeout for
+    its turn at the tree fails without doing anything.
+    """
+    def __init__(self, tree, path: str, run, workers=None, max_pending: int = MAX_PENDING,
+                 idle_timeout: float = IDLE_TIMEOUT, lock_timeout: float = LOCK_TIMEOUT, send_timeout: float = SEND_TIMEOUT):
+        """
+            Args:
+            tree (DirectoryTree): The tree to serve
+            path (str): Where the socket is created, clients can connect as soon as this returns
+            run: Runs a command line against the tree, run_command(tree, line) -> bool
+            workers (int): Threads in the pool, ThreadPoolExecutor's default if None
+        """
+        _claim(path)
+        self.tree = tree
+        self.path = path
+        self.run = run
+        self.workers = workers
+        self.max_pending = max_pending
+        self.idle_timeout = idle_timeout
+        self.lock_timeout = lock_timeout
+        self.send_timeout = send_timeout
+        self.output = None
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.bind(path)
+            self._socket.listen(BACKLOG)
+        except OSError:
+            self._socket.close()
+            raise
+        self._loop = None
+        self._stop = None
+        self._shutdown_requested = threading.Event()
+        self._stopped = threading.Event()
+        self._closing = False
+        self._sessions = set()  # session tasks
+        self._idle = set()  # session tasks waiting for their client's next line
+
+    def serve(self):
+        """Serves until shutdown is called (or Ctrl-C), then lets the commands in progress finish"""
+        try:
+            with _client_output() as self.output:
+                asyncio.run(self._serve())
+        finally:
+            self._socket.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+            self._stopped.set()
+
+    def shutdown(self):
+        """Tells serve to stop, from another thread, and waits until it has"""
+        self._shutdown_requested.set()
+        loop = self._loop
+        if loop is not None:
+            with contextlib.suppress(RuntimeError):
+                loop.call_soon_threadsafe(self._stop.set)
+        self._stopped.wait()
+
+    async def _serve(self):
+        self._stop = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        if self._shutdown_requested.is_set():
+            self._stop.set()
+        self._pending = asyncio.Semaphore(self.max_pending)
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="catfs-session")
+        server = await asyncio.start_unix_server(self._session, sock=self._socket, limit=LINE_LIMIT, backlog=BACKLOG)
+        try:
+            await self._stop.wait()
+        finally:
+            server.close()
+            self._closing = True
+            # sessions waiting for a line end now, the others once their command is answered
+            for task in self._idle:
+                task.cancel()
+            await asyncio.gather(*self._sessions, return_exceptions=True)
+            self._executor.shutdown()
+
+    async def _session(self, reader, writer):
+        task = asyncio.current_task()
+        self._sessions.add(task)
+        session = None
+        try:
+            role = ROLES.get((await self._read_line(reader) or "").strip().lower())
+            if role is None:
+                await self._send(writer, f"Invalid role, expected one of {', '.join(ROLES)}\n{FAILED}")
+                return
+            # opening and closing sessions takes the tree's locks, which a save may hold for a while
+            session = await self._loop.run_in_executor(self._executor, self.tree.open_session, role)
+            await self._send(writer, OK)
+            while not self._closing:
+                line = await self._read_line(reader)
+                if line is None or line.strip().lower() in {"exit", "quit"}:
+                    break
+                if line.startswith(f"{CONTROL}complete "):
+                    names = await self._offload(self._complete, session, line[len(CONTROL) + len("complete "):])
+                    await self._send(writer, "".join(f"{name}\n" for name in names) + OK)
+                else:
+                    await self._command(session, line, writer)
+        except ConnectionError:
+            # the client went away, or stopped reading its replies
+            writer.transport.abort()
+        finally:
+            self._sessions.discard(task)
+            if session is not None:
+                await self._loop.run_in_executor(self._executor, self.tree.close_session, session)
+            writer.close()
+
+    async def _read_line(self, reader):
+        """The client's next line, or None once it disconnects, sends too long a line or idles for idle_timeout"""
+        task = asyncio.current_task()
+        self._idle.add(task)
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        except (TimeoutError, ValueError):
+            return None
+        except asyncio.CancelledError:
+            if not self._closing:
+                raise
+            # the server is stopping, which ends the session as if the client had left
+            task.uncancel()
+            return None
+        finally:
+            self._idle.discard(task)
+        return line.decode("utf-8", "replace").rstrip("\n") if line else None
+
+    async def _send(self, writer, text: str):
+        writer.write(text.encode("utf-8"))
+        if not writer.transport.get_write_buffer_size():
+            # the socket took all of it
+            return
+        try:
+            await asyncio.wait_for(writer.drain(), self.send_timeout)
+        except TimeoutError:
+            raise ConnectionError(f"The client left its reply unread for {self.send_timeout:g}s") from None
+
+    async def _offload(self, function, *args):
+        """Runs function on the thread pool, once fewer than max_pending commands are waiting for it"""
+        async with self._pending:
+            return await self._loop.run_in_executor(self._executor, function, *args)
+
+    async def _command(self, session, line: str, writer):
+        if _is_cheap(self.tree, line.split()):
+            out = io.StringIO()
+            ok = self._execute(session, line, out, timeout=0)
+            if ok is not None:
+                await self._send(writer, out.getvalue() + (OK if ok else FAILED))
+                return
+            # a writer has the tree, wait for it on the pool rather than on the loop
+        out = _LoopOutput()
+        try:
+            ok = await self._offload(self._execute, session, line, out, self.lock_timeout)
+            if ok is None:
+                await self._send(writer, f"The cafe was busy for {self.lock_timeout:g}s, nothing was done\n{FAILED}")
+                return
+            out.seek(0)
+            while True:
+                chunk = out.read(OUTPUT_CHUNK)
+                if not chunk:
+                    break
+                await self._send(writer, chunk)
+            await self._send(writer, OK if ok else FAILED)
+        finally:
+            out.close()
+
+    def _execute(self, session, line: str, out, timeout):
+        with self.tree.using_session(session):
+            self.output.stream = out
+            try:
+                return execute(self.tree, self.run, line, timeout)
+            finally:
+                self.output.stream = None
+
+    def _complete(self, session, text: str) -> list:
+        with self.tree.using_session(session):
+            if not self.tree.rwlock.acquire_read(self.lock_timeout):
+                return []
+            try:
+                return self.tree.complete(text)
+            finally:
+                self.tree.rwlock.release_read()
+
+class _LoopOutput(tempfile.SpooledTemporaryFile):
+    """Where a command on AsyncCatServer's thread pool prints. The text stays in memory up to
+    OUTPUT_CHUNK and moves to a temporary file past that, to be sent after the command is done"""
+    def __init__(self):
+        super().__init__(OUTPUT_CHUNK, mode="w+", encoding="utf-8", errors="replace")
+
+class CatClient:
+    """
+    A connection to a CatServer or AsyncCatServer. It stands in for the tree in main's command_prompt
+    and run_script (pass run=CatClient.run_command): each line is sent as typed, parsed on the
+    server, and what the command printed there is printed here.
+    """
+    # transactions are refused by the server, so the client is never in one
+    in_transaction = False
+
+    def __init__(self, path: str, role: str = "visitor"):
+        """
+            Args:
+            path (str): The server's socket
+            role (str): visitor, volunteer, staff or admin
+        Raises OSError if nobody is listening on path, and ValueError if the server refuses the role
+        """
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(path)
+        except OSError:
+            self._socket.close()
+            raise
+        self._reader = self._socket.makefile("r", encoding="utf-8", newline="\n")
+        self._writer = self._socket.makefile("w", encoding="utf-8", newline="\n")
+        refusal = []
+        if not self.send(role, refusal.append):
+            self.close()
+            raise ValueError("".join(refusal).strip())
+
+    def send(self, line: str, write) -> bool:
+        """Sends one line and passes each line of the reply to write, returns False if the command failed"""
+        self._writer.write(f"{line}\n")
+        self._writer.flush()
+        for reply in self._reader:
+            if reply.startswith(CONTROL):
+                return reply == OK
+            write(reply)
+        raise ConnectionError("The server closed the connection")
+
+    def run_command(self, user_input: str) -> bool:
+        """Runs a command line on the server and prints its output, returns False if the command failed."""
+        return self.send(user_input.replace("\n", " "), sys.stdout.write)
+
+    def complete(self, text: str) -> list:
+        names = []
+        self.send(f"{CONTROL}complete {text}", names.append)
+        return [name.rstrip("\n") for name in names]
+
+    def deferred_saves(self):
+        # the server saves after each command, as it would for any client
+        return contextlib.nullcontext(self)
+
+    def close(self) -> None:
+        for f in (self._writer, self._reader, self._socket):
+            with contextlib.suppress(OSError):
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,331 @@
+# a cafe stored as a directory of shards, one per cubby, so a save only rewrites the cubbies that changed
+#
+#   manifest       JSON: layout version, cafe name, root cubby's name, journal sequence number, next shard id
+#   <id>.shard     one cubby's children in prowl order and its parent's id, see storage.encode_shard.
+#                  The root's id is 0
+#   carried.shard  the carried cats
+#   names-<n>.idx  bucket n of the name index: for each cat name hashed to n, the shards holding it
+#   commit         JSON, only there while a save is being installed
+#
+# A save writes each changed shard and name bucket to <file>.tmp, then the commit record naming
+# them along with the new manifest, then moves them into place and removes the record. Each step is
+# synced to disk (files and the directory) before the next one starts. Writing the
+# record is the atomic step: a save interrupted before it leaves the previous files as they were,
+# one interrupted after it is finished when the cafe is next opened. Either way the shards of one
+# save (the cubby a cat was put in and the carried cats, say) are seen together or not at all.
+#
+# A cafe can be opened lazily: only the manifest is read, and each cubby's shard is read the first
+# time its children are needed (see FolderNode.__getattr__). find looks a name up in the name index
+# and reads just the shards holding it, and the cubbies above them.
+import contextlib
+import gc
+import json
+import os
+import threading
+import zlib
+from collections import defaultdict
+from storage import (PARENT_NONE, CafeFormatError, encode_name_bucket, encode_shard, read_name_bucket, read_shard,
+                     read_shard_summary, sync_directory, write_cafe, write_synced)
+
+# 1: the first layout, without the name index or parent ids. Opening one rewrites it
+SHARDS_VERSION = 2
+ROOT_SHARD = 0
+MANIFEST = "manifest"
+COMMIT = "commit"
+CARRIED = "carried.shard"
+# Buckets of the name index, a save rewrites the buckets of the names it added or removed
+NAME_BUCKETS = 1024
+
+def name_bucket(name: str) -> int:
+    """The name index bucket of a cat name, the same in every process unlike hash()"""
+    return zlib.crc32(name.encode("utf-8", "surrogatepass")) % NAME_BUCKETS
+
+class PendingSave:
+    """The encoded shards of one save, from ShardStore.encode to ShardStore.write"""
+    __slots__ = ("shards", "folders", "carried", "names", "rebuild_names", "root_name")
+    def __init__(self, shards, folders, carried, names, rebuild_names, root_name):
+        self.shards = shards  # file name -> contents
+        self.folders = folders  # the cubbies encoded
+        self.carried = carried  # whether the carried cats were
+        self.names = names  # shard id -> names of the cats in it now, for the name index
+        self.rebuild_names = rebuild_names  # whether names covers every shard and the index is rebuilt from it
+        self.root_name = root_name
+
+class ShardStore:
+    """
+    The shards of one cafe and which of them are out of date. Mutations add the cubbies they change
+    to dirty, and set carried_dirty when the carried cats change, while holding the tree's lock.
+    Each save then encodes just those, so its cost follows the size of the cubbies touched rather
+    than the size of the cafe.
+    """
+    def __init__(self, directory: str):
+        """
+            Args:
+            directory (str): Where the shards live, created by the first save
+        """
+        self.directory = directory
+        self.ids = {}  # cubby -> its shard id, once it has one
+        self.by_id = {}  # shard id -> cubby, for the cubbies known so far
+        self.next_id = ROOT_SHARD
+        self.dirty = set()
+        self.carried_dirty = False
+        self.rebuild_names = False
+        self.outdated = False  # opened from an older layout, which the next save rewrites
+        self.unloaded = set()  # cubbies whose shard has not been read yet
+        self.on_load = None  # called with each cubby once its shard is read, still holding _load_lock
+        self.shards_read = 0
+        self._load_lock = threading.Lock()
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        """Whether a cafe was saved in directory, possibly by a save that has yet to be finished"""
+        return os.path.exists(os.path.join(directory, MANIFEST)) or os.path.exists(os.path.join(directory, COMMIT))
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def _shard_path(self, shard_id: int) -> str:
+        return self._path(f"{shard_id}.shard")
+
+    def mark_all(self, root) -> None:
+        """Makes the next save write every shard and the whole name index, into a directory that has neither yet"""
+        self.ids = {}
+        self.by_id = {}
+        self.next_id = ROOT_SHARD
+        self.dirty = {root}
+        self.carried_dirty = True
+        self.rebuild_names = True
+
+    def _assign_id(self, folder) -> int:
+        shard_id = self.ids[folder] = self.next_id
+        self.by_id[shard_id] = folder
+        self.next_id += 1
+        return shard_id
+
+    def encode(self, root, carried_cats) -> PendingSave:
+        """
+        Encodes every dirty shard and clears the marks, call while holding the tree's lock. A cubby
+        without a shard yet gets one when its parent is encoded, along with every cubby under it.
+        A dirty cubby without a shard that is no longer in the tree (a transaction was aborted)
+        is dropped.
+        """
+        if root not in self.ids:
+            self._assign_id(root)
+        folders, self.dirty = self.dirty, set()
+        carried, self.carried_dirty = self.carried_dirty, False
+        rebuild_names, self.rebuild_names = self.rebuild_names, False
+        shards = {}
+        names = {}
+        pending = [folder for folder in folders if folder in self.ids]
+        while pending:
+            folder = pending.pop()
+            cubby_ids = []
+            cat_names = []
+            for child in folder.children:
+                if child.is_file:
+                    cat_names.append(child.name)
+                    continue
+                shard_id = self.ids.get(child)
+                if shard_id is None:
+                    shard_id = self._assign_id(child)
+                    folders.add(child)
+                    pending.append(child)
+                cubby_ids.append(shard_id)
+            shard_id = self.ids[folder]
+            parent_id = PARENT_NONE if folder is root else self.ids[folder.parent]
+            shards[f"{shard_id}.shard"] = encode_shard(folder.children, cubby_ids, parent_id)
+            names[shard_id] = cat_names
+        if carried:
+            shards[CARRIED] = encode_shard(carried_cats, [])
+        return PendingSave(shards, folders, carried, names, rebuild_names, root.name)
+
+    def write(self, save: PendingSave, meta: dict) -> None:
+        """
+        Installs an encoded save, atomically (see the top of this file). If it fails, what it
+        encoded is marked dirty again, so the next save writes it.
+            Args:
+            save (PendingSave): From encode
+            meta (dict): JSON-serializable values to store in the manifest
+        """
+        manifest = dict(meta, format=SHARDS_VERSION, root=save.root_name, next_shard=self.next_id)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # a save that failed after its commit record was written goes in first
+            self.recover()
+            files = dict(save.shards)
+            files.update(self._name_buckets(save))
+            for filename, data in files.items():
+                write_synced(self._path(filename) + ".tmp", data)
+            # the files the record names are on disk before it is
+            sync_directory(self.directory)
+            record = {"files": list(files), "manifest": manifest}
+            write_cafe(self._path(COMMIT), json.dumps(record).encode("utf-8"))
+            self._install(record)
+        except BaseException:
+            # a set update is a single step, so this does not race with mutations adding to dirty
+            self.dirty.update(save.folders)
+            self.carried_dirty |= save.carried
+            self.rebuild_names |= save.rebuild_names
+            raise
+
+    def _name_buckets(self, save: PendingSave) -> dict:
+        """The name index buckets the save changes, encoded. What a shard held before is read back
+        from its file, so this costs about as much as writing the shard did"""
+        changes = defaultdict(list)  # bucket -> [(name, shard id, whether it is now there)]
+        for shard_id, cat_names in save.names.items():
+            now = set(cat_names)
+            before = set()
+            if not save.rebuild_names and os.path.exists(self._shard_path(shard_id)):
+                before = set(read_shard_summary(self._shard_path(shard_id))[1])
+            for name in now - before:
+                changes[name_bucket(name)].append((name, shard_id, True))
+            for name in before - now:
+                changes[name_bucket(name)].append((name, shard_id, False))
+        buckets = {}
+        for bucket, bucket_changes in changes.items():
+            entries = {} if save.rebuild_names else self._read_bucket(bucket)
+            for name, shard_id, present in bucket_changes:
+                shard_ids = entries.setdefault(name, [])
+                if present:
+                    shard_ids.append(shard_id)
+                elif shard_id in shard_ids:
+                    shard_ids.remove(shard_id)
+                    if not shard_ids:
+                        del entries[name]
+            buckets[f"names-{bucket}.idx"] = encode_name_bucket(entries)
+        return buckets
+
+    def _read_bucket(self, bucket: int) -> dict:
+        path = self._path(f"names-{bucket}.idx")
+        return read_name_bucket(path) if os.path.exists(path) else {}
+
+    def _install(self, record: dict) -> None:
+        # records of the first layout called the list "shards"
+        for filename in record.get("files", record.get("shards")):
+            tmp_path = self._path(filename) + ".tmp"
+            if os.path.exists(tmp_path):
+                os.replace(tmp_path, self._path(filename))
+        # syncs the renames above along with its own, before the record that would redo them goes
+        write_cafe(self._path(MANIFEST), json.dumps(record["manifest"]).encode("utf-8"))
+        os.remove(self._path(COMMIT))
+        sync_directory(self.directory)
+
+    def recover(self) -> None:
+        """Finishes a save interrupted after its commit record was written, and throws away the
+        files of one interrupted before"""
+        if os.path.exists(self._path(COMMIT)):
+            with open(self._path(COMMIT), "rb") as f:
+                self._install(json.load(f))
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".tmp"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._path(filename))
+
+    def load(self, lazy: bool = False):
+        """
+        Opens the cafe. Eagerly every shard is read, from the root down, otherwise none is until
+        its cubby's children are first needed (a cafe of the first layout is always read eagerly).
+        Returns:
+            tuple: (root FolderNode, list of carried cats, manifest dict)
+        """
+        from directory import FolderNode
+
+        self.recover()
+        with open(self._path(MANIFEST), "rb") as f:
+            manifest = json.load(f)
+        version = manifest["format"]
+        if version > SHARDS_VERSION:
+            raise CafeFormatError(f"{self.directory} uses layout version {version}, this CatFS only reads up to {SHARDS_VERSION}")
+        root = FolderNode(manifest["root"])
+        self.ids = {root: ROOT_SHARD}
+        self.by_id = {ROOT_SHARD: root}
+        self.next_id = manifest["next_shard"]
+        self.dirty = set()
+        self.carried_dirty = False
+        self.outdated = version < SHARDS_VERSION
+        has_parent = not self.outdated
+        carried_path = self._path(CARRIED)
+        carried_cats = read_shard(carried_path, has_parent=has_parent)[0] if os.path.exists(carried_path) else []
+        if lazy and not self.outdated:
+            self._make_lazy(root)
+            return root, carried_cats, manifest
+        # Millions of new objects would set off the cyclic garbage collector over and over, for nothing
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            folders = [root]
+            # breadth first, the list grows as it is walked so deep cafes need no recursion
+            for folder in folders:
+                folders.extend(self._read_children(folder, has_parent))
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        if self.outdated:
+            self.mark_all(root)
+        return root, carried_cats, manifest
+
+    def _read_children(self, folder, has_parent: bool = True, lazy: bool = False) -> list:
+        """Reads folder's shard into it, returns its child cubbies, whose shards are left unread if lazy"""
+        path = self._shard_path(self.ids[folder])
+        if not os.path.exists(path):
+            raise CafeFormatError(f"{path} is missing, {self.directory} is incomplete")
+        children, cubby_ids, _ = read_shard(path, folder, has_parent)
+        self.shards_read += 1
+        cubbies = [child for child in children if not child.is_file]
+        for cubby, shard_id in zip(cubbies, cubby_ids):
+            self.ids[cubby] = shard_id
+            self.by_id[shard_id] = cubby
+        if lazy:
+            for cubby in cubbies:
+                cubby._store = self
+            self.unloaded.update(cubbies)
+        # other threads read the children without taking _load_lock, so they are set once the cubbies are ready
+        folder._fill(children)
+        return cubbies
+
+    def _make_lazy(self, folder) -> None:
+        # the slots holding the children stay unset until load_children fills them
+        folder._store = self
+        del folder._children, folder._by_name
+        self.unloaded.add(folder)
+
+    def load_children(self, folder) -> None:
+        """Reads the shard of a cubby opened lazily, if no other thread has yet"""
+        with self._load_lock:
+            if folder not in self.unloaded:
+                return
+            self._read_children(folder, lazy=True)
+            del folder._store
+            if self.on_load is not None:
+                self.on_load(folder)
+            # only now may other threads see the cubby as loaded
+            self.unloaded.discard(folder)
+
+    def load_name(self, name: str) -> None:
+        """Reads the shards the name index lists for name, and the cubbies above them, so every cat
+        called name is in memory. Cubbies already read are up to date in memory and are skipped"""
+        if not self.unloaded:
+            return
+        for shard_id in self._read_bucket(name_bucket(name)).get(name, ()):
+            folder = self._locate(shard_id)
+            if folder is not None:
+                self.load_children(folder)
+
+    def _locate(self, shard_id: int):
+        """The cubby stored in shard_id, reading the cubbies above it (top down) until it is known"""
+        chain = []
+        while shard_id not in self.by_id:
+            path = self._shard_path(shard_id)
+            if not os.path.exists(path):
+                return None
+            chain.append(shard_id)
+            shard_id = read_shard_summary(path)[0]
+            if shard_id == PARENT_NONE:
+                raise CafeFormatError(f"{path} is corrupt, it is not under the root")
+        folder = self.by_id[shard_id]
+        for child_id in reversed(chain):
+            self.load_children(folder)
+            folder = self.by_id.get(child_id)
+            if folder is None:
+                raise CafeFormatError(f"{self._shard_path(child_id)} is corrupt, its parent does not hold it")
+        return folder
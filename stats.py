@@ -0,0 +1,82 @@
+# latency instrumentation for DirectoryTree commands
+import functools
+import math
+import time
+
+class LatencyHistogram:
+    """
+    A fixed-size histogram of latencies with logarithmic buckets (BUCKETS_PER_DECADE per
+    power of ten, from 1 microsecond up), so memory stays constant however many samples
+    are recorded and percentiles are accurate to within one bucket (~12%).
+    """
+    BUCKETS_PER_DECADE = 20
+    MIN_SECONDS = 1e-6
+    NUM_BUCKETS = BUCKETS_PER_DECADE * 9  # 1us .. 1000s
+
+    def __init__(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        """
+        Args:
+            seconds (float): How long the operation took
+        """
+        if seconds <= self.MIN_SECONDS:
+            bucket = 0
+        else:
+            bucket = min(self.NUM_BUCKETS - 1, int(math.log10(seconds / self.MIN_SECONDS) * self.BUCKETS_PER_DECADE))
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        """
+        Args:
+            p (float): Percentile between 0 and 100
+        Returns:
+            float: Upper bound (seconds) of the bucket holding the p-th percentile sample
+        """
+        if self.count == 0:
+            return 0.0
+        rank = math.ceil(self.count * p / 100) or 1
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(self.max, self.MIN_SECONDS * 10 ** ((bucket + 1) / self.BUCKETS_PER_DECADE))
+        return self.max
+
+    def summary(self) -> dict:
+        """
+        Returns:
+            dict: Sample count and mean/p50/p95/p99/max latencies in milliseconds
+        """
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1e3 if self.count else 0.0,
+            "p50_ms": self.percentile(50) * 1e3,
+            "p95_ms": self.percentile(95) * 1e3,
+            "p99_ms": self.percentile(99) * 1e3,
+            "max_ms": self.max * 1e3,
+        }
+
+def timed(method):
+    """Decorates a DirectoryTree command so each call is recorded in the tree's latency histograms"""
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            histogram = self.latencies.get(name)
+            if histogram is None:
+                histogram = self.latencies[name] = LatencyHistogram()
+            histogram.record(time.perf_counter() - start)
+    return wrapper
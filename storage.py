@@ -0,0 +1,395 @@
+# compact, versioned on-disk format for cafes
+#
+# A cafe file is a small header followed by length-prefixed sections. Nodes are numbered in
+# breadth-first order (root is 0), so every node's parent has a smaller id and the children of
+# each cubby are a contiguous run, in prowl order. Cats' roles and properties are stored as
+# columns. Both directions are flat loops over that numbering, with no recursion, so save and
+# load stay linear however deep the tree is.
+#
+#   header      MAGIC, FORMAT_VERSION
+#   meta        JSON: cafe name, journal sequence number, node counts
+#   kinds       one byte per node, KIND_FOLDER or KIND_FILE
+#   parents     int32 per node: parent id, PARENT_NONE for the root, PARENT_CARRIED for carried cats
+#   names       string table, one per node
+#   roles       one byte per cat, its required Role value
+#   prop tags   one byte per cat per property, a column per property in CAT_PROPERTIES order
+#   prop values string table of the property values that are not None, in the same order
+#
+# A string table is its string count and a mode byte, then the strings joined by NUL, or
+# (if any of them contains NUL) their lengths followed by the concatenated strings.
+#
+# Carried cats come after the tree's nodes. Session state (current cubby, role, cache,
+# statistics) is deliberately not stored.
+#
+# A shard of a sharded cafe (see shards.py) has the same header, followed by the sections
+# describing one cubby's children in prowl order:
+#
+#   kinds       one byte per child
+#   shard ids   int64: the parent cubby's shard (PARENT_NONE for the root and the carried cats),
+#               then one per child cubby, the shard holding that cubby's own children.
+#               Shards of the first sharded layout (see shards.SHARDS_VERSION) have no parent
+#   names, roles, prop tags, prop values   as above
+#
+# A bucket of a sharded cafe's name index is the same header followed by a string table of cat
+# names and an int64 per name, the shard of a cubby holding a cat of that name.
+import gc
+import json
+import os
+import struct
+import sys
+from array import array
+from collections import Counter, deque
+from itertools import accumulate, compress, islice, repeat
+from operator import attrgetter
+
+MAGIC = b"CATFS"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<5sH")
+_SECTION = struct.Struct("<Q")
+
+KIND_FOLDER = 0
+KIND_FILE = 1
+PARENT_NONE = -1
+PARENT_CARRIED = -2
+
+TAG_NONE = 0
+TAG_STR = 1
+TAG_INT = 2
+TAG_FLOAT = 3
+TAG_BOOL = 4
+
+class CafeFormatError(Exception):
+    """Raised when a cafe file is not in a format this version can read"""
+
+def _array_bytes(values: array) -> bytes:
+    # sections are always little-endian
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def _array_from(typecode: str, data: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+_STRING_TABLE = struct.Struct("<IB")
+_SEPARATED = 0     # the strings joined by NUL, the fast case
+_LENGTH_PREFIXED = 1  # uint32 lengths (in code points) then the strings, for strings that contain NUL
+
+def _string_table(strings) -> bytes:
+    """Encodes a list of strings as a single section"""
+    text = "\0".join(strings)
+    if text.count("\0") == max(len(strings) - 1, 0):
+        return _STRING_TABLE.pack(len(strings), _SEPARATED) + text.encode("utf-8")
+    lengths = _array_bytes(array("I", map(len, strings)))
+    return _STRING_TABLE.pack(len(strings), _LENGTH_PREFIXED) + lengths + "".join(strings).encode("utf-8")
+
+def _read_string_table(section: bytes) -> list:
+    count, mode = _STRING_TABLE.unpack_from(section)
+    if count == 0:
+        return []
+    if mode == _SEPARATED:
+        return section[_STRING_TABLE.size:].decode("utf-8").split("\0")
+    text_start = _STRING_TABLE.size + 4 * count
+    ends = list(accumulate(_array_from("I", section[_STRING_TABLE.size:text_start])))
+    text = section[text_start:].decode("utf-8")
+    return [text[start:end] for start, end in zip([0] + ends, ends)]
+
+def _encode_value(value):
+    """Returns (tag, text) for a property value"""
+    if value is None:
+        return TAG_NONE, None
+    if isinstance(value, bool):
+        return TAG_BOOL, "1" if value else "0"
+    if isinstance(value, int):
+        return TAG_INT, str(value)
+    if isinstance(value, float):
+        return TAG_FLOAT, repr(value)
+    return TAG_STR, str(value)
+
+_DECODERS = {TAG_STR: str, TAG_INT: int, TAG_FLOAT: float, TAG_BOOL: lambda text: text == "1"}
+
+def _encode_column(column):
+    """Returns (tags, texts) for one property of every cat"""
+    if all(value is None or type(value) is str for value in column):
+        # the common case, everything set from the command line is a string
+        return bytes(TAG_NONE if value is None else TAG_STR for value in column), [v for v in column if v is not None]
+    encoded = [_encode_value(value) for value in column]
+    return bytes(tag for tag, _ in encoded), [text for _, text in encoded if text is not None]
+
+def _decode_column(tags, texts):
+    """Inverse of _encode_column, texts is consumed from the front"""
+    present = len(tags) - tags.count(TAG_NONE)
+    values = list(islice(texts, present))
+    for tag in (TAG_STR, TAG_INT, TAG_FLOAT, TAG_BOOL):
+        if tags.count(tag) == present:
+            # a single type in the whole column
+            if tag != TAG_STR:
+                values = list(map(_DECODERS[tag], values))
+            break
+    else:
+        values = [_DECODERS[tag](text) for tag, text in zip((t for t in tags if t != TAG_NONE), values)]
+    if present == len(tags):
+        return values
+    column = [None] * len(tags)
+    for i, value in zip((i for i, tag in enumerate(tags) if tag != TAG_NONE), values):
+        column[i] = value
+    return column
+
+def _set_column(nodes, slot, values) -> None:
+    """Sets one slot on every node, the loop runs in C via the slot's descriptor"""
+    deque(map(slot.__set__, nodes, values), maxlen=0)
+
+def _node_sections(nodes, changed=None) -> list:
+    """
+    The kinds, names, roles, prop tags and prop values sections describing nodes, in that order.
+    changed, if given, is called once every value has been read, and returns {node: copy} for the
+    nodes that may have changed meanwhile: their copies' values are used instead.
+    """
+    from directory import CAT_PROPERTIES, Role
+
+    kinds = bytes(KIND_FILE if node.is_file else KIND_FOLDER for node in nodes)
+    files = [node for node in nodes if node.is_file]
+    role_values = {role: role.value for role in Role}
+    names = list(map(attrgetter("name"), nodes))
+    roles = list(map(attrgetter("required_role"), files))
+    columns = [list(map(attrgetter(property_name), files)) for property_name in CAT_PROPERTIES]
+    copies = changed() if changed is not None else None
+    if copies:
+        for i, copy in enumerate(map(copies.get, nodes)):
+            if copy is not None:
+                names[i] = copy.name
+        for i, copy in enumerate(map(copies.get, files)):
+            if copy is not None:
+                roles[i] = copy.required_role
+                for column, property_name in zip(columns, CAT_PROPERTIES):
+                    column[i] = getattr(copy, property_name)
+    sections = [kinds, _string_table(names)]
+    sections.append(bytes(map(role_values.__getitem__, roles)))
+    tags = []
+    texts = []
+    for column in columns:
+        column_tags, column_texts = _encode_column(column)
+        tags.append(column_tags)
+        texts += column_texts
+    sections.append(b"".join(tags))
+    sections.append(_string_table(texts))
+    return sections
+
+def _nodes_from_sections(kinds, name_table, roles, tags, value_table) -> list:
+    """Inverse of _node_sections. The nodes get their names and cat fields but no parents or
+    children yet, call with the garbage collector disabled"""
+    from directory import CAT_PROPERTIES, BaseNode, FileNode, FolderNode, Role
+
+    # Nodes are created empty and filled in a column at a time, which is much faster than node by node
+    node_classes = {KIND_FOLDER: FolderNode, KIND_FILE: FileNode}
+    nodes = list(map(object.__new__, map(node_classes.__getitem__, kinds)))
+    _set_column(nodes, BaseNode.name, _read_string_table(name_table))
+    _set_column(nodes, BaseNode._wd, repeat(None, len(nodes)))
+    files = list(compress(nodes, kinds))  # KIND_FILE is the only truthy kind
+    roles_by_value = {role.value: role for role in Role}
+    _set_column(files, FileNode.required_role, map(roles_by_value.__getitem__, roles))
+    texts = iter(_read_string_table(value_table))
+    for column, property_name in enumerate(CAT_PROPERTIES):
+        values = _decode_column(tags[column * len(files):(column + 1) * len(files)], texts)
+        _set_column(files, getattr(FileNode, property_name), values)
+    return nodes
+
+def _pack(sections) -> bytes:
+    chunks = [_HEADER.pack(MAGIC, FORMAT_VERSION)]
+    for section in sections:
+        chunks.append(_SECTION.pack(len(section)))
+        chunks.append(section)
+    return b"".join(chunks)
+
+def _unpack(path: str) -> list:
+    """Reads the sections of a file written by _pack, checking its header"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        raise CafeFormatError(f"{path} is not a cafe file")
+    magic, version = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise CafeFormatError(f"{path} is not a cafe file")
+    if version > FORMAT_VERSION:
+        raise CafeFormatError(f"{path} uses format version {version}, this CatFS only reads up to {FORMAT_VERSION}")
+    sections = []
+    offset = _HEADER.size
+    while offset < len(data):
+        (length,) = _SECTION.unpack_from(data, offset)
+        offset += _SECTION.size
+        sections.append(data[offset:offset + length])
+        offset += length
+    return sections
+
+def encode_cafe(root, carried_cats, meta: dict, snapshot=None) -> bytes:
+    """
+    Args:
+        root (FolderNode): Root cubby of the tree
+        carried_cats (list): Cats currently carried, stored outside the tree
+        meta (dict): JSON-serializable values to store alongside the tree
+        snapshot (SaveSnapshot): To encode the tree as it was when the snapshot was taken, while it is
+            being changed, see DirectoryTree._save
+    Returns:
+        bytes: The contents of a cafe file
+    """
+    nodes = [root]
+    parents = array("i", [PARENT_NONE])
+    index = 0
+    # breadth-first numbering: children are appended after their parent, in prowl order
+    while index < len(nodes):
+        node = nodes[index]
+        if not node.is_file:
+            children = node.children if snapshot is None else snapshot.children(node)
+            nodes.extend(children)
+            parents.extend([index] * len(children))
+        index += 1
+    nodes.extend(carried_cats)
+    parents.extend([PARENT_CARRIED] * len(carried_cats))
+
+    kinds, *columns = _node_sections(nodes, snapshot.changed if snapshot is not None else None)
+    meta_bytes = json.dumps(dict(meta, nodes=len(nodes), carried=len(carried_cats))).encode("utf-8")
+    return _pack([meta_bytes, kinds, _array_bytes(parents), *columns])
+
+def encode_shard(children, cubby_ids, parent_id: int = PARENT_NONE) -> bytes:
+    """
+    Args:
+        children: A cubby's children (or the carried cats), in prowl order
+        cubby_ids (list): The shard id of each child cubby, in the same order
+        parent_id (int): The shard id of the cubby's parent
+    Returns:
+        bytes: The contents of a shard file
+    """
+    kinds, *columns = _node_sections(list(children))
+    ids = array("q", [parent_id])
+    ids.extend(cubby_ids)
+    return _pack([kinds, _array_bytes(ids), *columns])
+
+def encode_name_bucket(entries: dict) -> bytes:
+    """
+    Args:
+        entries (dict): Cat name -> list of the shard ids holding a cat of that name
+    Returns:
+        bytes: The contents of a name index bucket
+    """
+    names = [name for name, shard_ids in entries.items() for _ in shard_ids]
+    ids = array("q", [shard_id for shard_ids in entries.values() for shard_id in shard_ids])
+    return _pack([_string_table(names), _array_bytes(ids)])
+
+def write_cafe(path: str, data: bytes) -> None:
+    """
+    Writes an encoded cafe to path atomically, readers see either the old file or the new one, never a torn one.
+    The file and then the rename are synced to disk before this returns, so a power loss cannot undo it either
+    """
+    tmp_path = path + ".tmp"
+    write_synced(tmp_path, data)
+    os.replace(tmp_path, path)
+    sync_directory(os.path.dirname(path))
+
+def write_synced(path: str, data: bytes) -> None:
+    """Writes data to path and waits until it is on disk"""
+    with open(path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def sync_directory(path: str) -> None:
+    """Waits until the files created, renamed or removed in a directory are on disk. Windows cannot
+    open a directory, and makes renames durable by itself"""
+    if os.name != "posix":
+        return
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_cafe(path: str):
+    """
+    Args:
+        path (str): A file written by write_cafe
+    Returns:
+        tuple: (root FolderNode, list of carried cats, meta dict)
+    """
+    from directory import BaseNode
+
+    meta_bytes, kinds, parent_bytes, name_table, roles, tags, value_table = _unpack(path)
+    meta = json.loads(meta_bytes)
+    parents = _array_from("i", parent_bytes)
+
+    # Millions of new objects would set off the cyclic garbage collector over and over, for nothing
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        nodes = _nodes_from_sections(kinds, name_table, roles, tags, value_table)
+        _set_column(nodes, BaseNode.parent, [nodes[i] if i >= 0 else None for i in parents])
+
+        # Each cubby's children are the next run of nodes, as long as it has children
+        num_tree_nodes = len(nodes) - meta["carried"]
+        child_counts = Counter(parents)
+        start = 1
+        for folder_id, kind in enumerate(kinds[:num_tree_nodes]):
+            if kind == KIND_FOLDER:
+                end = start + child_counts.get(folder_id, 0)
+                folder = nodes[folder_id]
+                folder._children = dict.fromkeys(nodes[start:end])
+                folder._reindex()
+                start = end
+        if start != num_tree_nodes:
+            raise CafeFormatError(f"{path} is corrupt, its nodes are not in breadth-first order")
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return nodes[0], nodes[num_tree_nodes:], meta
+
+def _shard_ids(path, kinds, id_bytes, has_parent):
+    ids = _array_from("q", id_bytes).tolist()
+    parent_id = ids.pop(0) if has_parent else PARENT_NONE
+    if len(ids) != kinds.count(KIND_FOLDER):
+        raise CafeFormatError(f"{path} is corrupt, it has {len(ids)} shard ids for {kinds.count(KIND_FOLDER)} cubbies")
+    return parent_id, ids
+
+def read_shard(path: str, parent=None, has_parent: bool = True):
+    """
+    Args:
+        path (str): A file written from encode_shard
+        parent (FolderNode): Set as every node's parent
+        has_parent (bool): False for a shard of the first sharded layout, which did not store its parent
+    Returns:
+        tuple: (list of nodes, in prowl order, list of the child cubbies' shard ids, the parent's shard id).
+        The cubbies are left without children, for the caller to fill from their own shards
+    """
+    from directory import BaseNode
+
+    kinds, id_bytes, name_table, roles, tags, value_table = _unpack(path)
+    parent_id, cubby_ids = _shard_ids(path, kinds, id_bytes, has_parent)
+    nodes = _nodes_from_sections(kinds, name_table, roles, tags, value_table)
+    _set_column(nodes, BaseNode.parent, repeat(parent, len(nodes)))
+    return nodes, cubby_ids, parent_id
+
+def read_shard_summary(path: str):
+    """
+    Reads a shard without creating its nodes.
+    Returns:
+        tuple: (the parent's shard id, the names of the cats in it)
+    """
+    kinds, id_bytes, name_table = _unpack(path)[:3]
+    parent_id, _ = _shard_ids(path, kinds, id_bytes, True)
+    return parent_id, list(compress(_read_string_table(name_table), kinds))
+
+def read_name_bucket(path: str) -> dict:
+    """Inverse of encode_name_bucket"""
+    name_table, id_bytes = _unpack(path)
+    entries = {}
+    for name, shard_id in zip(_read_string_table(name_table), _array_from("q", id_bytes).tolist()):
+        entries.setdefault(name, []).append(shard_id)
+    return entries
+
+if __name__ == "__main__":
+    # python3 storage.py migrates every legacy cafes/*.pkl to the current format
+    from directory import migrate_pickles
+    for name in migrate_pickles():
+        print(f"Migrated {name}")
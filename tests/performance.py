@@ -1,21 +1,67 @@
 # 100 searches with cache vs without cache
 
+import asyncio
 import os
 import sys
 import time
+import pickle
 import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+from datetime import date, timedelta
 from contextlib import redirect_stdout
 
 
 # Add the parent directory to sys.path to allow imports
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from directory import DirectoryTree, Role
+from directory import CAT_PROPERTIES, DirectoryTree, FileNode, FolderNode, Role
+from bulk import write_records
+from cache import CACHE_POLICIES
+from image import CafeImage
+from main import run_command
+from parallel import ParallelSearch, search
+from query import parse_predicate
+from server import AsyncCatServer, CatClient, CatServer
 
 NUM_LAYERS = 200
 NUM_CATS = 5000
 NUM_SEARCHES = 10000
 REPEATS = 10
 CACHE_SIZES = [0, 100, 500, 1000, 2000, 3000]
+POLICY_CACHE_SIZES = [100, 500, 1000]
+MEMORY_CATS = 100000
+STORAGE_CATS = [10000, 100000, 1000000]
+BACKGROUND_CATS = [1000, 10000, 100000]
+BACKGROUND_RESCUES = 50
+# seconds between the rescues of the paced run, so some of them land while a save is encoding
+BACKGROUND_PACE = 0.005
+SHARD_CATS = [10000, 100000, 1000000]
+SHARD_MUTATIONS = 50
+STARTUP_CATS = [10000, 100000, 1000000]
+IMAGE_CATS = [10000, 100000, 1000000]
+IMAGE_VIEWERS = 16
+VIEWER_LOOKUPS = 1000
+PARALLEL_CATS = 1000000
+PARALLEL_WORKERS = [1, 2, 4, 8]
+PARALLEL_REPEATS = 3
+NUM_WALKS = 20000
+NUM_INTAKE_CHECKS = 2000
+COMPLETION_CATS = 1000000
+NUM_COMPLETIONS = 1000
+QUERY_CATS = 100000
+QUERY_REPEATS = 20
+IMPORT_CATS = [10000, 1000000]
+EXPORT_CATS = [10000, 100000, 1000000]
+SERVER_CATS = 10000
+SERVER_CLIENTS = [1, 4, 16]
+SERVER_REQUESTS = 4000
+LOAD_CLIENTS = [1, 10, 100, 1000]
+LOAD_REQUESTS = 10000
+LOAD_WRITE_SHARE = 0.05
+CATS_PER_CUBBY = 1000
 CATS_PER_LAYER = NUM_CATS // NUM_LAYERS
 
 # Generate a fixed list of cat names
@@ -30,13 +76,21 @@ for i in range(NUM_SEARCHES):
     else:
         SEARCH_SEQUENCE.append(random.choice(CAT_NAMES))
 
+# Scan pollution: a nightly sweep over every cat, interleaved with lookups of the popular ones
+SCAN_SEQUENCE = []
+for i, cat in enumerate(CAT_NAMES * 2):
+    SCAN_SEQUENCE.append(cat)
+    if i % 2 == 0:
+        SCAN_SEQUENCE.append(random.choice(POPULAR_CATS))
+
 # Ensure reproducibility
 random.seed(42)
 
-def build_tree(cache_size):
-    # Use a unique cafe name for each run to avoid pickle conflicts
+def build_tree(cache_size, index=False):
+    # Use a unique cafe name for each run to avoid cafe file conflicts
     cafe_name = f"perf_cafe_{random.randint(0, int(1e9))}"
-    tree = DirectoryTree(name=cafe_name, role=Role.ADMIN, cache_size=cache_size)
+    # The name index is off by default here so the cache is measured against the full DFS
+    tree = DirectoryTree(name=cafe_name, role=Role.ADMIN, cache_size=cache_size, index=index)
     # Build NUM_LAYERS deep, each with one cubby, and distribute cats
     current_path = []
     cat_idx = 0
@@ -54,36 +108,756 @@ def build_tree(cache_size):
     return tree, cafe_name
 
 def run_searches(tree):
-    hits = 0
-    accesses = 0
-    cache = getattr(tree, 'cache', None)
+    # Suppress all output from tree.find by redirecting sys.stdout
     with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
-        if cache:
-            orig_get = cache.get
-            def counting_get(key):
-                nonlocal hits, accesses
-                accesses += 1
-                result = orig_get(key)
-                if result is not None:
-                    hits += 1
-                return result
-            cache.get = counting_get
-            # Suppress all output from tree.find by redirecting sys.stdout
-            for cat in SEARCH_SEQUENCE:
-                tree.find(cat)
-            cache.get = orig_get  # Restore
-        else:
-            for cat in SEARCH_SEQUENCE:
-                tree.find(cat)
-                accesses += 1  # For no-cache, every access is a miss
-    return hits, accesses
+        for cat in SEARCH_SEQUENCE:
+            tree.find(cat)
+    stats = tree.get_stats()
+    if stats["cache"] is None:
+        return 0, stats["find"]["accesses"]  # For no-cache, every access is a miss
+    return stats["cache"]["hits"], stats["cache"]["hits"] + stats["cache"]["misses"]
 
 def cleanup_cafe(cafe_name):
-    pkl_path = os.path.join("cafes", f"{cafe_name}.pkl")
-    if os.path.exists(pkl_path):
-        os.remove(pkl_path)
+    for path in (DirectoryTree.cafe_path(cafe_name), DirectoryTree.image_path(cafe_name), os.path.join("cafes", f"{cafe_name}.pkl")):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(DirectoryTree.shard_path(cafe_name), ignore_errors=True)
+
+def compare_index_vs_dfs():
+    print("Performance Test: CatFS find with the name index vs a full DFS (no cache)")
+    print(f"Tree: {NUM_LAYERS} layers, {NUM_CATS} cats, {NUM_SEARCHES} searches per run, {REPEATS} repeats per config.")
+    print()
+    summary = []
+    for index in (False, True):
+        label = "index" if index else "DFS"
+        total_time = 0.0
+        for repeat in range(REPEATS):
+            tree, cafe_name = build_tree(0, index=index)
+            start = time.time()
+            run_searches(tree)
+            elapsed = time.time() - start
+            total_time += elapsed
+            cleanup_cafe(cafe_name)
+        avg_time = total_time / REPEATS
+        print(f"[{label}] AVG: time={avg_time:.4f}s, per find={avg_time / NUM_SEARCHES * 1e6:.2f}us")
+        summary.append((label, avg_time))
+    dfs_time, index_time = summary[0][1], summary[1][1]
+    print(f"Index speedup over DFS: {dfs_time / (index_time or 1e-9):.1f}x")
+    print()
+
+def compare_cache_policies():
+    print("Performance Test: CatFS find cache eviction policies (name index off)")
+    print(f"Workloads: skewed ({len(SEARCH_SEQUENCE)} finds), scan pollution ({len(SCAN_SEQUENCE)} finds)")
+    print()
+    # One tree for the whole sweep, only the cache is swapped between configs
+    tree, cafe_name = build_tree(0)
+    summary = []
+    for workload, sequence in (("skewed", SEARCH_SEQUENCE), ("scan", SCAN_SEQUENCE)):
+        for policy in CACHE_POLICIES:
+            for cache_size in POLICY_CACHE_SIZES:
+                tree.set_cache_size(cache_size, policy)
+                start = time.time()
+                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                    for cat in sequence:
+                        tree.find(cat)
+                elapsed = time.time() - start
+                hit_rate = tree.cache.stats()["hit_rate"]
+                summary.append((workload, policy, cache_size, elapsed, hit_rate))
+    cleanup_cafe(cafe_name)
+    print(f"{'Workload':>8} | {'Policy':>8} | {'Cache Size':>10} | {'Time (s)':>8} | {'Hit Rate':>8}")
+    print("-"*56)
+    for workload, policy, cache_size, elapsed, hit_rate in summary:
+        print(f"{workload:>8} | {policy:>8} | {cache_size:>10} | {elapsed:8.3f} | {hit_rate:8.3f}")
+    print()
+
+# The node layout before __slots__, kept here only to measure what it cost
+class LegacyFileNode:
+    def __init__(self, name, required_role=Role.STAFF, parent=None):
+        self.name = name
+        self.parent = parent
+        self.is_file = True
+        self.content = {'age': None, 'mood': None, 'date_found': None, 'date_fed': None}
+        self.required_role = required_role
+
+class LegacyFolderNode:
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.is_file = False
+        self.children = []
+        self.dot = self
+        self.dotdot = parent
+
+    def add_child(self, child):
+        self.children.append(child)
+
+def bytes_per_cat(file_cls, folder_cls):
+    """Traced allocations per cat for MEMORY_CATS cats in one cubby, each with two properties set"""
+    names = [f"cat_{i}" for i in range(MEMORY_CATS)]  # allocated up front, names cost the same either way
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    folder = folder_cls("cubby")
+    for name in names:
+        cat = file_cls(name, Role.ADMIN, parent=folder)
+        cat.content["age"] = 3
+        cat.content["mood"] = "sleepy"
+        folder.add_child(cat)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / MEMORY_CATS
+
+def measure_memory():
+    print(f"Memory Test: bytes per cat (tracemalloc, {MEMORY_CATS} cats in one cubby)")
+    legacy = bytes_per_cat(LegacyFileNode, LegacyFolderNode)
+    compact = bytes_per_cat(FileNode, FolderNode)
+    print(f"  dict-based nodes (before): {legacy:8.1f} bytes/cat")
+    print(f"  __slots__ nodes (after):   {compact:8.1f} bytes/cat  (includes the cubby's name index)")
+    print(f"  saved: {legacy - compact:.1f} bytes/cat ({(1 - compact / legacy) * 100:.0f}%)")
+    print()
+
+def build_wide_tree(num_cats, sharded=False):
+    """A cafe with num_cats cats in cubbies of CATS_PER_CUBBY, built directly so only storage is timed"""
+    cafe_name = f"perf_cafe_{random.randint(0, int(1e9))}"
+    tree = DirectoryTree(name=cafe_name, role=Role.ADMIN, sharded=sharded)
+    cubby = None
+    for i in range(num_cats):
+        if i % CATS_PER_CUBBY == 0:
+            cubby = FolderNode(f"cubby_{i // CATS_PER_CUBBY}", tree.root)
+            tree._attach(tree.root, cubby)
+        cat = FileNode(f"cat_{i}", Role.ADMIN, cubby)
+        cat.age = str(i % 20)
+        cat.mood = "sleepy"
+        tree._attach(cubby, cat)
+    return tree, cafe_name
+
+def compare_storage_formats():
+    print("Performance Test: saving and loading a cafe, legacy pickle vs the binary cafe format")
+    print(f"{'Cats':>8} | {'Format':>7} | {'Save (s)':>8} | {'Load (s)':>8} | {'Size (MB)':>9}")
+    print("-"*53)
+    for num_cats in STORAGE_CATS:
+        tree, cafe_name = build_wide_tree(num_cats)
+        legacy_path = os.path.join("cafes", f"{cafe_name}.pkl")
+        start = time.time()
+        with open(legacy_path, "wb") as f:
+            pickle.dump(tree, f)
+        pickle_save = time.time() - start
+        start = time.time()
+        with open(legacy_path, "rb") as f:
+            pickle.load(f)
+        pickle_load = time.time() - start
+        start = time.time()
+        tree._save()
+        cafe_save = time.time() - start
+        start = time.time()
+        DirectoryTree.load(cafe_name)
+        cafe_load = time.time() - start
+        for label, save, load, path in (("pickle", pickle_save, pickle_load, legacy_path),
+                                         ("cafe", cafe_save, cafe_load, tree._path)):
+            size = os.path.getsize(path) / 1e6
+            print(f"{num_cats:>8} | {label:>7} | {save:8.3f} | {load:8.3f} | {size:9.2f}")
+        cleanup_cafe(cafe_name)
+    print()
+
+def compare_background_saves():
+    print(f"Performance Test: rescue latency with a save after every change vs the background writer ({BACKGROUND_RESCUES} rescues)")
+    print(f"{'Cats':>8} | {'Saves':>10} | {'p50 ms':>8} | {'p99 ms':>8} | {'sync ms':>8}")
+    print("-"*56)
+    for num_cats in BACKGROUND_CATS:
+        tree, cafe_name = build_wide_tree(num_cats)
+        for label in ("inline", "background", "paced"):
+            if label == "background":
+                tree.enable_background_saves()
+            tree.latencies = {}
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                for i in range(BACKGROUND_RESCUES):
+                    tree.rescue(f"{label}_{i}", Role.ADMIN)
+                    if label == "paced":
+                        time.sleep(BACKGROUND_PACE)
+                start = time.time()
+                tree.sync()
+            sync_ms = (time.time() - start) * 1e3
+            rescue = tree.get_stats()["commands"]["rescue"]
+            print(f"{num_cats:>8} | {label:>10} | {rescue['p50_ms']:8.3f} | {rescue['p99_ms']:8.3f} | {sync_ms:8.1f}")
+        tree.close()
+        cleanup_cafe(cafe_name)
+    print()
+
+def median_ms(durations):
+    return sorted(durations)[len(durations) // 2] * 1e3
+
+def compare_sharded_saves():
+    print(f"Performance Test: a save after every change, one cafe file vs a shard per cubby "
+          f"({SHARD_MUTATIONS} of each change, {CATS_PER_CUBBY} cats per cubby)")
+    print(f"{'Cats':>8} | {'Layout':>7} | {'First save (s)':>14} | {'rescue ms':>9} | {'carry ms':>8} | {'put ms':>8} | {'Load (s)':>8}")
+    print("-"*81)
+    for num_cats in SHARD_CATS:
+        for sharded in (False, True):
+            tree, cafe_name = build_wide_tree(num_cats, sharded)
+            start = time.perf_counter()
+            tree._save()
+            first_save = time.perf_counter() - start
+            timings = {"rescue": [], "carry": [], "put": []}
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                for i in range(SHARD_MUTATIONS):
+                    tree.walk("/cubby_0")
+                    start = time.perf_counter()
+                    tree.rescue(f"new_{i}", Role.ADMIN)
+                    timings["rescue"].append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    tree._mutate("carry", f"new_{i}")
+                    timings["carry"].append(time.perf_counter() - start)
+                    tree.walk("/cubby_1")
+                    start = time.perf_counter()
+                    tree.put(f"new_{i}")
+                    timings["put"].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            DirectoryTree.load(cafe_name)
+            load = time.perf_counter() - start
+            layout = "shards" if sharded else "file"
+            print(f"{num_cats:>8} | {layout:>7} | {first_save:14.3f} | {median_ms(timings['rescue']):9.3f} | "
+                  f"{median_ms(timings['carry']):8.3f} | {median_ms(timings['put']):8.3f} | {load:8.3f}")
+            tree.close()
+            cleanup_cafe(cafe_name)
+    print()
+
+def compare_startup():
+    print("Performance Test: opening a cafe, one file vs shards read at once vs shards read lazily, "
+          "then the first find and walk")
+    print(f"{'Cats':>8} | {'Layout':>7} | {'Open (s)':>8} | {'find ms':>8} | {'walk+prowl ms':>13} | {'Cubbies read':>12}")
+    print("-"*72)
+    for num_cats in STARTUP_CATS:
+        cubbies = num_cats // CATS_PER_CUBBY
+        for sharded in (False, True):
+            tree, cafe_name = build_wide_tree(num_cats, sharded)
+            tree._save()
+            tree.close()
+            for layout, lazy in ((("shards", False), ("lazy", True)) if sharded else (("file", False),)):
+                start = time.perf_counter()
+                tree = DirectoryTree.load(cafe_name, Role.ADMIN, lazy=lazy)
+                opened = time.perf_counter() - start
+                start = time.perf_counter()
+                tree._find_file_in_tree(f"cat_{num_cats // 2}")
+                find_ms = (time.perf_counter() - start) * 1e3
+                start = time.perf_counter()
+                with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                    tree.walk(f"/cubby_{cubbies - 1}")
+                    tree.prowl()
+                walk_ms = (time.perf_counter() - start) * 1e3
+                read = tree.get_stats()["shards"]["read"] if sharded else cubbies + 1
+                print(f"{num_cats:>8} | {layout:>7} | {opened:8.3f} | {find_ms:8.3f} | {walk_ms:13.3f} | {read:>12}")
+                tree.close()
+            cleanup_cafe(cafe_name)
+    print()
+
+# Run in a fresh process, so its memory is only what opening the cafe and looking cats up cost
+VIEWER_SCRIPT = """
+import os, random, sys, time
+from contextlib import redirect_stdout
+sys.path.insert(0, sys.argv[1])
+from directory import DirectoryTree, ImageTree, Role
+from main import run_command
+name, layout, num_cats, lookups, per_cubby = sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]), int(sys.argv[6])
+start = time.perf_counter()
+tree = ImageTree(name, Role.ADMIN) if layout == "image" else DirectoryTree.load(name, Role.ADMIN)
+opened = time.perf_counter() - start
+rng = random.Random(42)
+start = time.perf_counter()
+with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+    for _ in range(lookups):
+        i = rng.randrange(num_cats)
+        run_command(tree, f"find cat_{i}")
+        run_command(tree, f"walk /cubby_{i // per_cubby}")
+        run_command(tree, f"cat cat_{i}")
+looked_up = time.perf_counter() - start
+status = {}
+if os.path.exists("/proc/self/status"):
+    with open("/proc/self/status") as f:
+        status = dict(line.split(":", 1) for line in f)
+kb = lambda field: int(status[field].split()[0]) if field in status else 0
+print(opened, looked_up / lookups * 1e3, kb("RssAnon"), kb("RssFile"))
+"""
+
+def run_viewer(cafe_name, layout, num_cats):
+    """Opens the cafe in a new process and looks cats up, returns (open s, ms per lookup, private MB, file-backed MB)"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, "-c", VIEWER_SCRIPT, root, cafe_name, layout, str(num_cats),
+                             str(VIEWER_LOOKUPS), str(CATS_PER_CUBBY)], capture_output=True, text=True, check=True).stdout
+    opened, lookup_ms, anon_kb, file_kb = output.split()
+    return float(opened), float(lookup_ms), int(anon_kb) / 1024, int(file_kb) / 1024
+
+def compare_image_viewers():
+    print(f"Performance Test: read-only viewer processes, loading the cafe file vs mapping its image, "
+          f"{VIEWER_LOOKUPS} find+walk+cat lookups each")
+    print(f"{'Cats':>8} | {'Layout':>6} | {'Export (s)':>10} | {'Open (s)':>8} | {'lookup ms':>9} | {'Private MB':>10} | "
+          f"{'Mapped MB':>9} | {f'{IMAGE_VIEWERS} viewers MB':>15}")
+    print("-"*98)
+    for num_cats in IMAGE_CATS:
+        tree, cafe_name = build_wide_tree(num_cats)
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            tree.export_image()
+        exported = time.perf_counter() - start
+        tree._save()
+        tree.close()
+        image_mb = os.path.getsize(DirectoryTree.image_path(cafe_name)) / 1e6
+        for layout in ("file", "image"):
+            opened, lookup_ms, private_mb, file_mb = run_viewer(cafe_name, layout, num_cats)
+            # private memory is per process, the image's pages are one copy in the page cache
+            total_mb = IMAGE_VIEWERS * private_mb + (image_mb if layout == "image" else 0)
+            export = f"{exported:10.3f}" if layout == "image" else f"{'':>10}"
+            print(f"{num_cats:>8} | {layout:>6} | {export} | {opened:8.4f} | {lookup_ms:9.3f} | {private_mb:10.1f} | "
+                  f"{file_mb:9.1f} | {total_mb:15.1f}")
+        cleanup_cafe(cafe_name)
+    print()
+
+def time_search(run):
+    """Median seconds of PARALLEL_REPEATS runs"""
+    durations = []
+    for _ in range(PARALLEL_REPEATS):
+        start = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - start)
+    return median_ms(durations) / 1e3
+
+def compare_parallel_search():
+    print(f"Performance Test: searches that check every cat, {PARALLEL_CATS} cats in {PARALLEL_CATS // CATS_PER_CUBBY} cubbies, "
+          f"sequential vs split across worker processes ({os.cpu_count()} CPUs here)")
+    tree, cafe_name = build_wide_tree(PARALLEL_CATS)
+    # as a tree without the name index, so find has to check every cat too
+    tree._name_index = None
+    last_cat = f"cat_{PARALLEL_CATS - 1}"
+    searches = [("query age>=19", ("query", [parse_predicate("age>=19")]), False),
+                ("find --all *_99*", ("pattern", "*_99*", False), False),
+                (f"find {last_cat}", ("name", last_cat), True)]
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        tree.export_image()
+    print(f"Image written in {time.perf_counter() - start:.2f}s, the tree's snapshot costs the same after each change")
+    path = DirectoryTree.image_path(cafe_name)
+    image = CafeImage(path)
+    print(f"{'Workers':>10} | " + " | ".join(f"{label:>18}" for label, _, _ in searches) + f" | {'Speedup':>7}")
+    print("-"*(13 + 21 * len(searches) + 10))
+    in_tree = [lambda: list(tree.iter_query(["age>=19"])), lambda: list(tree.iter_find("*_99*")),
+               lambda: tree._find_file_in_tree(last_cat)]
+    rows = [("tree", in_tree), ("image", [lambda spec=spec, first=first: search(image, spec, first=first)
+                                          for _, spec, first in searches])]
+    baseline = None
+    for label, runs in rows:
+        seconds = [time_search(run) for run in runs]
+        baseline = baseline or sum(seconds)
+        print(f"{label:>10} | " + " | ".join(f"{s:18.3f}" for s in seconds) + f" | {baseline / sum(seconds):7.2f}")
+    for workers in PARALLEL_WORKERS:
+        pool = ParallelSearch(workers)
+        start = time.perf_counter()
+        pool.search(path, ("name", "nobody"))  # starts the workers
+        started = time.perf_counter() - start
+        seconds = [time_search(lambda spec=spec, first=first: pool.search(path, spec, first=first))
+                   for _, spec, first in searches]
+        print(f"{workers:>10} | " + " | ".join(f"{s:18.3f}" for s in seconds) +
+              f" | {baseline / sum(seconds):7.2f}   (started in {started:.2f}s)")
+        pool.close()
+    image.close()
+    tree.close()
+    cleanup_cafe(cafe_name)
+    print()
+
+def compare_walk_dentries():
+    print("Performance Test: walk with and without the path resolution cache")
+    # absolute paths of the deepest cubbies, plus relative hops back up the tree
+    cubby_paths = ["/" + "/".join(f"cubby_{layer}" for layer in range(depth + 1)) for depth in range(NUM_LAYERS)]
+    rng = random.Random(42)
+    targets = []
+    for _ in range(NUM_WALKS):
+        targets.append(rng.choice(cubby_paths[NUM_LAYERS // 2:]))
+        targets.append("../..")
+    print(f"Tree: {NUM_LAYERS} layers, {len(targets)} walks (absolute paths {NUM_LAYERS // 2}-{NUM_LAYERS} deep, and ../..)")
+    tree, cafe_name = build_tree(0, index=True)
+    for label, size in (("no cache", 0), ("dentries", 1024)):
+        tree.set_dentry_cache_size(size)
+        tree.latencies = {}
+        start = time.time()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            for target in targets:
+                tree.walk(target)
+        elapsed = time.time() - start
+        walk = tree.get_stats()["commands"]["walk"]
+        print(f"[{label:>8}] time={elapsed:.3f}s, per walk={elapsed / len(targets) * 1e6:.2f}us, "
+              f"p99={walk['p99_ms'] * 1e3:.1f}us")
+    print(f"  {tree.get_stats()['dentries']}")
+    cleanup_cafe(cafe_name)
+    print()
+
+def legacy_wd(tree, node):
+    """_get_wd_of_node before paths were memoized: climb to the root every time"""
+    path = []
+    current = node
+    while current is not None and current != tree.root:
+        path.append(current.name)
+        current = current.parent
+    return "/" + "/".join(reversed(path))
+
+def compare_path_memo():
+    print("Performance Test: reporting the paths of every cat, climbing to the root vs memoized paths")
+    tree, cafe_name = build_tree(0, index=True)
+    cats = [tree._find_file_in_tree(name) for name in CAT_NAMES]
+    print(f"Tree: {NUM_LAYERS} layers, {len(cats)} cats, {REPEATS} passes")
+    start = time.time()
+    for _ in range(REPEATS):
+        expected = [legacy_wd(tree, cat) for cat in cats]
+    climb_time = (time.time() - start) / REPEATS
+    start = time.time()
+    paths = [tree._get_wd_of_node(cat) for cat in cats]
+    cold_time = time.time() - start
+    start = time.time()
+    for _ in range(REPEATS):
+        paths = [tree._get_wd_of_node(cat) for cat in cats]
+    warm_time = (time.time() - start) / REPEATS
+    assert paths == expected
+    for label, elapsed in (("climb", climb_time), ("memo, first pass", cold_time), ("memo, warm", warm_time)):
+        print(f"[{label:>16}] per pass={elapsed * 1e3:.2f}ms, per path={elapsed / len(cats) * 1e6:.2f}us")
+    cleanup_cafe(cafe_name)
+    print()
+
+def compare_negative_cache():
+    print("Performance Test: find misses with and without the negative cache (name index off)")
+    # an intake script asks whether each arrival already exists, and most don't
+    rng = random.Random(42)
+    arrivals = [f"arrival_{i}" for i in range(200)]
+    checks = [rng.choice(arrivals) if i % 10 else rng.choice(CAT_NAMES) for i in range(NUM_INTAKE_CHECKS)]
+    print(f"Tree: {NUM_LAYERS} layers, {NUM_CATS} cats, {len(checks)} finds, 90% of them for {len(arrivals)} missing names")
+    tree, cafe_name = build_tree(0)
+    for label, size in (("no cache", 0), ("negative", 4096)):
+        tree.set_negative_cache_size(size)
+        start = time.time()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            for name in checks:
+                tree.find(name)
+        elapsed = time.time() - start
+        print(f"[{label:>8}] time={elapsed:.3f}s, per find={elapsed / len(checks) * 1e6:.1f}us")
+    print(f"  {tree.get_stats()['negative']}")
+    cleanup_cafe(cafe_name)
+    print()
+
+def compare_find_all():
+    print("Performance Test: one streaming find --all vs a find per matching cat")
+    pattern = "cat_1*"
+    names = [name for name in CAT_NAMES if name.startswith("cat_1")]
+    print(f"Tree: {NUM_LAYERS} layers, {NUM_CATS} cats, {len(names)} of them match {pattern}")
+    for index in (True, False):
+        tree, cafe_name = build_tree(0, index=index)
+        start = time.time()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            for name in names:
+                tree.find(name)
+        separate = time.time() - start
+        start = time.time()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            tree.find(pattern, all_matches=True)
+        streamed = time.time() - start
+        label = "index" if index else "dfs"
+        print(f"[{label:>5}] {len(names)} finds={separate:.3f}s, find --all={streamed:.4f}s, speedup={separate / streamed:.1f}x")
+        cleanup_cafe(cafe_name)
+    print()
+
+def compare_prefix_completion():
+    print(f"Performance Test: prefix find and tab completion at {COMPLETION_CATS} cats, sorted names vs scanning")
+    rng = random.Random(42)
+    prefixes = [f"cat_{rng.randrange(COMPLETION_CATS // 100)}" for _ in range(NUM_COMPLETIONS)]
+
+    # every cat in one cubby, the worst case for completing names in the current cubby
+    tree, cafe_name = build_wide_tree(0)
+    folder = tree.root
+    for i in range(COMPLETION_CATS):
+        folder.add_child(FileNode(f"cat_{i}", Role.ADMIN, folder))
+    # as when the cafe is loaded, every cubby's names are sorted along with the other indexes
+    start = time.time()
+    tree._rebuild_indexes()
+    rebuilt = time.time() - start
+    # scanning takes long enough that a sample of the prefixes will do
+    start = time.time()
+    for prefix in prefixes[:20]:
+        [name for name in folder._by_name if name.startswith(prefix)]
+    scanned = (time.time() - start) / 20
+    start = time.time()
+    for prefix in prefixes:
+        tree.complete(prefix)
+    completed = (time.time() - start) / len(prefixes)
+    start = time.time()
+    for i in range(100):
+        tree._attach(folder, FileNode(f"new_{i}", Role.ADMIN, folder))
+    attached = (time.time() - start) / 100
+    print(f"[complete] scan={scanned * 1000:.3f}ms, sorted={completed * 1000:.3f}ms per completion "
+          f"(indexes rebuilt in {rebuilt:.3f}s, a new cat costs {attached * 1000:.3f}ms to add)")
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        tree.find("cat_1*")  # sorts the cat names once
+    start = time.time()
+    for prefix in prefixes[:20]:
+        [name for name in tree._name_index if name.startswith(prefix)]
+    scanned = (time.time() - start) / 20
+    start = time.time()
+    for prefix in prefixes[:100]:
+        list(tree.iter_find(prefix + "*"))
+    found = (time.time() - start) / 100
+    print(f"[find prefix*] scan of the name index={scanned * 1000:.3f}ms, sorted={found * 1000:.3f}ms per find")
+    cleanup_cafe(cafe_name)
+    print()
+
+def compare_query_indexes():
+    print(f"Performance Test: property queries over {QUERY_CATS} cats, secondary indexes vs a full scan")
+    tree, cafe_name = build_wide_tree(QUERY_CATS)
+    rng = random.Random(42)
+    first_day = date(2026, 1, 1)
+    for folder in tree._iter_folders():
+        for cat in folder.children:
+            if cat.is_file:
+                cat.mood = "grumpy" if rng.random() < 0.01 else rng.choice(["sleepy", "hungry", "playful"])
+                cat.date_fed = (first_day + timedelta(days=rng.randrange(365))).isoformat()
+    queries = [
+        ["mood=grumpy"],
+        ["date_fed<2026-01-04"],
+        ["mood=grumpy", "age>=15"],
+        ["age=7", "date_fed>=2026-12-01"],
+        ["mood=hungry"],
+    ]
+    print(f"{'Query':>32} | {'Matches':>7} | {'Scan (ms)':>9} | {'Index (ms)':>10}")
+    print("-"*68)
+    for predicates in queries:
+        timings = []
+        for indexes in ((), ("age", "mood", "date_fed")):
+            for property_name in CAT_PROPERTIES:
+                tree.drop_property_index(property_name)
+            for property_name in indexes:
+                tree.index_property(property_name)
+            start = time.time()
+            for _ in range(QUERY_REPEATS):
+                matches = sum(1 for _ in tree.iter_query(predicates))
+            timings.append((time.time() - start) / QUERY_REPEATS)
+        print(f"{' '.join(predicates):>32} | {matches:>7} | {timings[0] * 1000:9.2f} | {timings[1] * 1000:10.2f}")
+    start = time.time()
+    tree.index_property("date_fed")
+    print(f"Building the date_fed index: {time.time() - start:.3f}s")
+    cleanup_cafe(cafe_name)
+    print()
+
+def write_import_file(directory, num_cats, fmt):
+    """A cafe's worth of cats in cubbies of CATS_PER_CUBBY, as an import file"""
+    path = os.path.join(directory, f"cats_{num_cats}.{fmt}")
+    with open(path, "w") as f:
+        if fmt == "csv":
+            f.write("path,name,role,age,mood\n")
+            for i in range(num_cats):
+                f.write(f"/wing_{i // (CATS_PER_CUBBY * 10)}/cubby_{i // CATS_PER_CUBBY},cat_{i},admin,{i % 20},sleepy\n")
+        else:
+            for i in range(num_cats):
+                f.write(f'{{"path": "/wing_{i // (CATS_PER_CUBBY * 10)}/cubby_{i // CATS_PER_CUBBY}", "name": "cat_{i}", '
+                        f'"role": "admin", "age": {i % 20}, "mood": "sleepy"}}\n')
+    return path
+
+def compare_bulk_import():
+    print("Performance Test: bulk import vs rescue and meow commands")
+    directory = tempfile.mkdtemp()
+    try:
+        for num_cats in IMPORT_CATS:
+            for fmt in ("csv", "jsonl"):
+                path = write_import_file(directory, num_cats, fmt)
+                cafe_name = f"perf_cafe_{random.randint(0, int(1e9))}"
+                tree = DirectoryTree(name=cafe_name, role=Role.ADMIN)
+                start = time.time()
+                cats, cubbies = tree.bulk_load(path)
+                elapsed = time.time() - start
+                size = os.path.getsize(path) / 1e6
+                print(f"[{fmt:>5}] {cats} cats, {cubbies} cubbies, {size:.1f}MB file: import={elapsed:.2f}s "
+                      f"({elapsed / cats * 1e6:.1f}us per cat)")
+                cleanup_cafe(cafe_name)
+            if num_cats <= 10000:
+                # the same cats one command at a time, saving once at the end like a script
+                cafe_name = f"perf_cafe_{random.randint(0, int(1e9))}"
+                tree = DirectoryTree(name=cafe_name, role=Role.ADMIN)
+                start = time.time()
+                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), tree.deferred_saves():
+                    for i in range(num_cats):
+                        if i % CATS_PER_CUBBY == 0:
+                            tree.walk("/")
+                            if i % (CATS_PER_CUBBY * 10) == 0:
+                                tree.mkcby(f"wing_{i // (CATS_PER_CUBBY * 10)}")
+                            tree.walk(f"wing_{i // (CATS_PER_CUBBY * 10)}")
+                            tree.mkcby(f"cubby_{i // CATS_PER_CUBBY}")
+                            tree.walk(f"cubby_{i // CATS_PER_CUBBY}")
+                        tree.rescue(f"cat_{i}", Role.ADMIN)
+                        tree.meow(f"cat_{i}", "age", str(i % 20))
+                        tree.meow(f"cat_{i}", "mood", "sleepy")
+                elapsed = time.time() - start
+                print(f"[ cmds] {num_cats} cats: rescue+meow in one script={elapsed:.2f}s ({elapsed / num_cats * 1e6:.1f}us per cat)")
+                cleanup_cafe(cafe_name)
+    finally:
+        shutil.rmtree(directory)
+    print()
+
+def compare_export():
+    print("Performance Test: streaming export, time and peak memory of the export itself")
+    print(f"{'Cats':>8} | {'Format':>6} | {'Time (s)':>8} | {'File (MB)':>9} | {'Peak (KB)':>9} | {'Round trip (s)':>14}")
+    print("-"*70)
+    directory = tempfile.mkdtemp()
+    try:
+        for num_cats in EXPORT_CATS:
+            tree, cafe_name = build_wide_tree(num_cats)
+            for fmt in ("csv", "jsonl"):
+                path = os.path.join(directory, f"export.{fmt}")
+                start = time.time()
+                write_records(tree.iter_records(), path)
+                elapsed = time.time() - start
+                peak = float("nan")
+                if num_cats <= 100000:
+                    # tracemalloc slows everything down, so only the smaller cafes are measured
+                    tracemalloc.start()
+                    write_records(tree.iter_records(), path)
+                    peak = tracemalloc.get_traced_memory()[1] / 1024
+                    tracemalloc.stop()
+                copy_name = f"perf_cafe_{random.randint(0, int(1e9))}"
+                copy = DirectoryTree(name=copy_name, role=Role.ADMIN)
+                start = time.time()
+                copy.bulk_load(path)
+                roundtrip = time.time() - start
+                del copy
+                cleanup_cafe(copy_name)
+                print(f"{num_cats:>8} | {fmt:>6} | {elapsed:8.2f} | {os.path.getsize(path) / 1e6:9.1f} | {peak:9.0f} | {roundtrip:14.2f}")
+            del tree
+            cleanup_cafe(cafe_name)
+    finally:
+        shutil.rmtree(directory)
+    print()
+
+def compare_server_clients():
+    print(f"Performance Test: {SERVER_REQUESTS} requests to a server over {SERVER_CATS} cats, split between concurrent clients")
+    print("Reads are cat, find and pawprint, writes are rescues, saved by the background writer")
+    print(f"{'Clients':>7} | {'Writes':>6} | {'Req/s':>8} | {'p50 ms':>8} | {'p99 ms':>8}")
+    print("-"*50)
+    tree, cafe_name = build_wide_tree(SERVER_CATS)
+    tree.enable_background_saves()
+    directory = tempfile.mkdtemp()
+    server = CatServer(tree, os.path.join(directory, "cafe.sock"), run_command)
+    serving = threading.Thread(target=server.serve, args=(0.05,))
+    serving.start()
+    for write_share in (0, 0.1):
+        for num_clients in SERVER_CLIENTS:
+            clients = [CatClient(server.server_address, "admin") for _ in range(num_clients)]
+            latencies = []
+            def run(i, client):
+                rng = random.Random(i)
+                client.send("walk /cubby_0", lambda line: None)
+                for j in range(SERVER_REQUESTS // num_clients):
+                    if rng.random() < write_share:
+                        line = f"rescue server_{write_share}_{num_clients}_{i}_{j}"
+                    else:
+                        line = rng.choice((f"cat cat_{rng.randrange(CATS_PER_CUBBY)}",
+                                           f"find cat_{rng.randrange(SERVER_CATS)}", "pawprint"))
+                    start = time.perf_counter()
+                    client.send(line, lambda line: None)
+                    latencies.append(time.perf_counter() - start)
+            threads = [threading.Thread(target=run, args=item) for item in enumerate(clients)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+            for client in clients:
+                client.close()
+            latencies.sort()
+            print(f"{num_clients:>7} | {write_share:>6.0%} | {len(latencies) / elapsed:8.0f} | "
+                  f"{latencies[len(latencies) // 2] * 1e3:8.3f} | {latencies[int(len(latencies) * 0.99)] * 1e3:8.3f}")
+    server.shutdown()
+    serving.join()
+    tree.close()
+    shutil.rmtree(directory)
+    cleanup_cafe(cafe_name)
+    print()
+
+async def simulate_client(path, i, num_requests, connected, latencies):
+    """One simulated kiosk: connects, waits for every other client to connect, then sends num_requests commands"""
+    reader, writer = await asyncio.open_unix_connection(path)
+    async def send(line):
+        writer.write(f"{line}\n".encode())
+        while not (await reader.readline()).startswith(b"\0"):
+            pass
+    await send("admin")
+    await send("walk /cubby_0")
+    await connected.wait()
+    rng = random.Random(i)
+    for j in range(num_requests):
+        if rng.random() < LOAD_WRITE_SHARE:
+            line = f"rescue load_{i}_{j}_{rng.randrange(1 << 30)}"
+        else:
+            line = rng.choice((f"cat cat_{rng.randrange(CATS_PER_CUBBY)}", f"find cat_{rng.randrange(SERVER_CATS)}", "pawprint"))
+        start = time.perf_counter()
+        await send(line)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+    await writer.wait_closed()
+
+def generate_load(path, num_clients):
+    """Runs num_clients simulated clients on one event loop, returns (seconds, latencies, threads while connected)"""
+    latencies = []
+    threads = []
+    async def run():
+        connected = asyncio.Barrier(num_clients + 1)
+        clients = [asyncio.create_task(simulate_client(path, i, LOAD_REQUESTS // num_clients, connected, latencies))
+                   for i in range(num_clients)]
+        await connected.wait()
+        threads.append(threading.active_count())
+        await asyncio.gather(*clients)
+    start = time.time()
+    asyncio.run(run())
+    return time.time() - start, latencies, threads[0]
+
+def compare_server_front_ends():
+    print(f"Performance Test: load generator, {LOAD_REQUESTS} requests to a server over {SERVER_CATS} cats "
+          f"split between simulated clients, {LOAD_WRITE_SHARE:.0%} of them rescues")
+    print(f"{'Server':>8} | {'Clients':>7} | {'Req/s':>8} | {'p50 ms':>8} | {'p99 ms':>8} | {'p99.9 ms':>8} | {'Threads':>7}")
+    print("-"*73)
+    for label, make_server in (("threads", lambda tree, path: CatServer(tree, path, run_command)),
+                               ("asyncio", lambda tree, path: AsyncCatServer(tree, path, run_command))):
+        tree, cafe_name = build_wide_tree(SERVER_CATS)
+        tree.enable_background_saves()
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "cafe.sock")
+        server = make_server(tree, path)
+        serving = threading.Thread(target=server.serve)
+        serving.start()
+        for num_clients in LOAD_CLIENTS:
+            elapsed, latencies, threads = generate_load(path, num_clients)
+            latencies.sort()
+            print(f"{label:>8} | {num_clients:>7} | {len(latencies) / elapsed:8.0f} | "
+                  f"{latencies[len(latencies) // 2] * 1e3:8.3f} | {latencies[int(len(latencies) * 0.99)] * 1e3:8.3f} | "
+                  f"{latencies[int(len(latencies) * 0.999)] * 1e3:8.3f} | {threads:>7}")
+        server.shutdown()
+        serving.join()
+        tree.close()
+        shutil.rmtree(directory)
+        cleanup_cafe(cafe_name)
+    print()
 
 def main():
+    compare_storage_formats()
+    compare_background_saves()
+    compare_sharded_saves()
+    compare_startup()
+    compare_image_viewers()
+    compare_parallel_search()
+    compare_walk_dentries()
+    compare_path_memo()
+    compare_negative_cache()
+    compare_find_all()
+    compare_prefix_completion()
+    compare_query_indexes()
+    compare_bulk_import()
+    compare_export()
+    compare_server_clients()
+    compare_server_front_ends()
+    measure_memory()
+    compare_index_vs_dfs()
+    compare_cache_policies()
     print("Performance Test: CatFS DirectoryTree Search with/without Cache")
     print(f"Tree: {NUM_LAYERS} layers, {NUM_CATS} cats, {NUM_SEARCHES} searches per run, {REPEATS} repeats per config.")
     print("Cache sizes tested:", CACHE_SIZES)
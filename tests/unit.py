@@ -8,19 +8,38 @@
 
 import os
 import unittest
+from unittest import mock
 import sys
 import time
 import logging
 import random
 from datetime import datetime
 import io
+import json
+import pickle
+import shutil
+import socket
+import struct
+import tempfile
+import threading
 from contextlib import redirect_stdout
 
 # Add the parent directory to sys.path to allow imports
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from directory import DirectoryTree, FileNode, FolderNode, Role
-from cache import LRUCache
+from directory import CAT_PROPERTIES, DirectoryTree, FileNode, FolderNode, ImageTree, Role, SaveSnapshot
+from bulk import BulkFormatError, write_records
+from cache import Cache, LRUCache, CACHE_POLICIES, make_cache
+from image import encode_image
+from journal import Journal
+from main import Completer, load_or_create_tree, main, run_command, run_script
+from names import SortedNames
+from parallel import ParallelSearch, search, split
+from rwlock import ReadWriteLock
+from server import AsyncCatServer, CatClient, CatServer
+from shards import ShardStore
+from stats import LatencyHistogram
+from storage import CafeFormatError, read_cafe, write_cafe
 
 class TestFileNode(unittest.TestCase):
     def setUp(self):
@@ -55,9 +74,67 @@ class TestFileNode(unittest.TestCase):
         self.assertEqual(self.dir.dot, self.dir)
         self.assertEqual(self.dir.dotdot, self.parent)
 
+    def test_compact_layout(self):
+        self.assertFalse(hasattr(self.file, "__dict__"))
+        self.assertFalse(hasattr(self.dir, "__dict__"))
+        # content is a live view over the node's fixed property fields
+        self.file.content["mood"] = "sleepy"
+        self.assertEqual(self.file.get_property("mood"), "sleepy")
+        self.assertEqual(self.file.content.copy(), {"age": None, "mood": "sleepy", "date_found": None, "date_fed": None})
+        self.assertNotIn("color", self.file.content)
+        self.file.content = {"age": "4"}
+        self.assertEqual((self.file.get_property("age"), self.file.get_property("mood")), ("4", None))
+
+    def test_node_pickle_roundtrip(self):
+        self.parent.add_child(self.file)
+        self.file.set_property("age", "2")
+        parent = pickle.loads(pickle.dumps(self.parent))
+        file = parent.get_child("test.txt")
+        self.assertIs(file.parent, parent)
+        self.assertEqual(file.get_property("age"), "2")
+        self.assertEqual(file.required_role, Role.STAFF)
+
+class TestFolderNodeChildren(unittest.TestCase):
+    def setUp(self):
+        self.folder = FolderNode("folder")
+        self.cats = [FileNode(f"cat{i}", parent=self.folder) for i in range(5)]
+        for cat in self.cats:
+            self.folder.add_child(cat)
+
+    def test_lookup_by_name(self):
+        self.assertIs(self.folder.get_child("cat3"), self.cats[3])
+        self.assertIs(self.folder.get_child("."), self.folder)
+        self.assertIsNone(self.folder.get_child("nonexistent"))
+
+    def test_remove_and_rename_keep_order(self):
+        self.folder.remove_child(self.cats[1])
+        self.folder.rename_child(self.cats[3], "renamed")
+        self.assertIsNone(self.folder.get_child("cat1"))
+        self.assertIsNone(self.folder.get_child("cat3"))
+        self.assertIs(self.folder.get_child("renamed"), self.cats[3])
+        self.assertEqual([c.name for c in self.folder.children], ["cat0", "cat2", "renamed", "cat4"])
+
+    def test_duplicate_names_return_first(self):
+        self.folder.rename_child(self.cats[4], "cat0")
+        self.folder.rename_child(self.cats[2], "cat0")
+        self.assertIs(self.folder.get_child("cat0"), self.cats[0])
+        self.folder.remove_child(self.cats[0])
+        self.assertIs(self.folder.get_child("cat0"), self.cats[2])
+        self.folder.remove_child(self.cats[2])
+        self.assertIs(self.folder.get_child("cat0"), self.cats[4])
+
+    def test_old_pickle_migrates(self):
+        # cafes/test1.pkl was written before children were indexed by name
+        with open(os.path.join("cafes", "test1.pkl"), "rb") as f:
+            tree = pickle.load(f)
+        cafe = tree.root.get_child("cafe")
+        self.assertIsNotNone(cafe)
+        self.assertIsNotNone(cafe.get_child("bob"))
+        self.assertEqual([c.name for c in tree.root.children], ["cafe"])
+
 class TestDirectoryTree(unittest.TestCase):
     def setUp(self):
-        # Use a unique name for each test to avoid pickle conflicts
+        # Use a unique name for each test to avoid cafe file conflicts
         self.cafe_name = f"testcafe_{random.randint(0, int(1e9))}"
         self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN)
         self.tree.rescue("whiskers", Role.ADMIN)
@@ -68,10 +145,10 @@ class TestDirectoryTree(unittest.TestCase):
         self.tree.walk("/")
 
     def tearDown(self):
-        # Clean up the pickle file after each test
-        pkl_path = os.path.join("cafes", f"{self.cafe_name}.pkl")
-        if os.path.exists(pkl_path):
-            os.remove(pkl_path)
+        # Clean up the cafe file after each test
+        cafe_path = DirectoryTree.cafe_path(self.cafe_name)
+        if os.path.exists(cafe_path):
+            os.remove(cafe_path)
 
     def test_cat_command(self):
         self.tree.meow("whiskers", "age", "2")
@@ -276,6 +353,21 @@ class TestLRUCache(unittest.TestCase):
         self.assertIsNotNone(self.cache.get("/file2"))
         self.assertIsNotNone(self.cache.get("/file3"))
 
+    def test_cache_counters(self):
+        self.cache.put("/file1", self.file1)
+        self.cache.put("/file1", self.file1)
+        self.cache.put("/file2", self.file2)
+        self.cache.put("/file3", self.file3)
+        self.cache.get("/file1")
+        self.cache.get("/file3")
+        self.cache.invalidate("/file3")
+        self.cache.invalidate("/file3")
+        stats = self.cache.stats()
+        self.assertEqual(stats["policy"], "lru")
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual((stats["insertions"], stats["evictions"], stats["invalidations"]), (3, 1, 1))
+        self.assertEqual(stats["size"], 1)
+
     def test_lru_eviction(self):
         # Test LRU eviction policy
         self.cache.put("/file1", self.file1)
@@ -285,9 +377,89 @@ class TestLRUCache(unittest.TestCase):
         self.assertIsNotNone(self.cache.get("/file1"))  # Should still be in cache
         self.assertIsNone(self.cache.get("/file2"))  # Should be evicted
 
+class TestCachePolicies(unittest.TestCase):
+    def test_policies_respect_capacity_and_values(self):
+        for policy in CACHE_POLICIES:
+            for capacity in (1, 3, 20):
+                cache = make_cache(policy, capacity)
+                expected = {}
+                rng = random.Random(7)
+                for i in range(3000):
+                    key = f"/file{int(rng.paretovariate(1.2)) % 60}"
+                    roll = rng.random()
+                    if roll < 0.1:
+                        cache.invalidate(key)
+                        expected.pop(key, None)
+                    elif roll < 0.5:
+                        value = cache.get(key)
+                        self.assertTrue(value is None or value == expected[key], policy)
+                    else:
+                        expected[key] = i
+                        cache.put(key, i)
+                    self.assertLessEqual(len(cache), capacity, policy)
+
+    def test_scan_resistance(self):
+        def hot_hit_rate(policy):
+            cache = make_cache(policy, 100)
+            rng = random.Random(3)
+            hits = 0
+            for i in range(20000):
+                hot = f"/hot{rng.randrange(60)}"
+                for key in (hot, f"/scan{i}"):
+                    if cache.get(key) is None:
+                        cache.put(key, key)
+                    elif key == hot:
+                        hits += 1
+            return hits / 20000
+        lru = hot_hit_rate("lru")
+        for policy in ("lfu", "2q", "arc", "tinylfu"):
+            self.assertGreater(hot_hit_rate(policy), lru, policy)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            make_cache("mru", 10)
+
+    def test_clear_keeps_counters_and_sizing(self):
+        for policy in CACHE_POLICIES:
+            cache = make_cache(policy, 200)
+            for i in range(300):
+                cache.put(f"/file{i}", i)
+                cache.get(f"/file{i}")
+            before = cache.stats()
+            cache.clear()
+            after = cache.stats()
+            self.assertEqual(after["size"], 0, policy)
+            self.assertEqual({k: v for k, v in after.items() if k != "size"},
+                             {k: v for k, v in before.items() if k != "size"}, policy)
+            for i in range(300):
+                cache.put(f"/file{i}", i)
+            self.assertLessEqual(len(cache), 200, policy)
+            self.assertEqual(cache.get("/file299"), 299, policy)
+
+    def test_incomplete_policy_fails_when_created(self):
+        class NoInvalidate(Cache):
+            policy = "noinvalidate"
+            _get = LRUCache._get
+            _put = LRUCache._put
+            __len__ = LRUCache.__len__
+        with self.assertRaises(TypeError):
+            NoInvalidate(10)
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 101):
+            histogram.record(ms / 1000)
+        self.assertEqual(histogram.count, 100)
+        # buckets are ~12% wide, percentiles report the bucket's upper bound
+        self.assertAlmostEqual(histogram.percentile(50), 0.050, delta=0.050 * 0.13)
+        self.assertAlmostEqual(histogram.percentile(99), 0.099, delta=0.099 * 0.13)
+        self.assertEqual(histogram.percentile(100), 0.1)
+        self.assertEqual(LatencyHistogram().summary()["p99_ms"], 0.0)
+
 class TestDirectoryTreeWithCache(unittest.TestCase):
     def setUp(self):
-        # Use a unique name for each test to avoid pickle conflicts
+        # Use a unique name for each test to avoid cafe file conflicts
         self.cafe_name = f"cachecafe_{random.randint(0, int(1e9))}"
         self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN, cache_size=3)
         # Rescue 4 cats to overflow the cache (cache size is 3)
@@ -296,10 +468,10 @@ class TestDirectoryTreeWithCache(unittest.TestCase):
             self.tree.rescue(name, Role.ADMIN)
 
     def tearDown(self):
-        # Clean up the pickle file after each test
-        pkl_path = os.path.join("cafes", f"{self.cafe_name}.pkl")
-        if os.path.exists(pkl_path):
-            os.remove(pkl_path)
+        # Clean up the cafe file after each test
+        cafe_path = DirectoryTree.cafe_path(self.cafe_name)
+        if os.path.exists(cafe_path):
+            os.remove(cafe_path)
 
     def test_cache_overflow_and_eviction(self):
         # Access the first three cats to fill the cache
@@ -330,6 +502,39 @@ class TestDirectoryTreeWithCache(unittest.TestCase):
             self.tree.find("cat2")
         self.assertIn("Found cat2", f.getvalue())
 
+    def test_stats_command(self):
+        with redirect_stdout(io.StringIO()):
+            for name in self.cat_names + ["cat4", "notacat"]:
+                self.tree.find(name)
+        stats = self.tree.get_stats()
+        self.assertEqual(stats["find"], {"accesses": 6, "cache_hits": 1})
+        self.assertEqual(stats["cache"]["evictions"], 1)
+        self.assertEqual(stats["cache"]["size"], 3)
+        self.assertEqual(stats["commands"]["find"]["count"], 6)
+        self.assertEqual(stats["commands"]["rescue"]["count"], 4)
+        f = io.StringIO()
+        with redirect_stdout(f):
+            self.tree.stats()
+        self.assertIn("evictions=1", f.getvalue())
+        path = os.path.join("cafes", f"{self.cafe_name}.stats.json")
+        try:
+            with redirect_stdout(io.StringIO()):
+                self.tree.stats("json", path)
+            with open(path) as f:
+                self.assertEqual(json.load(f)["cache"]["hits"], 1)
+        finally:
+            os.remove(path)
+
+    def test_every_command_is_timed(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.begin()
+            self.tree.abort()
+            self.tree.begin()
+            self.tree.commit()
+            self.tree.stats()
+        commands = self.tree.get_stats()["commands"]
+        self.assertEqual([commands[name]["count"] for name in ("begin", "abort", "commit", "stats")], [2, 1, 1, 1])
+
     def test_cache_refill_after_eviction(self):
         # Fill cache and overflow
         for name in self.cat_names:
@@ -355,6 +560,2116 @@ class TestDirectoryTreeWithCache(unittest.TestCase):
             self.tree.find("cat2")
         self.assertIn("Found cat2", f.getvalue())
 
+class TestCacheCoherence(unittest.TestCase):
+    NAMES = [f"cat{i}" for i in range(8)]
+
+    def setUp(self):
+        self.cafe_name = f"coherentcafe_{random.randint(0, int(1e9))}"
+
+    def tearDown(self):
+        cafe_path = DirectoryTree.cafe_path(self.cafe_name)
+        if os.path.exists(cafe_path):
+            os.remove(cafe_path)
+
+    def uncached_find(self, tree, name):
+        stack = [tree.root]
+        while stack:
+            folder = stack.pop()
+            for child in folder.children:
+                if child.is_file and child.name == name:
+                    return child
+            stack.extend(child for child in folder.children if not child.is_file)
+        return None
+
+    def assert_attached(self, tree, node):
+        while node is not tree.root:
+            self.assertIsNotNone(node.parent)
+            self.assertIn(node, node.parent.children)
+            node = node.parent
+
+    def test_rename_and_adoption_invalidate(self):
+        tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN, cache_size=4, index=False)
+        with redirect_stdout(io.StringIO()):
+            tree.rescue("whiskers", Role.ADMIN)
+            tree.rescue("mittens", Role.ADMIN)
+            tree.find("whiskers")
+            tree.find("mittens")
+            tree.recollar("whiskers", "whiskers_new")
+            tree.adopted("mittens")
+        self.assertIsNone(tree._find_file_in_tree("whiskers"))
+        self.assertIsNone(tree._find_file_in_tree("mittens"))
+        self.assertEqual(tree.cache_hits, 0)
+        tree._do_carry(tree.current_node, "whiskers_new")
+        self.assertIsNone(tree._find_file_in_tree("whiskers_new"))
+
+    def test_misses_are_remembered_until_the_name_appears(self):
+        tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN, index=False)
+        with redirect_stdout(io.StringIO()):
+            tree.rescue("whiskers", Role.ADMIN)
+            tree.rescue("stray", Role.ADMIN)
+            tree._mutate("carry", "stray")
+            introductions = [
+                ("kitten", lambda: tree.rescue("kitten", Role.ADMIN)),
+                ("twin", lambda: tree.copycat("whiskers", "twin")),
+                ("tabby", lambda: tree.recollar("whiskers", "tabby")),
+                ("stray", lambda: tree.put("stray")),
+            ]
+            for name, introduce in introductions:
+                self.assertIsNone(tree._find_file_in_tree(name))
+                searches = tree._negative.misses
+                self.assertIsNone(tree._find_file_in_tree(name))
+                self.assertEqual(tree._negative.misses, searches, f"{name} was searched for twice")
+                introduce()
+                self.assertEqual(tree._find_file_in_tree(name).name, name)
+        self.assertEqual(tree.get_stats()["negative"]["hits"], len(introductions))
+        os.remove(tree._path)
+
+    def test_randomized_consistency(self):
+        rng = random.Random(377)
+        for index, policy in [(False, policy) for policy in CACHE_POLICIES] + [(True, "lru")]:
+            tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN, cache_size=3, index=index, cache_policy=policy)
+            with redirect_stdout(io.StringIO()):
+                for _ in range(500):
+                    op = rng.choice(["rescue", "copycat", "recollar", "adopted", "carry", "put", "mkcby", "walk"])
+                    name, other = rng.choice(self.NAMES), rng.choice(self.NAMES)
+                    node = tree._find_node_in_current(name)
+                    if op == "rescue":
+                        tree.rescue(name, Role.ADMIN)
+                    elif op == "copycat":
+                        tree.copycat(name, other)
+                    elif op == "recollar":
+                        tree.recollar(name, other)
+                    elif op == "adopted":
+                        tree.adopted(name)
+                    elif op == "carry" and node and node.is_file:
+                        tree._mutate("carry", name)
+                    elif op == "put":
+                        tree.put()
+                    elif op == "mkcby":
+                        tree.mkcby(f"cubby{rng.randrange(3)}")
+                    elif op == "walk":
+                        tree.walk(rng.choice(["/", "..", "cubby0", "cubby1", "cubby2"]))
+                    for lookup in rng.sample(self.NAMES, 3):
+                        cached = tree._find_file_in_tree(lookup)
+                        expected = self.uncached_find(tree, lookup)
+                        self.assertEqual(cached is None, expected is None, f"{op} broke {lookup}")
+                        if cached is not None:
+                            self.assertEqual(cached.name, lookup)
+                            self.assert_attached(tree, cached)
+            self.assertGreater(tree.cache_hits, 0, policy)
+            os.remove(tree._path)
+
+class TestNameIndex(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"indexcafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN)
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("whiskers", Role.ADMIN)
+            self.tree.mkcby("cubby1")
+            self.tree.walk("cubby1")
+            self.tree.rescue("shadow", Role.ADMIN)
+
+    def tearDown(self):
+        cafe_path = DirectoryTree.cafe_path(self.cafe_name)
+        if os.path.exists(cafe_path):
+            os.remove(cafe_path)
+
+    def test_index_follows_mutations(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.recollar("shadow", "shade")
+            self.tree.copycat("shade", "shade_copy")
+            self.tree.walk("/")
+            self.tree.adopted("whiskers")
+        self.assertIsNone(self.tree._find_file_in_tree("shadow"))
+        self.assertIsNone(self.tree._find_file_in_tree("whiskers"))
+        self.assertEqual(self.tree._find_file_in_tree("shade").name, "shade")
+        self.assertIsNotNone(self.tree._find_file_in_tree("shade_copy"))
+
+    def test_index_follows_carry_and_put(self):
+        self.tree._do_carry(self.tree.current_node, "shadow")
+        self.assertIsNone(self.tree._find_file_in_tree("shadow"))
+        with redirect_stdout(io.StringIO()):
+            self.tree.walk("/")
+            self.tree.put("shadow")
+        found = self.tree._find_file_in_tree("shadow")
+        self.assertIs(found.parent, self.tree.root)
+        self.assertEqual(self.tree._get_wd_of_node(found), "/shadow")
+
+    def test_index_matches_dfs(self):
+        dfs_tree = DirectoryTree(name=f"{self.cafe_name}_dfs", role=Role.ADMIN, index=False)
+        try:
+            with redirect_stdout(io.StringIO()):
+                for tree in (self.tree, dfs_tree):
+                    tree.walk("/")
+                    for i in range(3):
+                        tree.mkcby(f"deep{i}")
+                        tree.walk(f"deep{i}")
+                        tree.rescue(f"cat{i}", Role.ADMIN)
+            for name in ("cat0", "cat1", "cat2", "nonexistent"):
+                indexed = self.tree._find_file_in_tree(name)
+                searched = dfs_tree._find_file_in_tree(name)
+                self.assertEqual(indexed and self.tree._get_wd_of_node(indexed),
+                                 searched and dfs_tree._get_wd_of_node(searched))
+        finally:
+            os.remove(dfs_tree._path)
+
+class TestFindPatterns(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"patterncafe_{random.randint(0, int(1e9))}"
+        self.trees = [DirectoryTree(name=f"{self.cafe_name}_{index}", role=Role.ADMIN, index=index)
+                      for index in (True, False)]
+        with redirect_stdout(io.StringIO()):
+            for tree in self.trees:
+                tree.rescue("tabby_1", Role.ADMIN)
+                tree.rescue("calico", Role.ADMIN)
+                tree.mkcby("upstairs")
+                tree.walk("upstairs")
+                tree.rescue("tabby_2", Role.ADMIN)
+                tree.mkcby("attic")
+                tree.walk("attic")
+                tree.rescue("tabby_1", Role.ADMIN)
+                tree.rescue("tabbycat", Role.ADMIN)
+                tree.walk("/")
+
+    def tearDown(self):
+        for tree in self.trees:
+            if os.path.exists(tree._path):
+                os.remove(tree._path)
+
+    def test_iter_find_matches_globs_regexes_and_names(self):
+        expected = {
+            ("tabby_*", False): ["/tabby_1", "/upstairs/attic/tabby_1", "/upstairs/tabby_2"],
+            ("tabby_?", False): ["/tabby_1", "/upstairs/attic/tabby_1", "/upstairs/tabby_2"],
+            ("*a*", False): ["/calico", "/tabby_1", "/upstairs/attic/tabby_1", "/upstairs/attic/tabbycat",
+                             "/upstairs/tabby_2"],
+            ("tabby_1", False): ["/tabby_1", "/upstairs/attic/tabby_1"],
+            (r"_\d$", True): ["/tabby_1", "/upstairs/attic/tabby_1", "/upstairs/tabby_2"],
+            ("^cal", True): ["/calico"],
+            ("nobody*", False): [],
+            ("nobody", False): [],
+        }
+        for tree in self.trees:
+            for (pattern, regex), paths in expected.items():
+                found = list(tree.iter_find(pattern, regex))
+                self.assertEqual(sorted(path for path, _ in found), paths, (tree._name_index is not None, pattern))
+                for path, cat in found:
+                    self.assertEqual(tree._get_wd_of_node(cat), path)
+
+    def test_iter_find_without_index_is_in_prowl_order(self):
+        paths = [path for path, _ in self.trees[1].iter_find("tabby*")]
+        self.assertEqual(paths, ["/tabby_1", "/upstairs/tabby_2", "/upstairs/attic/tabby_1", "/upstairs/attic/tabbycat"])
+
+    def test_iter_find_is_lazy(self):
+        for tree in self.trees:
+            matches = tree.iter_find("*")
+            path, cat = next(matches)
+            self.assertTrue(cat.is_file)
+            matches.close()
+
+    def test_find_all_command(self):
+        for tree in self.trees:
+            output = io.StringIO()
+            with redirect_stdout(output):
+                self.assertTrue(run_command(tree, "find --all tabby_*"))
+            lines = output.getvalue().splitlines()
+            self.assertEqual(sorted(lines[:-1]), ["/tabby_1", "/upstairs/attic/tabby_1", "/upstairs/tabby_2"])
+            self.assertEqual(lines[-1], "3 cats found")
+
+    def test_find_pattern_without_all_prints_one_match(self):
+        for tree in self.trees:
+            output = io.StringIO()
+            with redirect_stdout(output):
+                run_command(tree, "find --regex cat$")
+                run_command(tree, "find calico")
+                run_command(tree, "find dog*")
+            self.assertEqual(output.getvalue().splitlines(), [
+                "Found tabbycat in /upstairs/attic/tabbycat",
+                "Found calico in /calico",
+                "dog* not found in the tree",
+            ])
+
+    def test_invalid_regex_fails(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertFalse(run_command(self.trees[0], "find --all --regex tabby(["))
+        self.assertIn("Invalid pattern", output.getvalue())
+
+    def test_results_follow_mutations(self):
+        for tree in self.trees:
+            with redirect_stdout(io.StringIO()):
+                tree.recollar("tabby_1", "ginger")
+                tree.walk("upstairs")
+                tree.rescue("tabby_3", Role.ADMIN)
+                tree.walk("/")
+            paths = sorted(path for path, _ in tree.iter_find("tabby_*"))
+            self.assertEqual(paths, ["/upstairs/attic/tabby_1", "/upstairs/tabby_2", "/upstairs/tabby_3"])
+
+class TestPrefixCompletion(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"prefixcafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN)
+        with redirect_stdout(io.StringIO()):
+            for name in ("tabby", "tabitha", "calico", "tux"):
+                self.tree.rescue(name, Role.ADMIN)
+            self.tree.mkcby("tower")
+            self.tree.walk("tower")
+            self.tree.rescue("tabby", Role.ADMIN)
+            self.tree.rescue("ginger", Role.ADMIN)
+            self.tree.walk("/")
+
+    def tearDown(self):
+        cafe_path = DirectoryTree.cafe_path(self.cafe_name)
+        if os.path.exists(cafe_path):
+            os.remove(cafe_path)
+
+    def test_complete_names_in_current_cubby(self):
+        self.assertEqual(self.tree.complete("ta"), ["tabby", "tabitha"])
+        self.assertEqual(self.tree.complete("t"), ["tabby", "tabitha", "tower", "tux"])
+        self.assertEqual(self.tree.complete("z"), [])
+        self.assertEqual(self.tree.complete(""), ["calico", "tabby", "tabitha", "tower", "tux"])
+
+    def test_complete_paths(self):
+        self.assertEqual(self.tree.complete("tower/g"), ["tower/ginger"])
+        self.assertEqual(self.tree.complete("/tower/"), ["/tower/ginger", "/tower/tabby"])
+        self.assertEqual(self.tree.complete("/c"), ["/calico"])
+        self.assertEqual(self.tree.complete("nowhere/g"), [])
+        self.assertEqual(self.tree.complete("tux/g"), [])
+
+    def test_every_cubby_is_kept_sorted(self):
+        with redirect_stdout(io.StringIO()):
+            for i in range(20):
+                self.tree.walk("/")
+                self.tree.mkcby(f"room{i}")
+                self.tree.walk(f"room{i}")
+                self.tree.rescue(f"cat{i}", Role.ADMIN)
+        tree = DirectoryTree.load(self.cafe_name, Role.ADMIN)
+        # nothing is sorted on first use, however many cubbies are completed in
+        with mock.patch("directory.SortedNames", side_effect=AssertionError("sorted on first use")):
+            for i in range(20):
+                self.assertEqual(tree.complete(f"/room{i}/c"), [f"/room{i}/cat{i}"])
+        with redirect_stdout(io.StringIO()):
+            tree.walk("/room0")
+            tree.rescue("cub", Role.ADMIN)
+            tree.mkcby("cupboard")
+        self.assertEqual(tree.complete("c"), ["cat0", "cub", "cupboard"])
+        self.assertEqual(tree.complete("cupboard/"), [])
+        self.assertEqual(tree.complete("/r"), [f"/room{i}" for i in sorted(range(20), key=str)])
+
+    def test_completion_follows_mutations(self):
+        self.assertEqual(self.tree.complete("t"), ["tabby", "tabitha", "tower", "tux"])
+        with redirect_stdout(io.StringIO()):
+            self.tree.recollar("tux", "tuxedo")
+            self.tree.adopted("tabitha")
+            self.tree.mkcby("tunnel")
+            self.tree.copycat("tabby", "tabby")
+            self.tree._mutate("carry", "calico")  # carry itself fails half the time
+            self.tree.rescue("toffee", Role.ADMIN)
+        self.assertEqual(self.tree.complete("t"), ["tabby", "toffee", "tower", "tunnel", "tuxedo"])
+        self.assertEqual(self.tree.complete("c"), [])
+        with redirect_stdout(io.StringIO()):
+            self.tree.adopted("tabby")
+        # a copy by the same name is still there
+        self.assertEqual(self.tree.complete("tab"), ["tabby"])
+        with redirect_stdout(io.StringIO()):
+            self.tree.begin()
+            self.tree.rescue("tiger", Role.ADMIN)
+            self.tree.abort()
+        self.assertEqual(self.tree.complete("ti"), [])
+
+    def test_prefix_find_follows_mutations(self):
+        def found(pattern):
+            return [path for path, _ in self.tree.iter_find(pattern)]
+        self.assertEqual(found("tab*"), ["/tabby", "/tower/tabby", "/tabitha"])
+        with redirect_stdout(io.StringIO()):
+            self.tree.recollar("tabitha", "tabs")
+            self.tree.adopted("tabby")
+            self.tree.rescue("tabasco", Role.ADMIN)
+        self.assertEqual(found("tab*"), ["/tabasco", "/tower/tabby", "/tabs"])
+        self.assertEqual(found("tab?y"), ["/tower/tabby"])
+        self.assertEqual(found("ginger*"), ["/tower/ginger"])
+        self.assertEqual(found("x*"), [])
+
+    def test_sorted_names_prefix_edges(self):
+        names = SortedNames(["a", "ab", "abc", "b", "a\U0010ffff", "a\U0010ffffz", "\U0010ffff"])
+        self.assertEqual(names.with_prefix("a"), ["a", "ab", "abc", "a\U0010ffff", "a\U0010ffffz"])
+        self.assertEqual(names.with_prefix("a\U0010ffff"), ["a\U0010ffff", "a\U0010ffffz"])
+        self.assertEqual(names.with_prefix("\U0010ffff"), ["\U0010ffff"])
+        self.assertEqual(names.with_prefix(""), sorted(names))
+        names.remove("ab")
+        names.add("aa")
+        self.assertEqual(names.with_prefix("a")[:3], ["a", "aa", "abc"])
+        self.assertIn("aa", names)
+        self.assertNotIn("ab", names)
+
+    def test_completer_completes_commands_then_names(self):
+        completer = Completer(self.tree)
+        with mock.patch("main.readline") as readline:
+            readline.get_line_buffer.return_value = "wa"
+            readline.get_begidx.return_value = 0
+            self.assertEqual(completer.complete("wa", 0), "walk")
+            self.assertIsNone(completer.complete("wa", 1))
+            readline.get_line_buffer.return_value = "cat ta"
+            readline.get_begidx.return_value = 4
+            self.assertEqual([completer.complete("ta", state) for state in range(3)], ["tabby", "tabitha", None])
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"querycafe_{random.randint(0, int(1e9))}"
+        self.trees = [DirectoryTree(name=f"{self.cafe_name}_{i}", role=Role.ADMIN, property_indexes=indexes)
+                      for i, indexes in enumerate([(), ("age", "mood", "date_fed")])]
+        cats = [
+            ("/", "oreo", {"age": "2", "mood": "hungry", "date_fed": "2026-10-10"}),
+            ("/", "mochi", {"age": "10", "mood": "sleepy", "date_fed": "2026-10-15"}),
+            ("/upstairs", "pepper", {"age": "7", "mood": "hungry", "date_fed": "2026-10-12"}),
+            ("/upstairs", "salt", {"age": "3", "mood": "playful"}),
+            ("/upstairs/attic", "ghost", {"age": "13", "mood": "hungry", "date_fed": "2026-10-16"}),
+        ]
+        with redirect_stdout(io.StringIO()):
+            for tree in self.trees:
+                tree.mkcby("upstairs")
+                tree.walk("upstairs")
+                tree.mkcby("attic")
+                for cubby, name, properties in cats:
+                    tree.walk(cubby)
+                    tree.rescue(name, Role.ADMIN)
+                    for property_name, value in properties.items():
+                        tree.meow(name, property_name, value)
+                tree.walk("/")
+
+    def tearDown(self):
+        for tree in self.trees:
+            if os.path.exists(tree._path):
+                os.remove(tree._path)
+
+    def query(self, tree, *predicates, scope="/"):
+        return sorted(path for path, _ in tree.iter_query(predicates, scope))
+
+    def assertQuery(self, predicates, expected, scope="/"):
+        for tree in self.trees:
+            self.assertEqual(self.query(tree, *predicates, scope=scope), expected, (predicates, tree._property_indexes))
+
+    def test_equality_and_ranges(self):
+        self.assertQuery(["mood=hungry"], ["/oreo", "/upstairs/attic/ghost", "/upstairs/pepper"])
+        # ages compare as numbers, so 10 is not less than 7
+        self.assertQuery(["age<7"], ["/oreo", "/upstairs/salt"])
+        self.assertQuery(["age>=7", "age<=10"], ["/mochi", "/upstairs/pepper"])
+        self.assertQuery(["age=10.0"], ["/mochi"])
+        self.assertQuery(["date_fed<2026-10-13"], ["/oreo", "/upstairs/pepper"])
+        self.assertQuery(["mood=hungry", "date_fed>2026-10-11", "age!=13"], ["/upstairs/pepper"])
+        self.assertQuery(["mood!=hungry"], ["/mochi", "/upstairs/salt"])
+        self.assertQuery(["date_found=2026-01-01"], [])
+        self.assertQuery([], ["/mochi", "/oreo", "/upstairs/attic/ghost", "/upstairs/pepper", "/upstairs/salt"])
+
+    def test_subtree_scope(self):
+        self.assertQuery(["mood=hungry"], ["/upstairs/attic/ghost", "/upstairs/pepper"], scope="/upstairs")
+        self.assertQuery(["age>5"], ["/upstairs/attic/ghost"], scope="upstairs/attic")
+        with self.assertRaises(ValueError):
+            self.trees[1].iter_query(["age>5"], scope="/nowhere")
+
+    def test_selective_queries_use_an_index(self):
+        indexed = self.trees[1]
+        self.query(indexed, "mood=hungry", "age>12")
+        self.query(indexed, "date_found=2026-01-01")
+        self.query(indexed, "mood!=hungry")
+        self.assertEqual((indexed.queries_indexed, indexed.queries_scanned), (1, 2))
+        self.assertEqual([path for path, _ in indexed.iter_query(["age>5"])],
+                         ["/mochi", "/upstairs/attic/ghost", "/upstairs/pepper"])
+
+    def test_indexes_follow_mutations(self):
+        with redirect_stdout(io.StringIO()):
+            for tree in self.trees:
+                tree.meow("oreo", "mood", "sleepy")
+                tree.copycat("mochi", "mochi_copy")
+                tree.adopted("mochi")
+                tree.walk("upstairs")
+                tree._mutate("carry", "pepper")  # carry itself fails half the time
+                tree.walk("attic")
+                tree.put("pepper")
+                tree.meow("pepper", "age", "8")
+                tree.recollar("pepper", "paprika")
+                tree.walk("/")
+        self.assertQuery(["mood=sleepy"], ["/mochi_copy", "/oreo"])
+        self.assertQuery(["age>=8"], ["/mochi_copy", "/upstairs/attic/ghost", "/upstairs/attic/paprika"])
+        self.assertQuery(["age=7"], [])
+        self.assertQuery(["mood=hungry"], ["/upstairs/attic/ghost", "/upstairs/attic/paprika"], scope="/upstairs")
+
+    def test_abort_restores_indexes(self):
+        indexed = self.trees[1]
+        with redirect_stdout(io.StringIO()):
+            indexed.begin()
+            indexed.meow("oreo", "mood", "grumpy")
+            indexed.rescue("newbie", Role.ADMIN)
+            indexed.meow("newbie", "mood", "hungry")
+            indexed.abort()
+        self.assertEqual(self.query(indexed, "mood=grumpy"), [])
+        self.assertEqual(self.query(indexed, "mood=hungry"), ["/oreo", "/upstairs/attic/ghost", "/upstairs/pepper"])
+
+    def test_indexes_rebuilt_on_load(self):
+        tree = self.trees[0]
+        loaded = DirectoryTree.load(tree.name, Role.ADMIN, property_indexes=("date_fed",))
+        self.assertEqual(self.query(loaded, "date_fed<=2026-10-12"), ["/oreo", "/upstairs/pepper"])
+        self.assertEqual(loaded.queries_indexed, 1)
+
+    def test_query_command(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertTrue(run_command(self.trees[1], "query mood=hungry --in /upstairs"))
+            self.assertTrue(run_command(self.trees[1], "query age>100"))
+            self.assertFalse(run_command(self.trees[1], "query colour=black"))
+            self.assertFalse(run_command(self.trees[1], "query age>old"))
+            self.assertFalse(run_command(self.trees[1], "query age"))
+            self.assertFalse(run_command(self.trees[1], "query age>1 --in"))
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[:4], ["/upstairs/attic/ghost", "/upstairs/pepper", "2 cats found", "No cats match"])
+        self.assertTrue(lines[4].startswith("Invalid property: colour"))
+        self.assertIn("number", lines[5])
+        self.assertTrue(lines[6].startswith("Invalid predicate: age"))
+
+class TestBulkLoad(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"bulkcafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN, property_indexes=("mood",))
+        self.dir = tempfile.mkdtemp()
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("resident", Role.ADMIN)
+            self.tree.mkcby("upstairs")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        if os.path.exists(self.tree._path):
+            os.remove(self.tree._path)
+
+    def write(self, filename, text):
+        path = os.path.join(self.dir, filename)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def test_csv_import(self):
+        path = self.write("cats.csv", "path,name,role,age,mood\n"
+                                      "/upstairs/attic,ghost,admin,13,hungry\n"
+                                      "/upstairs,pepper,Visitor,,playful\n"
+                                      ",tabby,,2,\n"
+                                      "upstairs/attic,boo,volunteer,1,\n")
+        with mock.patch.object(self.tree, "_save", wraps=self.tree._save) as save:
+            self.assertEqual(self.tree.bulk_load(path), (4, 1))
+        self.assertEqual(save.call_count, 1)
+        ghost = self.tree._traverse_to_node("/upstairs/attic/ghost")
+        self.assertEqual((ghost.required_role, ghost.age, ghost.mood), (Role.ADMIN, "13", "hungry"))
+        pepper = self.tree._traverse_to_node("/upstairs/pepper")
+        self.assertEqual((pepper.required_role, pepper.age, pepper.mood), (Role.VISITOR, None, "playful"))
+        self.assertEqual(self.tree._traverse_to_node("/tabby").required_role, Role.STAFF)
+        self.assertEqual([c.name for c in self.tree._traverse_to_node("/upstairs/attic").children], ["ghost", "boo"])
+        root, _, _ = read_cafe(self.tree._path)
+        self.assertEqual(sorted(c.name for c in root.children), ["resident", "tabby", "upstairs"])
+
+    def test_jsonl_import_is_relative_to_current_cubby(self):
+        path = self.write("cats.jsonl", '{"path": "attic", "name": "ghost", "age": 13, "mood": "hungry"}\n'
+                                        '\n'
+                                        '{"name": "mochi", "role": "admin", "date_fed": "2026-10-15"}\n')
+        with redirect_stdout(io.StringIO()):
+            self.tree.walk("upstairs")
+        self.assertEqual(self.tree.bulk_load(path), (2, 1))
+        ghost = self.tree._traverse_to_node("/upstairs/attic/ghost")
+        self.assertEqual(ghost.age, 13)
+        self.assertEqual(self.tree._traverse_to_node("/upstairs/mochi").date_fed, "2026-10-15")
+
+    def test_indexes_see_imported_cats(self):
+        path = self.write("cats.csv", "path,name,mood\n/a/b,ghost,hungry\n/a,boo,hungry\n")
+        with redirect_stdout(io.StringIO()):
+            self.tree.find("ghost")  # caches the miss path and sorts the cat names
+            self.tree.complete("/a")
+        self.tree.bulk_load(path)
+        self.assertEqual(self.tree._get_wd_of_node(self.tree._find_file_in_tree("ghost")), "/a/b/ghost")
+        self.assertEqual([p for p, _ in self.tree.iter_find("g*")], ["/a/b/ghost"])
+        self.assertEqual([p for p, _ in self.tree.iter_query(["mood=hungry"])], ["/a/b/ghost", "/a/boo"])
+        self.assertEqual(self.tree.queries_indexed, 1)
+        self.assertEqual(self.tree.complete("/a"), ["/a"])
+
+    def test_failed_import_changes_nothing(self):
+        before = os.path.getmtime(self.tree._path)
+        bad_rows = [
+            "/new,fine\n/upstairs,resident\n,resident\n",
+            "/new,fine\n/upstairs,cat,king\n",
+            "/new,fine\n/resident/inside,cat\n",
+            "/new,fine\n,bad/name\n",
+            "/new,fine\n..,cat\n",
+        ]
+        for rows in bad_rows:
+            path = self.write("bad.csv", "path,name,role\n" + rows)
+            with self.assertRaises(BulkFormatError) as raised:
+                self.tree.bulk_load(path)
+            self.assertIn("bad.csv:", str(raised.exception))
+            self.assertEqual(sorted(c.name for c in self.tree.root.children), ["resident", "upstairs"])
+            self.assertIsNone(self.tree._find_file_in_tree("fine"))
+        self.assertEqual(os.path.getmtime(self.tree._path), before)
+        with self.assertRaises(BulkFormatError):
+            self.tree.bulk_load(self.write("cats.txt", "name\nx\n"))
+        with self.assertRaises(BulkFormatError):
+            self.tree.bulk_load(self.write("cats.csv", "name,colour\nx,black\n"))
+        with self.assertRaises(BulkFormatError):
+            self.tree.bulk_load(self.write("cats.jsonl", '{"name": "x"}\n[1]\n'))
+
+    def test_jsonl_values_must_be_scalars(self):
+        for row in ('{"name": "x", "role": ["admin"]}', '{"name": "x", "role": {"admin": 1}}',
+                    '{"name": "x", "age": {"a": 1}}', '{"name": "x", "mood": ["hungry"]}'):
+            path = self.write("bad.jsonl", '{"name": "fine"}\n' + row + "\n")
+            with self.assertRaises(BulkFormatError) as raised:
+                self.tree.bulk_load(path)
+            self.assertIn("bad.jsonl:2:", str(raised.exception))
+            self.assertIsNone(self.tree._find_file_in_tree("fine"))
+
+    def test_import_command(self):
+        path = self.write("cats.jsonl", '{"path": "/upstairs", "name": "ghost"}\n{"path": "/x/y", "name": "boo"}\n')
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertTrue(run_command(self.tree, f"import {path}"))
+            self.assertFalse(run_command(self.tree, f"import {path}"))
+            self.assertFalse(run_command(self.tree, f"import {self.dir}/missing.csv"))
+            self.tree.begin()
+            self.assertFalse(run_command(self.tree, f"import {path}"))
+            self.tree.abort()
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], "Imported 2 cats and created 2 cubbies")
+        self.assertTrue(lines[1].startswith("Import failed, nothing was imported:"))
+        self.assertIn("already exists", lines[1])
+        self.assertTrue(lines[2].startswith("Import failed"))
+
+    def test_rollback_keeps_the_cats_already_there(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("tom")
+        path = self.write("bad.csv", "path,name\n,a\n/upstairs,b\n/upstairs/new,c\n,d\n,tom\n")
+        with self.assertRaises(BulkFormatError):
+            self.tree.bulk_load(path)
+        self.assertEqual([c.name for c in self.tree.root.children], ["resident", "upstairs", "tom"])
+        self.assertEqual(self.tree.root._by_name.keys(), {"resident", "upstairs", "tom"})
+        self.assertEqual(list(self.tree._traverse_to_node("/upstairs").children), [])
+
+    def test_import_flag(self):
+        path = self.write("cats.csv", "path,name\n/upstairs,ghost\n")
+        argv = ["main.py", "-n", self.cafe_name, "-p", "admin", "--import", path]
+        with mock.patch("sys.argv", argv), redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(main(), 0)
+            self.assertEqual(main(), 1)
+        self.assertIn("Imported 1 cat", output.getvalue())
+        root, _, _ = read_cafe(self.tree._path)
+        self.assertEqual([c.name for c in root.find_child("upstairs").children], ["ghost"])
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"exportcafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN)
+        self.copies = []
+        self.dir = tempfile.mkdtemp()
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("oreo", Role.VISITOR)
+            self.tree.meow("oreo", "mood", "sleepy, very ☕")
+            self.tree.mkcby("upstairs")
+            self.tree.mkcby("empty")
+            self.tree.rescue("tabby", Role.ADMIN)
+            self.tree.walk("upstairs")
+            self.tree.mkcby("attic")
+            self.tree.rescue("pepper", Role.VOLUNTEER)
+            self.tree.meow("pepper", "date_fed", "2026-10-12")
+            self.tree.walk("attic")
+            self.tree.rescue("ghost", Role.STAFF)
+            self.tree.walk("/")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        for tree in [self.tree] + self.copies:
+            if os.path.exists(tree._path):
+                os.remove(tree._path)
+
+    def copy(self):
+        tree = DirectoryTree(name=f"{self.cafe_name}_{len(self.copies)}", role=Role.ADMIN)
+        self.copies.append(tree)
+        return tree
+
+    def listing(self, tree, scope="/"):
+        return [(r["path"], r["name"], r["type"], r.get("role"), tuple(r.get(p) for p in CAT_PROPERTIES))
+                for r in tree.iter_records(scope)]
+
+    def test_records_are_in_prowl_order(self):
+        self.assertEqual([(r["path"], r["name"], r["type"]) for r in self.tree.iter_records()], [
+            ("/", "oreo", "cat"),
+            ("/", "upstairs", "cubby"),
+            ("/upstairs", "attic", "cubby"),
+            ("/upstairs/attic", "ghost", "cat"),
+            ("/upstairs", "pepper", "cat"),
+            ("/", "empty", "cubby"),
+            ("/", "tabby", "cat"),
+        ])
+        oreo = next(self.tree.iter_records())
+        self.assertEqual(oreo, {"path": "/", "name": "oreo", "type": "cat", "role": "visitor", "mood": "sleepy, very ☕"})
+
+    def test_roundtrip(self):
+        for filename in ("cafe.jsonl", "cafe.csv"):
+            path = os.path.join(self.dir, filename)
+            self.assertEqual(write_records(self.tree.iter_records(), path), 7)
+            copy = self.copy()
+            self.assertEqual(copy.bulk_load(path), (4, 3))
+            self.assertEqual(self.listing(copy), self.listing(self.tree))
+
+    def test_jsonl_keeps_value_types(self):
+        self.tree._traverse_to_node("/oreo").age = 3
+        self.tree._traverse_to_node("/tabby").age = 2.5
+        path = os.path.join(self.dir, "cafe.jsonl")
+        write_records(self.tree.iter_records(), path)
+        copy = self.copy()
+        copy.bulk_load(path)
+        self.assertEqual(copy._traverse_to_node("/oreo").age, 3)
+        self.assertEqual(copy._traverse_to_node("/tabby").age, 2.5)
+
+    def test_subtree_export(self):
+        path = os.path.join(self.dir, "upstairs.csv")
+        self.assertEqual(write_records(self.tree.iter_records("/upstairs"), path), 3)
+        copy = self.copy()
+        copy.bulk_load(path)
+        self.assertEqual(self.listing(copy, "/upstairs"), self.listing(self.tree, "/upstairs"))
+        self.assertEqual([c.name for c in copy.root.children], ["upstairs"])
+        with self.assertRaises(ValueError):
+            self.tree.iter_records("/oreo")
+
+    def test_deep_tree(self):
+        folder = self.tree.root
+        for i in range(5000):
+            child = FolderNode(f"level{i}", folder)
+            folder.add_child(child)
+            folder = child
+        folder.add_child(FileNode("bottom", Role.ADMIN, folder))
+        records = list(self.tree.iter_records())
+        self.assertEqual(records[-1]["name"], "bottom")
+        self.assertEqual(records[-1]["path"].count("/"), 5000)
+
+    def test_export_command(self):
+        path = os.path.join(self.dir, "attic.jsonl")
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertTrue(run_command(self.tree, f"export {path} --in upstairs/attic"))
+            self.assertFalse(run_command(self.tree, f"export {path}.txt"))
+            self.assertFalse(run_command(self.tree, f"export {path} --in nowhere"))
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], f"Exported 1 record to {path}")
+        self.assertTrue(lines[1].startswith("Export failed"))
+        self.assertTrue(lines[2].startswith("Export failed: Cubby nowhere not found"))
+        self.assertEqual(sorted(os.listdir(self.dir)), ["attic.jsonl"])
+        with open(path) as f:
+            self.assertEqual(json.loads(f.read()), {"path": "/upstairs/attic", "name": "ghost", "type": "cat", "role": "staff"})
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertTrue(run_command(self.tree, "export - --in /upstairs/attic"))
+        self.assertEqual(json.loads(output.getvalue())["name"], "ghost")
+
+    def test_cubby_rows(self):
+        path = os.path.join(self.dir, "cubbies.csv")
+        with open(path, "w") as f:
+            f.write("path,name,type,role\n/upstairs,attic,cubby,\n/new,box,cubby,\n")
+        self.assertEqual(self.tree.bulk_load(path), (0, 2))
+        self.assertFalse(self.tree._traverse_to_node("/new/box").is_file)
+        with open(path, "w") as f:
+            f.write("path,name,type,role\n/,box,cubby,admin\n")
+        with self.assertRaises(BulkFormatError):
+            self.tree.bulk_load(path)
+        with open(path, "w") as f:
+            f.write("path,name,type\n/,box,dog\n")
+        with self.assertRaises(BulkFormatError):
+            self.tree.bulk_load(path)
+
+class TestDentryCache(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"dentrycafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN)
+        with redirect_stdout(io.StringIO()):
+            for cubby in ("a", "b", "c"):
+                self.tree.mkcby(cubby)
+                self.tree.walk(cubby)
+            self.tree.rescue("tom", Role.ADMIN)
+        self.tree.current_node = self.tree.root
+        self.tree.set_dentry_cache_size(16)
+
+    def tearDown(self):
+        cafe_path = DirectoryTree.cafe_path(self.cafe_name)
+        if os.path.exists(cafe_path):
+            os.remove(cafe_path)
+
+    def uncached(self, path):
+        dentries, self.tree._dentries = self.tree._dentries, None
+        try:
+            return self.tree._traverse_to_node(path)
+        finally:
+            self.tree._dentries = dentries
+
+    def test_repeated_walk_hits(self):
+        with redirect_stdout(io.StringIO()):
+            for _ in range(3):
+                self.tree.walk("/a/b/c")
+        self.assertEqual((self.tree._dentries.hits, self.tree._dentries.misses), (2, 1))
+        self.assertIs(self.tree._traverse_to_node("/a/b/c/tom"), self.uncached("/a/b/c/tom"))
+
+    def test_relative_paths(self):
+        c = self.tree._traverse_to_node("/a/b/c")
+        with redirect_stdout(io.StringIO()):
+            self.tree.walk("a/b")
+            self.assertIs(self.tree._traverse_to_node("./c/../c/./tom"), c.find_child("tom"))
+            self.assertIs(self.tree._traverse_to_node("../.."), self.tree.root)
+            # the same relative path from another cubby is a different entry
+            self.tree.walk("c")
+            self.assertIsNone(self.tree._traverse_to_node("./c/../c/./tom"))
+            self.assertIsNone(self.tree._traverse_to_node("/.."))
+
+    def test_removed_cat_is_forgotten(self):
+        self.assertIsNotNone(self.tree._traverse_to_node("/a/b/c/tom"))
+        with redirect_stdout(io.StringIO()):
+            self.tree.walk("/a/b/c")
+            self.tree.adopted("tom")
+        self.assertIsNone(self.tree._traverse_to_node("/a/b/c/tom"))
+
+    def test_duplicate_names(self):
+        c = self.tree._traverse_to_node("/a/b/c")
+        with redirect_stdout(io.StringIO()):
+            self.tree.walk("/a/b/c")
+            self.tree.rescue("jerry", Role.ADMIN)
+            self.tree.copycat("tom", "tom2")
+            first = c.find_child("tom")
+            self.assertIs(self.tree._traverse_to_node("/a/b/c/tom"), first)
+            # an older sibling renamed to the same name now wins the lookup
+            self.tree.recollar("jerry", "tom")
+            self.assertIs(self.tree._traverse_to_node("/a/b/c/tom"), first)
+            self.tree.adopted("tom")
+            self.assertIs(self.tree._traverse_to_node("/a/b/c/tom").name, "tom")
+            self.assertIsNot(self.tree._traverse_to_node("/a/b/c/tom"), first)
+
+    def test_removed_or_renamed_cubby(self):
+        a = self.tree._traverse_to_node("/a")
+        b = self.tree._traverse_to_node("/a/b")
+        self.assertIsNotNone(self.tree._traverse_to_node("/a/b/c/tom"))
+        self.tree.current_node = b
+        self.assertIs(self.tree._traverse_to_node("../b/c"), b.find_child("c"))
+        self.tree._rename(self.tree.root, a, "z")
+        self.assertIsNone(self.tree._traverse_to_node("/a/b/c/tom"))
+        self.assertIsNotNone(self.tree._traverse_to_node("/z/b/c/tom"))
+        self.tree._detach(a, b)
+        self.assertIsNone(self.tree._traverse_to_node("/z/b/c/tom"))
+        self.assertIsNone(self.tree._traverse_to_node("../b/c"))
+
+    def test_abort_forgets_paths(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.begin()
+            self.tree.walk("/a/b/c")
+            self.tree.mkcby("d")
+            self.assertIsNotNone(self.tree._traverse_to_node("/a/b/c/d"))
+            self.tree.abort()
+        self.assertIsNone(self.tree._traverse_to_node("/a/b/c/d"))
+
+    def test_randomized_against_uncached(self):
+        rng = random.Random(7)
+        names = ["x", "y", "tom"]
+        paths = ["/a", "/a/b", "/a/b/c/tom", "x", "x/y", "..", "../x", "./tom", "/a/x/y", "y/../x", "tom"]
+        self.tree.set_dentry_cache_size(8)
+        with redirect_stdout(io.StringIO()):
+            for step in range(400):
+                folder = self.tree.current_node
+                op = rng.choice(["mkcby", "rescue", "recollar", "adopted", "carry", "put", "walk", "rmcby"])
+                name = rng.choice(names)
+                if op == "mkcby":
+                    self.tree.mkcby(name)
+                elif op == "rescue":
+                    self.tree.rescue(name, Role.ADMIN)
+                elif op == "recollar":
+                    self.tree.recollar(name, rng.choice(names))
+                elif op == "adopted":
+                    self.tree.adopted(name)
+                elif op == "carry":
+                    with mock.patch("random.random", return_value=0.0):
+                        self.tree.carry(name)
+                elif op == "put":
+                    self.tree.put()
+                elif op == "walk":
+                    self.tree.walk(rng.choice(paths))
+                elif op == "rmcby":
+                    cubby = folder.find_child(name)
+                    if cubby is not None and not cubby.is_file and cubby is not self.tree.current_node:
+                        self.tree._detach(folder, cubby)
+                for path in paths:
+                    self.assertIs(self.tree._traverse_to_node(path), self.uncached(path), f"step {step}: {op} broke {path}")
+        self.assertGreater(self.tree._dentries.hits, 0)
+
+class TestPathMemo(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"memocafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN)
+        with redirect_stdout(io.StringIO()):
+            for cubby in ("a", "b", "c"):
+                self.tree.mkcby(cubby)
+                self.tree.walk(cubby)
+            self.tree.rescue("tom", Role.ADMIN)
+            self.tree.walk("/")
+            self.tree.mkcby("z")
+        self.a = self.tree._traverse_to_node("/a")
+        self.tom = self.tree._traverse_to_node("/a/b/c/tom")
+
+    def tearDown(self):
+        cafe_path = DirectoryTree.cafe_path(self.cafe_name)
+        if os.path.exists(cafe_path):
+            os.remove(cafe_path)
+
+    def climb(self, node):
+        """The path the slow way, without memos"""
+        names = []
+        while node is not None and node is not self.tree.root:
+            names.append(node.name)
+            node = node.parent
+        return "/" + "/".join(reversed(names))
+
+    def assert_paths(self):
+        for folder in self.tree._iter_folders():
+            for node in [folder, *folder.children]:
+                self.assertEqual(self.tree._get_wd_of_node(node), self.climb(node))
+                self.assertEqual(self.tree._get_depth_of_node(node), self.climb(node).count("/") - (node is self.tree.root))
+
+    def test_paths_and_depths(self):
+        self.assertEqual(self.tree._get_wd_of_node(self.tom), "/a/b/c/tom")
+        self.assertEqual(self.tree._get_depth_of_node(self.tom), 4)
+        self.assertEqual(self.tree._get_wd_of_node(self.tree.root), "/")
+        self.assertEqual(self.tree._get_depth_of_node(self.tree.root), 0)
+        # the cubbies above were memoized on the way
+        self.assertEqual(self.tree._traverse_to_node("/a/b")._wd, ("/a/b", 2))
+        out = io.StringIO()
+        with redirect_stdout(out):
+            self.tree.find("tom")
+            self.tree.walk("/a/b")
+            self.tree.pawprint()
+        self.assertEqual(out.getvalue().split("\n")[0], "Found tom in /a/b/c/tom")
+        self.assertIn("/a/b", out.getvalue())
+
+    def test_renamed_cubby_invalidates_subtree(self):
+        self.tree._get_wd_of_node(self.tom)
+        self.tree._rename(self.tree.root, self.a, "aa")
+        self.assertEqual(self.tree._get_wd_of_node(self.tom), "/aa/b/c/tom")
+        self.assert_paths()
+
+    def test_moved_cubby_invalidates_subtree(self):
+        self.tree._get_wd_of_node(self.tom)
+        b = self.a.find_child("b")
+        self.tree._detach(self.a, b)
+        self.assertEqual(self.tree._get_wd_of_node(self.tom), self.climb(self.tom))
+        self.assertIsNone(self.tom._wd)  # detached, so not memoized
+        self.tree._attach(self.tree._traverse_to_node("/z"), b)
+        self.assertEqual(self.tree._get_wd_of_node(self.tom), "/z/b/c/tom")
+        self.assert_paths()
+
+    def test_carried_and_put_cat(self):
+        self.tree._get_wd_of_node(self.tom)
+        self.tree.current_node = self.tom.parent
+        self.tree._mutate("carry", "tom")
+        self.assertEqual(self.tree._get_wd_of_node(self.tom), self.climb(self.tom))
+        self.assertIsNone(self.tom._wd)
+        with redirect_stdout(io.StringIO()):
+            self.tree.walk("/z")
+            self.tree.put("tom")
+        self.assertEqual(self.tree._get_wd_of_node(self.tom), "/z/tom")
+
+    def test_abort_restores_paths(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.begin()
+            self.tree.walk("/a/b/c")
+            self.tree._mutate("carry", "tom")
+            self.tree.walk("/z")
+            self.tree.put("tom")
+            self.tree.recollar("tom", "thomas")
+            self.assertEqual(self.tree._get_wd_of_node(self.tom), "/z/thomas")
+            self.tree.abort()
+        self.assertEqual(self.tree._get_wd_of_node(self.tom), "/a/b/c/tom")
+        self.assert_paths()
+
+class TestTransactions(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"txncafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN, cache_size=5)
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("whiskers", Role.ADMIN)
+            self.tree.rescue("mittens", Role.ADMIN)
+            self.tree.rescue("socks", Role.ADMIN)
+            self.tree.meow("mittens", "mood", "grumpy")
+            self.tree.mkcby("cubby1")
+
+    def tearDown(self):
+        if self.tree._journal is not None:
+            self.tree._journal.close()
+        for ext in ("cafe", "journal"):
+            path = os.path.join("cafes", f"{self.cafe_name}.{ext}")
+            if os.path.exists(path):
+                os.remove(path)
+
+    def saved_root(self):
+        return read_cafe(self.tree._path)[0]
+
+    def test_commit_saves_once(self):
+        with mock.patch.object(DirectoryTree, "_save", autospec=True,
+                               side_effect=DirectoryTree._save) as save, redirect_stdout(io.StringIO()):
+            self.tree.begin()
+            for i in range(20):
+                self.tree.rescue(f"kitten{i}", Role.ADMIN)
+            self.assertIsNone(self.saved_root().find_child("kitten0"))
+            self.tree.commit()
+        self.assertEqual(save.call_count, 1)
+        self.assertIsNotNone(self.saved_root().find_child("kitten19"))
+
+    def test_abort_rolls_back(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.find("mittens")
+            self.tree.begin()
+            self.tree.rescue("kitten", Role.ADMIN)
+            self.tree.meow("mittens", "mood", "happy")
+            self.tree.recollar("mittens", "mittens_new")
+            self.tree.adopted("whiskers")
+            self.tree._mutate("carry", "socks")
+            self.tree.walk("cubby1")
+            self.tree.mkcby("inner")
+            self.tree.abort()
+        self.assertIs(self.tree.current_node, self.tree.root)
+        self.assertEqual(self.tree.carried_cats, [])
+        self.assertEqual([c.name for c in self.tree.root.children], ["whiskers", "mittens", "socks", "cubby1"])
+        self.assertEqual(self.tree._find_node_in_current("mittens").get_property("mood"), "grumpy")
+        self.assertIsNone(self.tree._traverse_to_node("/cubby1/inner"))
+        self.assertIsNone(self.tree._find_file_in_tree("kitten"))
+        self.assertIsNone(self.tree._find_file_in_tree("mittens_new"))
+        for name in ("whiskers", "mittens", "socks"):
+            self.assertIs(self.tree._find_file_in_tree(name).parent, self.tree.root)
+
+    def test_context_manager(self):
+        with redirect_stdout(io.StringIO()):
+            with self.tree.transaction():
+                self.tree.rescue("kitten", Role.ADMIN)
+            with self.assertRaises(ValueError):
+                with self.tree.transaction():
+                    self.tree.adopted("kitten")
+                    raise ValueError("changed my mind")
+        self.assertFalse(self.tree.in_transaction)
+        self.assertIsNotNone(self.tree._find_node_in_current("kitten"))
+        self.assertIsNotNone(self.saved_root().find_child("kitten"))
+
+    def test_journaled_commit_is_one_record(self):
+        self.tree.enable_journal()
+        with redirect_stdout(io.StringIO()):
+            with self.tree.transaction():
+                self.tree.rescue("kitten", Role.ADMIN)
+                self.tree.meow("kitten", "age", "1")
+                self.tree.walk("cubby1")
+                self.tree.rescue("shadow", Role.ADMIN)
+        self.tree._journal.close()
+        self.assertEqual(len(list(Journal(self.tree._journal_path).records())), 1)
+        tree = load_or_create_tree(self.cafe_name, Role.ADMIN)
+        self.assertEqual(tree._find_node_in_current("kitten").get_property("age"), "1")
+        self.assertIsNotNone(tree._traverse_to_node("/cubby1/shadow"))
+
+class TestScriptMode(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"scriptcafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN)
+
+    def tearDown(self):
+        cafe_path = DirectoryTree.cafe_path(self.cafe_name)
+        if os.path.exists(cafe_path):
+            os.remove(cafe_path)
+
+    def run_lines(self, lines, keep_going=False):
+        out, err = io.StringIO(), io.StringIO()
+        with mock.patch.object(DirectoryTree, "_save", autospec=True,
+                               side_effect=DirectoryTree._save) as save, \
+                redirect_stdout(out), mock.patch("sys.stderr", err):
+            code = run_script(self.tree, lines, keep_going)
+        return code, out.getvalue(), err.getvalue(), save.call_count
+
+    def test_script_saves_once(self):
+        lines = ["# intake", "mkcby intake", "walk intake", ""] + [f"rescue cat{i} volunteer" for i in range(50)]
+        code, out, err, saves = self.run_lines(lines)
+        self.assertEqual((code, err, saves), (0, "", 1))
+        self.assertNotIn("catfs", out)
+        self.assertEqual(self.tree._traverse_to_node("/intake/cat49").required_role, Role.VOLUNTEER)
+
+    def test_script_stops_on_first_error(self):
+        code, out, err, saves = self.run_lines(["rescue tom", "cat nope", "rescue jerry"])
+        self.assertEqual(code, 1)
+        self.assertIn(":2: command failed: cat nope", err)
+        self.assertIsNone(self.tree._find_node_in_current("jerry"))
+        # what ran before the failure is still saved
+        self.assertEqual(saves, 1)
+        self.assertIsNotNone(read_cafe(self.tree._path)[0].find_child("tom"))
+
+    def test_script_keep_going(self):
+        code, out, err, saves = self.run_lines(["rescue tom", "bogus command", "rescue jerry"], keep_going=True)
+        self.assertEqual(code, 1)
+        self.assertIsNotNone(self.tree._find_node_in_current("jerry"))
+
+    def test_command_results(self):
+        with redirect_stdout(io.StringIO()):
+            self.assertTrue(run_command(self.tree, "rescue tom"))
+            self.assertFalse(run_command(self.tree, "rescue tom"))
+            self.assertFalse(run_command(self.tree, "rescue tom notarole"))
+            self.assertTrue(run_command(self.tree, "find nobody"))
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"journalcafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN, journal=True)
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("whiskers", Role.ADMIN)
+            self.tree.meow("whiskers", "mood", "sleepy")
+            self.tree.mkcby("cubby1")
+            self.tree.walk("cubby1")
+            self.tree.rescue("shadow", Role.VOLUNTEER)
+            self.tree.walk("/")
+
+    def tearDown(self):
+        self.tree._journal.close()
+        for ext in ("cafe", "journal"):
+            path = os.path.join("cafes", f"{self.cafe_name}.{ext}")
+            if os.path.exists(path):
+                os.remove(path)
+
+    def reload(self):
+        return load_or_create_tree(self.cafe_name, Role.ADMIN)
+
+    def test_mutations_are_journaled_not_snapshotted(self):
+        self.assertGreater(os.path.getsize(self.tree._journal_path), 0)
+        snapshot, _, _ = read_cafe(self.tree._path)
+        self.assertIsNone(snapshot.find_child("whiskers"))
+
+    def test_replay_restores_tree(self):
+        tree = self.reload()
+        whiskers = tree._find_node_in_current("whiskers")
+        self.assertIsNotNone(whiskers)
+        self.assertEqual(whiskers.get_property("mood"), "sleepy")
+        self.assertIsNotNone(tree._traverse_to_node("/cubby1/shadow"))
+
+    def test_torn_record_is_discarded(self):
+        size = os.path.getsize(self.tree._journal_path)
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("mittens", Role.VISITOR)
+        # Simulate a crash partway through writing the last record
+        with open(self.tree._journal_path, "r+b") as f:
+            f.truncate(os.path.getsize(self.tree._journal_path) - 3)
+        tree = self.reload()
+        self.assertIsNone(tree._find_node_in_current("mittens"))
+        self.assertIsNotNone(tree._find_node_in_current("whiskers"))
+        self.assertEqual(os.path.getsize(self.tree._journal_path), size)
+
+    def test_checkpoint_rewrites_snapshot(self):
+        self.tree.checkpoint_bytes = 1
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("mittens", Role.VISITOR)
+        self.assertEqual(os.path.getsize(self.tree._journal_path), 0)
+        snapshot, _, _ = read_cafe(self.tree._path)
+        self.assertIsNotNone(snapshot.find_child("mittens"))
+        self.assertEqual(self.reload().replay_journal(), 0)
+
+    def test_replay_skips_records_already_in_snapshot(self):
+        # A crash between writing the snapshot and emptying the journal must not double-apply
+        with open(self.tree._journal_path, "rb") as f:
+            records = f.read()
+        self.tree._save()
+        with open(self.tree._journal_path, "wb") as f:
+            f.write(records)
+        tree = self.reload()
+        self.assertEqual(len([c for c in tree.root.children if c.name == "whiskers"]), 1)
+
+class TestBackgroundSaves(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"bgcafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN, background=True)
+
+    def tearDown(self):
+        self.tree.close()
+        if os.path.exists(self.tree._path):
+            os.remove(self.tree._path)
+
+    def saved_names(self):
+        return [c.name for c in read_cafe(self.tree._path)[0].children]
+
+    def test_saves_happen_off_the_command_thread(self):
+        threads = []
+        def save(tree):
+            threads.append(threading.current_thread().name)
+            DirectoryTree._save(tree)
+        self.tree._writer.save = lambda: save(self.tree)
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("whiskers", Role.ADMIN)
+            self.tree.sync()
+        self.assertEqual(threads, ["catfs-writer"])
+        self.assertEqual(self.saved_names(), ["whiskers"])
+
+    def test_burst_is_coalesced(self):
+        self.tree._writer.delay = 0.5
+        with redirect_stdout(io.StringIO()):
+            for i in range(100):
+                self.tree.rescue(f"kitten{i}", Role.ADMIN)
+            self.assertNotIn("kitten99", self.saved_names())
+            self.tree.sync()
+        self.assertLessEqual(self.tree._writer.saves, 2)
+        self.assertEqual(len(self.saved_names()), 100)
+        self.assertFalse(os.path.exists(self.tree._path + ".tmp"))
+
+    def test_transaction_changes_wait_for_commit(self):
+        self.tree._writer.delay = 0.5
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("whiskers", Role.ADMIN)
+            # begin flushes what came before it
+            self.tree.begin()
+            self.assertEqual(self.saved_names(), ["whiskers"])
+            self.tree.rescue("kitten", Role.ADMIN)
+            self.tree.sync()
+            self.assertEqual(self.saved_names(), ["whiskers"])
+            self.tree.commit()
+            self.tree.sync()
+        self.assertEqual(self.saved_names(), ["whiskers", "kitten"])
+
+    def test_close_flushes(self):
+        self.tree._writer.delay = 10
+        with redirect_stdout(io.StringIO()):
+            self.tree.mkcby("cubby1")
+        self.tree.close()
+        self.assertEqual(self.saved_names(), ["cubby1"])
+
+    def test_failed_save_is_reported_by_sync(self):
+        self.tree._writer.save = mock.Mock(side_effect=OSError("disk full"))
+        out = io.StringIO()
+        with redirect_stdout(out), mock.patch("sys.stderr", io.StringIO()):
+            self.tree.rescue("whiskers", Role.ADMIN)
+            self.assertFalse(self.tree.sync())
+        self.assertIn("Sync failed: disk full", out.getvalue())
+
+    def test_commands_do_not_wait_for_a_save_to_encode(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.mkcby("upstairs")
+            self.tree.rescue("whiskers", Role.ADMIN)
+            self.tree.sync()
+        encoding = threading.Event()
+        release = threading.Event()
+        changed = SaveSnapshot.changed
+        def slow_changed(snapshot):
+            encoding.set()
+            release.wait(5)
+            return changed(snapshot)
+        encoded = []
+        def record(path, data):
+            encoded.append(data)
+            write_cafe(path, data)
+        with mock.patch.object(SaveSnapshot, "changed", slow_changed), mock.patch("directory.write_cafe", record), \
+                mock.patch("random.random", return_value=0.0), redirect_stdout(io.StringIO()):
+            self.tree.meow("whiskers", "mood", "sleepy")
+            self.assertTrue(encoding.wait(5))
+            # the save has read the tree and is still encoding it
+            start = time.perf_counter()
+            self.tree.recollar("whiskers", "tom")
+            self.tree.meow("tom", "mood", "hungry")
+            self.tree.carry("tom")
+            self.tree.walk("upstairs")
+            self.tree.put()
+            self.tree.rescue("felix")
+            self.assertLess(time.perf_counter() - start, 1)
+            release.set()
+            self.tree.sync()
+        path = os.path.join(tempfile.mkdtemp(), "first.cafe")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        write_cafe(path, encoded[0])
+        root, carried, _ = read_cafe(path)
+        self.assertEqual([(c.name, c.mood) for c in root.children if c.is_file], [("whiskers", "sleepy")])
+        self.assertEqual([c.name for c in next(c for c in root.children if not c.is_file).children], [])
+        root, carried, _ = read_cafe(self.tree._path)
+        self.assertEqual([c.name for c in root.children], ["upstairs"])
+        self.assertEqual([(c.name, c.mood) for c in next(iter(root.children)).children], [("tom", "hungry"), ("felix", None)])
+
+class TestReadWriteLock(unittest.TestCase):
+    def setUp(self):
+        self.lock = ReadWriteLock()
+
+    def in_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread
+
+    def test_readers_share(self):
+        both_in = threading.Barrier(2, timeout=5)
+        def read():
+            with self.lock.read():
+                both_in.wait()
+        threads = [self.in_thread(read) for _ in range(2)]
+        for thread in threads:
+            thread.join()
+        self.assertFalse(both_in.broken)
+
+    def test_writer_waits_for_readers(self):
+        events = []
+        def write():
+            with self.lock.write():
+                events.append("write")
+        with self.lock.read():
+            thread = self.in_thread(write)
+            time.sleep(0.05)
+            events.append("read done")
+        thread.join()
+        self.assertEqual(events, ["read done", "write"])
+
+    def test_waiting_writer_goes_before_new_readers(self):
+        events = []
+        def write():
+            with self.lock.write():
+                events.append("write")
+        def read():
+            with self.lock.read():
+                events.append("read")
+        with self.lock.read():
+            writer = self.in_thread(write)
+            while not self.lock._waiting_writers:
+                time.sleep(0.001)
+            reader = self.in_thread(read)
+            time.sleep(0.05)
+            self.assertEqual(events, [])
+        writer.join()
+        reader.join()
+        self.assertEqual(events, ["write", "read"])
+
+    def test_writer_can_reenter(self):
+        with self.lock.write():
+            with self.lock.write():
+                with self.lock.read():
+                    pass
+        # released every time it was taken, so another thread can write
+        thread = self.in_thread(lambda: self.lock.write().__enter__())
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"servercafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN)
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("whiskers", Role.ADMIN)
+            self.tree.mkcby("upstairs")
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "cafe.sock")
+        self.server = self.make_server()
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+        self.clients = []
+
+    def make_server(self, **options):
+        return CatServer(self.tree, self.path, run_command)
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.tree.close()
+        shutil.rmtree(self.dir)
+        if os.path.exists(self.tree._path):
+            os.remove(self.tree._path)
+
+    def connect(self, role="admin"):
+        client = CatClient(self.path, role)
+        self.clients.append(client)
+        return client
+
+    def send(self, client, line):
+        out = []
+        ok = client.send(line, out.append)
+        return ok, "".join(out)
+
+    def disconnect(self, client):
+        sessions = len(self.tree._client_sessions)
+        client.close()
+        deadline = time.time() + 5
+        while len(self.tree._client_sessions) == sessions and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_each_client_has_its_own_cubby_and_role(self):
+        staff, visitor = self.connect("staff"), self.connect("visitor")
+        self.assertTrue(self.send(staff, "walk upstairs")[0])
+        self.assertEqual(self.send(staff, "pawprint"), (True, "Current cubby: /upstairs\n"))
+        self.assertEqual(self.send(visitor, "pawprint"), (True, "Current cubby: /\n"))
+        self.assertEqual(self.send(visitor, "boop whiskers"), (False, "Permission denied: you need grooming permission\n"))
+        # the tree's own session is untouched
+        self.assertIs(self.tree.current_node, self.tree.root)
+        self.assertEqual(self.tree.role, Role.ADMIN)
+
+    def test_carried_cats_belong_to_their_client(self):
+        carrier, other = self.connect(), self.connect()
+        with mock.patch("random.random", return_value=0.0):
+            self.assertTrue(self.send(carrier, "carry whiskers")[0])
+        self.assertEqual(self.send(other, "carrying"), (True, "Not carrying any cats\n"))
+        self.assertEqual(self.send(other, "put whiskers"), (False, "Not carrying whiskers\n"))
+        self.assertEqual([cat.name for cat in read_cafe(self.tree._path)[1]], ["whiskers"])
+        # cats still carried when the client leaves stay carried, by the tree
+        self.disconnect(carrier)
+        self.assertEqual([cat.name for cat in self.tree.carried_cats], ["whiskers"])
+
+    def test_mutations_from_many_clients(self):
+        clients = [self.connect() for _ in range(8)]
+        failures = []
+        def rescue(i, client):
+            for j in range(25):
+                if not client.send(f"rescue cat_{i}_{j}", lambda line: None):
+                    failures.append((i, j))
+        threads = [threading.Thread(target=rescue, args=item) for item in enumerate(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+        saved = [node.name for node in read_cafe(self.tree._path)[0].children]
+        self.assertEqual(len(saved), 2 + 8 * 25)
+        self.assertEqual(len(self.tree._name_index), 1 + 8 * 25)
+
+    def test_reads_share_the_tree_and_writes_wait(self):
+        release = threading.Event()
+        def run(tree, line):
+            if line == "prowl":
+                release.wait(5)
+            return run_command(tree, line)
+        self.server.run = run
+        slow, reader, writer = self.connect(), self.connect(), self.connect()
+        prowling = threading.Thread(target=self.send, args=(slow, "prowl"))
+        prowling.start()
+        while not self.tree.rwlock._readers:
+            time.sleep(0.001)
+        self.assertEqual(self.send(reader, "pawprint"), (True, "Current cubby: /\n"))
+        rescuing = threading.Thread(target=self.send, args=(writer, "rescue tom"))
+        rescuing.start()
+        time.sleep(0.05)
+        self.assertIsNone(self.tree.root.find_child("tom"))
+        release.set()
+        prowling.join()
+        rescuing.join()
+        self.assertIsNotNone(self.tree.root.find_child("tom"))
+
+    def test_concurrent_readers_get_their_own_output(self):
+        with redirect_stdout(io.StringIO()):
+            for i in range(8):
+                self.tree.mkcby(f"room{i}")
+        clients = [self.connect() for _ in range(8)]
+        wrong = []
+        def read(i, client):
+            client.send(f"walk room{i}", lambda line: None)
+            for _ in range(50):
+                ok, out = self.send(client, "pawprint")
+                if out != f"Current cubby: /room{i}\n":
+                    wrong.append(out)
+                ok, out = self.send(client, "find whiskers")
+                if out != "Found whiskers in /whiskers\n":
+                    wrong.append(out)
+        threads = [threading.Thread(target=read, args=item) for item in enumerate(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(wrong, [])
+
+    def test_transactions_are_refused(self):
+        client = self.connect()
+        self.assertEqual(self.send(client, "begin"), (False, "Transactions are not available to server clients\n"))
+        self.assertFalse(self.tree.in_transaction)
+
+    def test_completion(self):
+        client = self.connect()
+        self.assertEqual(client.complete("wh"), ["whiskers"])
+        self.assertEqual(client.complete("up"), ["upstairs"])
+
+    def test_script_through_client(self):
+        client = self.connect()
+        with redirect_stdout(io.StringIO()), mock.patch("sys.stderr", io.StringIO()):
+            code = run_script(client, ["walk upstairs", "rescue tom", "cat nobody", "rescue jerry"], keep_going=True,
+                              run=CatClient.run_command)
+        self.assertEqual(code, 1)
+        self.assertEqual(sorted(self.tree._name_index), ["jerry", "tom", "whiskers"])
+
+    def test_invalid_role_is_refused(self):
+        with self.assertRaises(ValueError):
+            CatClient(self.path, "owner")
+
+    def test_second_server_on_the_same_socket(self):
+        with self.assertRaises(RuntimeError):
+            self.make_server()
+
+class TestAsyncServer(TestServer):
+    """Runs every TestServer test against the asyncio front end, plus its own"""
+    def make_server(self, **options):
+        return AsyncCatServer(self.tree, self.path, run_command, **options)
+
+    def restart(self, **options):
+        self.server.shutdown()
+        self.thread.join()
+        self.server = self.make_server(**options)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+
+    def test_cheap_reads_stay_on_the_loop(self):
+        threads = {}
+        def run(tree, line):
+            threads[line] = threading.current_thread().name
+            return run_command(tree, line)
+        self.server.run = run
+        client = self.connect()
+        self.send(client, "pawprint")
+        self.send(client, "find whiskers")
+        self.send(client, "find --all whisk*")
+        self.send(client, "rescue tom")
+        self.assertEqual(threads["pawprint"], self.thread.name)
+        # the name index answers a plain find straight away
+        self.assertEqual(threads["find whiskers"], self.thread.name)
+        self.assertTrue(threads["find --all whisk*"].startswith("catfs-session"))
+        self.assertTrue(threads["rescue tom"].startswith("catfs-session"))
+        # with shards left to read even a cheap read may have to go to disk
+        with mock.patch.object(self.tree, "_shards", mock.Mock(unloaded={self.tree.root})):
+            self.send(client, "walk upstairs")
+            self.send(client, "help")
+        self.assertTrue(threads["walk upstairs"].startswith("catfs-session"))
+        self.assertEqual(threads["help"], self.thread.name)
+
+    def test_cheap_read_waits_for_a_writer_off_the_loop(self):
+        client = self.connect()
+        with self.tree.rwlock.write():
+            replies = []
+            reading = threading.Thread(target=lambda: replies.append(self.send(client, "pawprint")))
+            reading.start()
+            time.sleep(0.05)
+            self.assertEqual(replies, [])
+            # meanwhile the loop is free to let other clients in
+            self.connect()
+        reading.join()
+        self.assertEqual(replies, [(True, "Current cubby: /\n")])
+
+    def test_command_gives_up_on_a_busy_tree(self):
+        self.restart(lock_timeout=0.05)
+        client = self.connect()
+        with self.tree.rwlock.read():
+            ok, out = self.send(client, "rescue tom")
+        self.assertFalse(ok)
+        self.assertIn("busy", out)
+        self.assertIsNone(self.tree.root.find_child("tom"))
+        self.assertTrue(self.send(client, "rescue tom")[0])
+
+    def test_idle_session_is_disconnected(self):
+        self.restart(idle_timeout=0.05)
+        client = self.connect()
+        with mock.patch("random.random", return_value=0.0):
+            self.send(client, "carry whiskers")
+        deadline = time.time() + 5
+        while self.tree._client_sessions and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.tree._client_sessions, set())
+        self.assertEqual([cat.name for cat in self.tree.carried_cats], ["whiskers"])
+        with self.assertRaises(ConnectionError):
+            client.send("pawprint", lambda line: None)
+
+    def test_client_that_stops_reading_is_disconnected(self):
+        self.restart(send_timeout=0.5)
+        with redirect_stdout(io.StringIO()), self.tree.deferred_saves():
+            for i in range(5000):
+                self.tree.rescue(f"kitten_with_a_long_name_{i}", Role.ADMIN)
+        slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        slow.connect(self.path)
+        slow.sendall(b"admin\nexport -\n")
+        # the export is spooled and the tree let go before it fills the socket buffers, so writers need not wait
+        client = self.connect()
+        time.sleep(0.05)
+        start = time.time()
+        self.assertTrue(self.send(client, "rescue tom")[0])
+        self.assertLess(time.time() - start, 0.25)
+        deadline = time.time() + 5
+        while len(self.tree._client_sessions) > 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.tree._client_sessions), 1)
+        slow.close()
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"storagecafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN)
+
+    def tearDown(self):
+        for path in (self.tree._path, self.tree._legacy_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def listing(self, tree):
+        """Every node as (path, kind, role, properties), in prowl order"""
+        rows = []
+        stack = [tree.root]
+        while stack:
+            node = stack.pop()
+            if node.is_file:
+                rows.append((tree._get_wd_of_node(node), "cat", node.required_role, dict(node.content)))
+            else:
+                rows.append((tree._get_wd_of_node(node), "cubby", None, None))
+                stack.extend(reversed(list(node.children)))
+        return rows
+
+    def test_roundtrip(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("whiskers", Role.VISITOR)
+            self.tree.meow("whiskers", "mood", "sleepy ☕")
+            self.tree.mkcby("cubby1")
+            self.tree.walk("cubby1")
+            self.tree.rescue("shadow", Role.VOLUNTEER)
+            self.tree.rescue("smudge", Role.STAFF)
+            self.tree.mkcby("inner")
+            self.tree.recollar("smudge", "shadow")
+            self.tree.carry("whiskers")
+        shadow, smudge = [c for c in self.tree.current_node.children if c.name == "shadow"]
+        shadow.age, shadow.date_fed, shadow.date_found, shadow.mood = 3, 1.5, True, ""
+        # a NUL in any string switches its table to the length-prefixed layout
+        smudge.date_fed = "noon\0ish"
+        self.tree.carried_cats.append(FileNode("tabby", Role.ADMIN))
+        self.tree._save()
+
+        tree = DirectoryTree.load(self.cafe_name, Role.VISITOR)
+        self.assertEqual(self.listing(tree), self.listing(self.tree))
+        self.assertEqual([c.name for c in tree.carried_cats], [c.name for c in self.tree.carried_cats])
+        self.assertEqual(tree._find_file_in_tree("shadow").age, 3)
+
+    def test_session_state_is_not_saved(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.mkcby("cubby1")
+            self.tree.walk("cubby1")
+        self.tree.set_cache_size(5)
+        tree = DirectoryTree.load(self.cafe_name)
+        self.assertIs(tree.current_node, tree.root)
+        self.assertEqual(tree.role, Role.VISITOR)
+        self.assertIsNone(tree.cache)
+
+    def test_deep_tree(self):
+        folder = self.tree.root
+        for i in range(5 * sys.getrecursionlimit()):
+            child = FolderNode(f"deep{i}", folder)
+            folder.add_child(child)
+            folder = child
+        folder.add_child(FileNode("bottom", Role.ADMIN, folder))
+        self.tree._save()
+        tree = DirectoryTree.load(self.cafe_name)
+        self.assertEqual(tree._get_wd_of_node(tree._find_file_in_tree("bottom")).count("/"), 5 * sys.getrecursionlimit() + 1)
+        node = tree.root
+        while not node.is_file:
+            node = next(iter(node.children))
+        self.assertEqual(node.name, "bottom")
+
+    def test_legacy_pickle_migrates(self):
+        shutil.copy(os.path.join("cafes", "test1.pkl"), self.tree._legacy_path)
+        os.remove(self.tree._path)
+        tree = load_or_create_tree(self.cafe_name, Role.ADMIN)
+        self.assertEqual(tree._find_file_in_tree("bob").name, "bob")
+        self.assertTrue(os.path.exists(self.tree._path))
+        with open(self.tree._path, "rb") as f:
+            self.assertEqual(f.read(5), b"CATFS")
+        # parents are stored by position, so the migrated file links every cat to the cubby holding it
+        migrated = DirectoryTree.load(self.cafe_name)
+        self.assertEqual(migrated._get_wd_of_node(migrated._find_file_in_tree("bob")), "/cafe/bob")
+
+    def test_tree_still_pickles(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("whiskers", Role.ADMIN)
+        with open(self.tree._legacy_path, "wb") as f:
+            pickle.dump(self.tree, f)
+        os.remove(self.tree._path)
+        tree = DirectoryTree.load(self.cafe_name)
+        self.assertEqual(tree._find_file_in_tree("whiskers").name, "whiskers")
+
+    def test_newer_format_is_rejected(self):
+        with open(self.tree._path, "r+b") as f:
+            f.seek(5)
+            f.write(struct.pack("<H", 999))
+        with self.assertRaises(CafeFormatError):
+            DirectoryTree.load(self.cafe_name)
+
+class TestShardedStorage(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"shardcafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN, sharded=True)
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("whiskers", Role.VISITOR)
+            self.tree.mkcby("cubby1")
+            self.tree.mkcby("cubby2")
+            self.tree.walk("cubby1")
+            self.tree.rescue("shadow", Role.VOLUNTEER)
+
+    def tearDown(self):
+        self.tree.close()
+        shutil.rmtree(self.tree._shard_path, ignore_errors=True)
+        if os.path.exists(self.tree._path):
+            os.remove(self.tree._path)
+
+    listing = TestStorage.listing
+
+    def shard(self, path):
+        return f"{self.tree._shards.ids[self.tree._traverse_to_node(path)]}.shard"
+
+    def written(self, *commands):
+        """The shards each command rewrote"""
+        saves = []
+        write = ShardStore.write
+        def record(store, save, meta):
+            saves.append(set(save.shards))
+            return write(store, save, meta)
+        with mock.patch.object(ShardStore, "write", record), mock.patch("random.random", return_value=0.0), \
+                redirect_stdout(io.StringIO()):
+            for command in commands:
+                run_command(self.tree, command)
+        return saves
+
+    def test_roundtrip(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.meow("shadow", "mood", "sleepy ☕")
+            self.tree.mkcby("inner")
+            self.tree.walk("inner")
+            self.tree.rescue("smudge", Role.ADMIN)
+            self.tree.meow("smudge", "date_fed", "noon\0ish")
+            self.tree.walk("/")
+            self.tree.recollar("cubby2", "cubby3")
+        with mock.patch("random.random", return_value=0.0), redirect_stdout(io.StringIO()):
+            self.tree.carry("whiskers")
+        tree = DirectoryTree.load(self.cafe_name)
+        self.assertEqual(self.listing(tree), self.listing(self.tree))
+        self.assertEqual([c.name for c in tree.carried_cats], ["whiskers"])
+        self.assertEqual(tree._find_file_in_tree("smudge").date_fed, "noon\0ish")
+        self.assertFalse(os.path.exists(self.tree._path))
+
+    def test_mutations_rewrite_only_the_shards_they_touch(self):
+        cubby1, cubby2 = self.shard("/cubby1"), self.shard("/cubby2")
+        self.assertEqual(self.written("rescue mittens", "meow mittens mood hungry", "adopted shadow"), [{cubby1}] * 3)
+        [saved] = self.written("mkcby inner")
+        self.assertEqual(saved, {cubby1, self.shard("/cubby1/inner")})
+        self.assertEqual(self.written("carry mittens", "walk /cubby2", "put mittens"),
+                         [{cubby1, "carried.shard"}, {cubby2, "carried.shard"}])
+        self.assertIsNotNone(DirectoryTree.load(self.cafe_name)._traverse_to_node("/cubby2/mittens"))
+
+    def test_new_cubbies_from_an_import_get_shards(self):
+        path = os.path.join(tempfile.mkdtemp(), "cats.jsonl")
+        with open(path, "w") as f:
+            f.write(json.dumps({"path": "/upstairs/attic", "name": "ghost"}) + "\n")
+            f.write(json.dumps({"path": "/cubby1", "name": "pepper"}) + "\n")
+        self.tree.bulk_load(path)
+        tree = DirectoryTree.load(self.cafe_name)
+        self.assertIsNotNone(tree._traverse_to_node("/upstairs/attic/ghost"))
+        self.assertIsNotNone(tree._traverse_to_node("/cubby1/pepper"))
+
+    def test_save_interrupted_before_its_commit_record_is_dropped(self):
+        with mock.patch("random.random", return_value=0.0), redirect_stdout(io.StringIO()):
+            self.tree.carry("shadow")
+            self.tree.walk("/cubby2")
+            with mock.patch("shards.write_cafe", side_effect=OSError("disk full")), self.assertRaises(OSError):
+                self.tree.put("shadow")
+        tree = DirectoryTree.load(self.cafe_name)
+        self.assertEqual([c.name for c in tree.carried_cats], ["shadow"])
+        self.assertIsNone(tree._traverse_to_node("/cubby2/shadow"))
+        self.assertFalse([f for f in os.listdir(self.tree._shard_path) if f.endswith(".tmp")])
+        # the failed save's shards are written by the next one
+        self.tree._save()
+        tree = DirectoryTree.load(self.cafe_name)
+        self.assertEqual(tree.carried_cats, [])
+        self.assertIsNotNone(tree._traverse_to_node("/cubby2/shadow"))
+
+    def test_save_interrupted_after_its_commit_record_is_finished(self):
+        with mock.patch("random.random", return_value=0.0), redirect_stdout(io.StringIO()):
+            self.tree.carry("shadow")
+            self.tree.walk("/cubby2")
+            with mock.patch.object(ShardStore, "_install", side_effect=OSError("crash")), self.assertRaises(OSError):
+                self.tree.put("shadow")
+        tree = DirectoryTree.load(self.cafe_name)
+        self.assertEqual(tree.carried_cats, [])
+        self.assertIsNone(tree._traverse_to_node("/cubby1/shadow"))
+        self.assertIsNotNone(tree._traverse_to_node("/cubby2/shadow"))
+        self.assertFalse(os.path.exists(os.path.join(self.tree._shard_path, "commit")))
+
+    def test_save_is_on_disk_before_each_step(self):
+        import shards
+        steps = []
+        def step(name, function):
+            def run(path, *args):
+                steps.append((name, os.path.basename(path)))
+                return function(path, *args)
+            return run
+        with mock.patch("shards.write_synced", step("file", shards.write_synced)), \
+                mock.patch("shards.sync_directory", step("directory", shards.sync_directory)), \
+                mock.patch("shards.write_cafe", step("record", shards.write_cafe)), \
+                mock.patch("storage.os.fsync", wraps=os.fsync) as fsync, redirect_stdout(io.StringIO()):
+            self.tree.rescue("mittens")
+        files = [name for kind, name in steps if kind == "file"]
+        self.assertIn(self.shard("/cubby1") + ".tmp", files)
+        directory = os.path.basename(self.tree._shard_path)
+        self.assertEqual(steps[len(files):], [("directory", directory), ("record", "commit"), ("record", "manifest"),
+                                              ("directory", directory)])
+        # every shard and bucket, then the record and manifest each with their rename
+        self.assertEqual(fsync.call_count, len(files) + 1 + 2 * 2 + 1)
+
+    def test_file_cafe_is_converted(self):
+        name = f"{self.cafe_name}_file"
+        tree = DirectoryTree(name=name, role=Role.ADMIN)
+        with redirect_stdout(io.StringIO()):
+            tree.mkcby("cubby1")
+            tree.walk("cubby1")
+            tree.rescue("bob")
+        try:
+            converted = DirectoryTree.load(name, sharded=True)
+            self.assertFalse(os.path.exists(tree._path))
+            self.assertTrue(ShardStore.exists(tree._shard_path))
+            self.assertEqual(self.listing(DirectoryTree.load(name)), self.listing(tree))
+            self.assertIsNotNone(converted._shards)
+        finally:
+            shutil.rmtree(tree._shard_path, ignore_errors=True)
+            if os.path.exists(tree._path):
+                os.remove(tree._path)
+
+class TestLazyLoading(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"lazycafe_{random.randint(0, int(1e9))}"
+        tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN, sharded=True)
+        with redirect_stdout(io.StringIO()):
+            tree.rescue("whiskers")
+            for cubby in ("a", "b", "c"):
+                tree.walk("/")
+                tree.mkcby(cubby)
+                tree.walk(cubby)
+                tree.rescue(f"{cubby}_cat")
+                tree.rescue("twin")
+            tree.mkcby("deep")
+            tree.walk("deep")
+            tree.rescue("deep_cat")
+        tree.close()
+        self.tree = DirectoryTree.load(self.cafe_name, Role.ADMIN)
+
+    def tearDown(self):
+        self.tree.close()
+        shutil.rmtree(self.tree._shard_path, ignore_errors=True)
+
+    def unread(self, tree=None):
+        tree = tree or self.tree
+        return sorted(tree._get_wd_of_node(folder) for folder in tree._shards.unloaded)
+
+    def test_opening_reads_only_the_root(self):
+        self.assertEqual(self.tree._shards.shards_read, 1)
+        self.assertEqual(self.unread(), ["/a", "/b", "/c"])
+        self.assertEqual(self.tree._find_node_in_current("whiskers").name, "whiskers")
+
+    def test_walk_and_prowl_read_the_cubbies_they_reach(self):
+        with redirect_stdout(io.StringIO()) as out:
+            self.tree.walk("/c/deep")
+            self.tree.walk("/b")
+            self.tree.prowl()
+        self.assertIn("b_cat", out.getvalue())
+        # walking into a cubby does not need its contents yet
+        self.assertEqual(self.unread(), ["/a", "/c/deep"])
+        self.assertEqual(self.tree._shards.shards_read, 3)
+
+    def test_find_reads_only_the_cubbies_holding_the_name(self):
+        self.assertEqual(self.tree._get_wd_of_node(self.tree._find_file_in_tree("deep_cat")), "/c/deep/deep_cat")
+        self.assertEqual(self.unread(), ["/a", "/b"])
+        self.assertIsNone(self.tree._find_file_in_tree("nobody"))
+        self.assertEqual(self.unread(), ["/a", "/b"])
+        self.assertEqual([path for path, _ in self.tree.iter_find("twin")], ["/c/twin", "/a/twin", "/b/twin"])
+        self.assertEqual(self.unread(), [])
+
+    def test_patterns_and_property_indexes_read_everything(self):
+        self.assertEqual(sorted(path for path, _ in self.tree.iter_find("*_cat")),
+                         ["/a/a_cat", "/b/b_cat", "/c/c_cat", "/c/deep/deep_cat"])
+        self.assertEqual(self.unread(), [])
+        tree = DirectoryTree.load(self.cafe_name, property_indexes=["mood"])
+        self.assertEqual(self.unread(tree), [])
+
+    def test_changes_keep_the_name_index_current(self):
+        with mock.patch("random.random", return_value=0.0), redirect_stdout(io.StringIO()):
+            self.tree.walk("/b")
+            self.tree.rescue("mittens")
+            self.tree.carry("b_cat")
+            self.tree.adopted("twin")
+            self.tree.walk("/a")
+            self.tree.put("b_cat")
+            self.tree.recollar("a_cat", "renamed")
+        tree = DirectoryTree.load(self.cafe_name)
+        self.assertEqual(tree._get_wd_of_node(tree._find_file_in_tree("b_cat")), "/a/b_cat")
+        self.assertEqual(tree._get_wd_of_node(tree._find_file_in_tree("mittens")), "/b/mittens")
+        self.assertIsNone(tree._find_file_in_tree("a_cat"))
+        self.assertEqual(sorted(path for path, _ in tree.iter_find("twin")), ["/a/twin", "/c/twin"])
+
+    def test_cubbies_are_ready_before_they_are_seen(self):
+        # other threads see a cubby's children as soon as they are set, without waiting for the load
+        fill = FolderNode._fill
+        filled = []
+        def check(folder, children):
+            filled.append(folder.name)
+            for child in children:
+                if not child.is_file:
+                    self.assertIs(child._store, self.tree._shards)
+                    self.assertIn(child, self.tree._shards.unloaded)
+            fill(folder, children)
+            self.assertIs(folder._store, self.tree._shards)
+        with mock.patch.object(FolderNode, "_fill", check):
+            self.assertEqual(self.tree._get_wd_of_node(self.tree._find_file_in_tree("deep_cat")), "/c/deep/deep_cat")
+        self.assertEqual(filled, ["c", "deep"])
+        self.assertEqual(self.unread(), ["/a", "/b"])
+
+    def test_eager_load_reads_everything(self):
+        tree = DirectoryTree.load(self.cafe_name, lazy=False)
+        self.assertEqual(self.unread(tree), [])
+        self.assertEqual(tree._shards.shards_read, 5)
+
+class TestCafeImage(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"imagecafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN)
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("whiskers", Role.VISITOR)
+            self.tree.mkcby("b")
+            self.tree.mkcby("a")
+            self.tree.walk("a")
+            self.tree.rescue("twin", Role.VISITOR)
+            self.tree.rescue("grumpy", Role.ADMIN)
+            self.tree.meow("twin", "mood", "sleepy")
+            self.tree.mkcby("deep")
+            self.tree.walk("deep")
+            self.tree.rescue("twin", Role.VISITOR)
+            self.tree.rescue("ünïcode", Role.VISITOR)
+            self.tree.walk("/b")
+            self.tree.rescue("tabby", Role.VISITOR)
+        self.tree._find_node_in(self.tree.root, "whiskers").age = 4
+        self.tree._find_node_in(self.tree.root, "whiskers").date_fed = 2.5
+        self.tree.walk("/")
+        with redirect_stdout(io.StringIO()):
+            self.tree.export_image()
+        self.image = ImageTree(self.cafe_name)
+
+    def tearDown(self):
+        self.image.close()
+        self.tree.close()
+        for path in (self.tree.cafe_path(self.cafe_name), self.tree.image_path(self.cafe_name)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def run_image(self, *commands):
+        with redirect_stdout(io.StringIO()) as out:
+            results = [run_command(self.image, command) for command in commands]
+        return results, out.getvalue()
+
+    def test_records_match_the_tree(self):
+        self.assertEqual(list(self.image.iter_records()), list(self.tree.iter_records()))
+        self.assertEqual(list(self.image.iter_records("/a")), list(self.tree.iter_records("/a")))
+        whiskers = next(record for record in self.image.iter_records() if record["name"] == "whiskers")
+        self.assertEqual((whiskers["age"], whiskers["date_fed"]), (4, 2.5))
+        self.assertRaises(ValueError, self.image.iter_records, "/whiskers")
+
+    def test_walk_prowl_and_cat(self):
+        results, out = self.run_image("prowl", "walk a/deep", "pawprint", "walk ../..", "walk /a", "cat twin", "boop grumpy")
+        self.assertEqual(results, [True] * 6 + [False])
+        self.assertIn(" - whiskers (cat)\n - b (cubby)\n - a (cubby)", out)
+        self.assertIn("Current cubby: /a/deep", out)
+        self.assertIn("Cat: twin\nmood: sleepy", out)
+        self.assertIn("Permission denied", out)
+        self.assertEqual(self.image.image.path(self.image.current_node), "/a")
+        results, _ = self.run_image("walk /whiskers", "walk /nowhere", "cat deep", "cat nobody")
+        self.assertEqual(results, [False] * 4)
+
+    def test_find_and_query(self):
+        self.assertEqual([path for path, _ in self.image.iter_find("twin")], ["/a/twin", "/a/deep/twin"])
+        self.assertEqual([path for path, _ in self.image.iter_find("t*")], ["/b/tabby", "/a/twin", "/a/deep/twin"])
+        self.assertEqual([path for path, _ in self.image.iter_find("^[gw]", regex=True)], ["/a/grumpy", "/whiskers"])
+        self.assertEqual(list(self.image.iter_find("nobody")), [])
+        _, out = self.run_image("find ünïcode", "query age>=3", "query --in /a mood=sleepy")
+        self.assertIn("Found ünïcode in /a/deep/ünïcode", out)
+        self.assertIn("/whiskers\n1 cat found", out)
+        self.assertIn("/a/twin\n1 cat found", out)
+        self.assertEqual(self.image.complete("a/"), ["a/deep", "a/grumpy", "a/twin"])
+
+    def test_changes_are_refused(self):
+        results, out = self.run_image("rescue kitten", "mkcby new", "meow whiskers age 5", "begin", "image")
+        self.assertEqual(results, [False] * 5)
+        self.assertEqual(out.count("read-only image"), 5)
+        self.assertEqual(self.image.image.node_count, 10)
+
+    def test_new_image_replaces_the_old_one(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.rescue("newcomer")
+            self.tree.export_image()
+        # the open viewer keeps the image it mapped, a new one sees the change
+        self.assertEqual(list(self.image.iter_find("newcomer")), [])
+        viewer = ImageTree(self.cafe_name)
+        self.addCleanup(viewer.close)
+        self.assertEqual([path for path, _ in viewer.iter_find("newcomer")], ["/newcomer"])
+
+    def test_not_an_image(self):
+        self.assertRaises(CafeFormatError, ImageTree, self.cafe_name, path=self.tree.cafe_path(self.cafe_name))
+        with tempfile.NamedTemporaryFile() as empty:
+            self.assertRaises(CafeFormatError, ImageTree, self.cafe_name, path=empty.name)
+
+class TestParallelSearch(unittest.TestCase):
+    def setUp(self):
+        self.cafe_name = f"parallelcafe_{random.randint(0, int(1e9))}"
+        self.tree = DirectoryTree(name=self.cafe_name, role=Role.ADMIN, index=False)
+        self.tree.set_negative_cache_size(0)
+        rng = random.Random(7)
+        with redirect_stdout(io.StringIO()):
+            # cubbies of uneven sizes, a few levels deep, with cats before and after their subcubbies
+            for top in range(3):
+                self.tree.walk("/")
+                self.tree.mkcby(f"top{top}")
+                self.tree.rescue(f"stray{top}")
+                for sub in range(top + 1):
+                    self.tree.walk(f"/top{top}")
+                    self.tree.mkcby(f"sub{sub}")
+                    self.tree.walk(f"sub{sub}")
+                    for name in dict.fromkeys(f"cat{rng.randrange(40)}" for _ in range(rng.randrange(5, 30))):
+                        self.tree.rescue(name)
+                        self.tree.meow(name, "age", str(rng.randrange(10)))
+                self.tree.walk(f"/top{top}")
+                self.tree.rescue("twin")
+            self.tree.walk("/")
+            self.tree.rescue("twin")
+            self.tree.rescue("cat1")
+
+    def tearDown(self):
+        self.tree.close()
+        os.remove(self.tree.cafe_path(self.cafe_name))
+
+    def enable(self):
+        """Turns parallel search on and waits for the snapshot its first search starts writing"""
+        self.tree.enable_parallel_search(2)
+        self.wait_for_snapshot()
+
+    def wait_for_snapshot(self):
+        self.assertIsNone(self.tree._parallel_search(("name", "nobody")))
+        snapshotting = self.tree._snapshotting
+        if snapshotting is not None:
+            snapshotting.join()
+
+    def results(self):
+        return ([path for path, _ in self.tree.iter_find("twin")],
+                [path for path, _ in self.tree.iter_find("cat1*")],
+                [path for path, _ in self.tree.iter_find("^cat[0-9]$", regex=True)],
+                [path for path, _ in self.tree.iter_query(["age>=5"])],
+                [path for path, _ in self.tree.iter_query(["age<3"], scope="/top2")],
+                self.tree._find_file_in_tree("cat1"), self.tree._find_file_in_tree("nobody"))
+
+    def test_same_results_in_the_same_order(self):
+        sequential = self.results()
+        self.assertEqual(sequential[0], ["/twin", "/top0/twin", "/top1/twin", "/top2/twin"])
+        self.enable()
+        with mock.patch.object(self.tree._parallel, "search", wraps=self.tree._parallel.search) as search:
+            self.assertEqual(self.results(), sequential)
+        self.assertEqual(search.call_count, 7)
+
+    def test_tasks_cover_the_tree_in_order(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.export_image()
+        image_path = self.tree.image_path(self.cafe_name)
+        self.addCleanup(os.remove, image_path)
+        image = ImageTree(self.cafe_name).image
+        self.addCleanup(image.close)
+        everything = ("pattern", "*", False)
+        for count in (1, 2, 5, 100):
+            tasks = split(image, image.ROOT, count)
+            self.assertEqual(tasks[0], (image.ROOT, False) if count > 1 else (image.ROOT, True))
+            found = []
+            for folder, recursive in tasks:
+                found += image.cats_under(folder, recursive)
+            self.assertEqual(found, search(image, everything))
+        self.assertEqual(len(split(image, image.ROOT, 100)), 10)  # every cubby split off
+
+    def test_first_match_is_the_earliest(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.export_image()
+        image_path = self.tree.image_path(self.cafe_name)
+        self.addCleanup(os.remove, image_path)
+        pool = ParallelSearch(2)
+        self.addCleanup(pool.close)
+        # the root's own twin is checked first, though the subtrees come before it in the image
+        self.assertEqual(pool.search(image_path, ("name", "twin"), first=True)[0][0], "/twin")
+        self.assertEqual(pool.search(image_path, ("name", "twin"), scope="/top1", first=True)[0][0], "/top1/twin")
+        self.assertEqual(pool.search(image_path, ("name", "nobody"), first=True), [])
+        self.assertEqual([path for path, _ in pool.search(image_path, ("name", "twin"))],
+                         ["/twin", "/top0/twin", "/top1/twin", "/top2/twin"])
+        self.assertRaises(ValueError, pool.search, image_path, ("name", "twin"), "/twin")
+
+    def test_snapshot_follows_changes(self):
+        self.enable()
+        self.assertEqual(list(self.tree.iter_find("newcomer")), [])
+        snapshot = self.tree._snapshot
+        with redirect_stdout(io.StringIO()):
+            self.tree.walk("/top1/sub0")
+            self.tree.rescue("newcomer")
+        cat = self.tree._find_node_in_current("newcomer")
+        # the stale snapshot is not searched, nor waited for
+        encoding = threading.Event()
+        release = threading.Event()
+        def slow_encode(*args):
+            encoding.set()
+            release.wait(5)
+            return encode_image(*args)
+        with mock.patch("directory.encode_image", slow_encode):
+            self.assertEqual(list(self.tree.iter_find("newcomer")), [("/top1/sub0/newcomer", cat)])
+            self.assertTrue(encoding.wait(5))
+            self.assertEqual([path for path, _ in self.tree.iter_query(["age<3"], scope="/top1/sub0")],
+                             ["/top1/sub0/cat14", "/top1/sub0/cat35"])
+            self.assertIs(self.tree._snapshot, snapshot)
+            release.set()
+            self.tree._snapshotting.join()
+        self.assertIs(self.tree._snapshot.nodes[self.tree._snapshot.ids[cat]], cat)
+        self.assertFalse(os.path.exists(snapshot.path))
+        with mock.patch.object(self.tree._parallel, "search", wraps=self.tree._parallel.search) as search:
+            self.assertEqual(list(self.tree.iter_find("newcomer")), [("/top1/sub0/newcomer", cat)])
+        self.assertEqual(search.call_count, 1)
+        snapshot = self.tree._snapshot
+        self.tree.close()
+        self.assertFalse(os.path.exists(snapshot.path))
+
+    def test_cats_come_back_as_themselves(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.walk("/top0")
+            self.tree.rescue("a/b")
+            # two cats of one name in a cubby, which only a direct mutation makes
+            self.tree._mutate("rescue", "dup", Role.STAFF)
+            self.tree._mutate("rescue", "dup", Role.STAFF)
+        dups = [cat for cat in self.tree.current_node.children if cat.name == "dup"]
+        for age, cat in enumerate(dups, 50):
+            cat.age = str(age)
+        slashed = self.tree._find_node_in_current("a/b")
+        self.enable()
+        self.assertEqual([cat for _, cat in self.tree.iter_find("dup")], dups)
+        self.assertEqual([cat for _, cat in self.tree.iter_query(["age>=50"])], dups)
+        self.assertEqual(list(self.tree.iter_find("a/b")), [("/top0/a/b", slashed)])
+        self.assertIs(self.tree._find_file_in_tree("a/b"), slashed)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.tree.find("a/b")
+        self.assertIn("Found a/b in /top0/a/b", output.getvalue())
+
+    def test_search_does_not_hold_the_tree_lock(self):
+        self.enable()
+        search = self.tree._parallel.search
+        acquired = []
+        def take_the_lock():
+            if self.tree._lock.acquire(timeout=5):
+                self.tree._lock.release()
+                acquired.append(True)
+        def search_while_locking(*args):
+            other = threading.Thread(target=take_the_lock)
+            other.start()
+            other.join()
+            return search(*args)
+        self.tree._parallel.search = search_while_locking
+        self.assertEqual([path for path, _ in self.tree.iter_find("twin")], ["/twin", "/top0/twin", "/top1/twin", "/top2/twin"])
+        self.assertEqual(acquired, [True])
+
+    def test_image_viewer_queries(self):
+        with redirect_stdout(io.StringIO()):
+            self.tree.export_image()
+        self.addCleanup(os.remove, self.tree.image_path(self.cafe_name))
+        viewer = ImageTree(self.cafe_name)
+        self.addCleanup(viewer.close)
+        expected = [path for path, _ in self.tree.iter_query(["age>=5"])]
+        self.assertEqual([path for path, _ in viewer.iter_query(["age>=5"])], expected)
+        viewer.enable_parallel_search(2)
+        self.assertEqual([path for path, _ in viewer.iter_query(["age>=5"])], expected)
+
 def run_tests():
     # Set up logging
     logging.basicConfig(level=logging.INFO)
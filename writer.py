@@ -0,0 +1,77 @@
+# background thread that saves cafe snapshots off the command path
+import atexit
+import sys
+import threading
+
+class BackgroundWriter:
+    """
+    Calls save() on a daemon thread whenever it is woken. Wake-ups that arrive while a save
+    is waiting or running are coalesced, so a burst of mutations costs one or two snapshots.
+    Whatever is pending is flushed when the interpreter exits.
+    """
+    def __init__(self, save, delay: float = 0.05):
+        """
+        Args:
+            save: Called with no arguments to write a snapshot
+            delay (float): How long (seconds) to wait after a wake-up for more mutations before saving
+        """
+        self.save = save
+        self.delay = delay
+        self.saves = 0
+        self._cond = threading.Condition()
+        self._pending = False
+        self._busy = False
+        self._urgent = False
+        self._stopped = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="catfs-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def wake(self) -> None:
+        """Asks for a save, returns immediately"""
+        with self._cond:
+            self._pending = True
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._stopped)
+                if not self._pending:
+                    return
+                # let the rest of a burst of mutations arrive, unless someone is waiting on us
+                self._cond.wait_for(lambda: self._urgent or self._stopped, timeout=self.delay)
+                self._pending = False
+                self._busy = True
+            try:
+                self.save()
+            except Exception as e:
+                print(f"Background save failed: {e}", file=sys.stderr)
+                self._error = e
+            with self._cond:
+                self._busy = False
+                self.saves += 1
+                self._cond.notify_all()
+
+    def flush(self) -> None:
+        """Blocks until every save asked for so far is written, re-raises the error if one failed"""
+        with self._cond:
+            self._urgent = True
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: not (self._pending or self._busy))
+            self._urgent = False
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def close(self) -> None:
+        """Flushes and stops the thread"""
+        atexit.unregister(self.close)
+        try:
+            self.flush()
+        finally:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+            self._thread.join()